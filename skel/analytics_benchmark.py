@@ -0,0 +1,71 @@
+"""
+This module measures the order analytics over millions of units
+
+It submits orders of a few products for a few consumers, then times the
+report computed over the columns with NumPy against the same aggregates
+computed unit by unit in Python.
+
+Usage: python3 analytics_benchmark.py [--units 3000000] [--consumers 4]
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import argparse
+from collections import Counter
+from time import perf_counter
+
+from tema.order_analytics import OrderAnalytics
+from tema.product import Coffee, Tea
+
+
+def python_report(analytics):
+    """
+    Returns the units, revenue by kind and revenue by consumer, one unit at a time.
+    """
+    products = analytics.catalog.products()
+    consumers = list(analytics.consumer_ids)
+    by_kind = Counter()
+    by_consumer = Counter()
+    for product_id, consumer_id, price in zip(analytics.product_id, analytics.consumer_id,
+                                              analytics.price):
+        by_kind[type(products[product_id]).__name__] += price
+        by_consumer[consumers[consumer_id]] += price
+    return len(analytics.product_id), by_kind, by_consumer
+
+
+def main():
+    """
+        Prints the time to record the orders and to compute the reports
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--units", type=int, default=3000000)
+    parser.add_argument("--consumers", type=int, default=4)
+    args = parser.parse_args()
+
+    products = (Tea(name="Linden", price=9, type="Herbal"),
+                Tea(name="Sencha", price=12, type="Green"),
+                Coffee(name="Brasil", price=7, acidity=5.09, roast_level="MEDIUM"))
+    order = products * (args.units // args.consumers // len(products))
+
+    analytics = OrderAnalytics()
+    start = perf_counter()
+    for idx in range(args.consumers):
+        analytics.submit(f"cons{idx}", order)
+    submitted = perf_counter() - start
+
+    report = analytics.report()
+    start = perf_counter()
+    python_report(analytics)
+    python_seconds = perf_counter() - start
+
+    print(f"{report['units']} units, recorded in {submitted:.2f} s")
+    print(f"{'report':>18} {'seconds':>12}")
+    print(f"{'numpy':>18} {report['seconds']:>12.4f}")
+    print(f"{'python':>18} {python_seconds:>12.4f}")
+    print(f"{'speedup':>18} {python_seconds / report['seconds']:>11.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""
+This module benchmarks the marketplace end to end on the test scenarios
+
+Every scenario (tests/*.in by default, or generated ones) runs several times,
+each run in a process of its own so that its peak RSS is its own. A run reports
+its wall time, the marketplace operations per second and, from the snapshot of
+the marketplace's metrics, the latency percentiles of every marketplace method
+and the time spent on its locks; the results are written as JSON.
+Two result files can then be compared to catch performance regressions.
+
+Usage: python3 benchmark.py run [scenarios] [--repeat 3] [--sleep-scale 1.0] [-o out.json]
+       python3 benchmark.py compare base.json new.json [--threshold 0.1]
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import argparse
+import glob
+import json
+import logging
+import platform
+import resource
+import sys
+from multiprocessing import Pipe, Process
+from statistics import median
+
+from benchmark_utils import scale_sleeps, timed
+from tema.marketplace import Marketplace
+from tema.scenario import load_config, run_threads
+
+def latency(methods):
+    """
+    Returns the call count, failures and latency percentiles (in microseconds, the
+    upper bounds of the metrics' histogram buckets) of every method of a snapshot.
+    """
+    return {method: {"count": stats["calls"], "failed": stats["failed"],
+                     **{f"{percentile}_us": bound
+                        for percentile, bound in stats["latency_us"].items()}}
+            for method, stats in methods.items()}
+
+
+def run_once(scenario, sleep_scale, connection):
+    """
+    Process body: runs the scenario once and sends its measurements over the connection.
+    """
+    # Measure the marketplace, not the log file
+    logging.disable(logging.CRITICAL)
+
+    market_config = load_config(scenario)
+    scale_sleeps(market_config, sleep_scale)
+    marketplace = Marketplace(**market_config['marketplace'], metrics=True)
+
+    wall = timed(run_threads, market_config, 0, marketplace)
+
+    # The producer threads keep running, the snapshot is taken once
+    snapshot = marketplace.snapshot()
+    ops = sum(stats["calls"] for stats in snapshot["methods"].values())
+
+    connection.send({
+        "wall_s": wall,
+        "ops": ops,
+        "ops_per_s": ops / wall,
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "latency": latency(snapshot["methods"]),
+        "locks": snapshot["locks"],
+    })
+    connection.close()
+
+
+def measure(scenario, sleep_scale):
+    """
+    Runs the scenario once in a new process and returns its measurements.
+    """
+    receiver, sender = Pipe(duplex=False)
+    worker = Process(target=run_once, args=(scenario, sleep_scale, sender))
+    worker.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError as error:
+        raise RuntimeError(f"{scenario} failed, exit code {worker.exitcode}") from error
+    finally:
+        worker.join()
+
+    return result
+
+
+def summarize(runs):
+    """
+    Returns the median of every measurement over the runs, the maximum for the RSS.
+    """
+    summary = {key: median(run[key] for run in runs) for key in ("wall_s", "ops", "ops_per_s")}
+    summary["peak_rss_kib"] = max(run["peak_rss_kib"] for run in runs)
+    summary["latency"] = {}
+    for method in runs[0]["latency"]:
+        summary["latency"][method] = {
+            key: median(run["latency"][method][key] for run in runs
+                        if method in run["latency"])
+            for key in runs[0]["latency"][method]}
+    return summary
+
+
+def run(args):
+    """
+    Benchmarks the scenarios and writes the results as JSON.
+    """
+    scenarios = args.scenarios or sorted(glob.glob("tests/*.in"))
+    results = {
+        "python": platform.python_version(),
+        "repeat": args.repeat,
+        "sleep_scale": args.sleep_scale,
+        "scenarios": {},
+    }
+
+    for scenario in scenarios:
+        runs = [measure(scenario, args.sleep_scale) for _ in range(args.repeat)]
+        summary = summarize(runs)
+        results["scenarios"][scenario] = {"summary": summary, "runs": runs}
+        print(f"{scenario}: {summary['wall_s']:.2f} s, {summary['ops_per_s']:.0f} ops/s, "
+              f"{summary['peak_rss_kib']} KiB", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w', encoding="utf-8") as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+def change(base, new):
+    """
+    Returns the relative change from base to new.
+    """
+    return (new - base) / base if base else 0.0
+
+
+def compare(args):
+    """
+    Compares two result files and prints a table of the changes.
+
+    returns 1 if a scenario regressed by more than the threshold, 0 otherwise
+    """
+    with open(args.base, encoding="utf-8") as base_file:
+        base = json.load(base_file)["scenarios"]
+    with open(args.new, encoding="utf-8") as new_file:
+        new = json.load(new_file)["scenarios"]
+
+    regressions = 0
+    print(f"{'scenario':>16} {'ops/s':>8} {'wall':>8} {'rss':>8} {'worst p99':>22}")
+    for scenario in sorted(base.keys() & new.keys()):
+        old_summary = base[scenario]["summary"]
+        new_summary = new[scenario]["summary"]
+
+        ops = change(old_summary["ops_per_s"], new_summary["ops_per_s"])
+        wall = change(old_summary["wall_s"], new_summary["wall_s"])
+        rss = change(old_summary["peak_rss_kib"], new_summary["peak_rss_kib"])
+        p99 = {method: change(stats["p99_us"], new_summary["latency"][method]["p99_us"])
+               for method, stats in old_summary["latency"].items()
+               if method in new_summary["latency"]}
+        worst = max(p99, key=p99.get, default=None)
+
+        # Fewer operations per second or a longer run
+        regressed = ops < -args.threshold or wall > args.threshold
+        regressions += regressed
+        worst_text = f"{worst} {p99[worst]:+.1%}" if worst else "-"
+        print(f"{scenario:>16} {ops:>+8.1%} {wall:>+8.1%} {rss:>+8.1%} {worst_text:>22}"
+              f"{'  REGRESSION' if regressed else ''}")
+
+    return 1 if regressions else 0
+
+
+def main():
+    """
+        Parses the command line and runs the benchmark or the comparison
+    """
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="benchmark the scenarios")
+    run_parser.add_argument("scenarios", nargs='*',
+                            help="scenario files (default: tests/*.in)")
+    run_parser.add_argument("--repeat", type=int, default=3,
+                            help="number of runs of every scenario")
+    run_parser.add_argument("--sleep-scale", type=float, default=1.0,
+                            help="factor applied to every waiting time of the scenarios")
+    run_parser.add_argument("-o", "--output", help="JSON results file (default: stdout)")
+
+    compare_parser = commands.add_parser("compare", help="compare two results files")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="relative slowdown reported as a regression")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+        return 0
+    return compare(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,51 @@
+"""
+This module holds the helpers shared by the benchmarks
+
+They scale the waiting times of a scenario down, so that the marketplace
+operations dominate the run time, and time a run with the bought products
+discarded.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import os
+import sys
+from time import perf_counter
+
+from tema.order_sink import get_order_sink
+
+
+def scale_sleeps(market_config, factor):
+    """
+    Scales every waiting time of the scenario.
+    """
+    for producer in market_config['producers']:
+        producer['products'] = [(product, quantity, sleep_time * factor)
+                                for product, quantity, sleep_time in producer['products']]
+        producer['republish_wait_time'] *= factor
+
+    for consumer in market_config['consumers']:
+        consumer['retry_wait_time'] *= factor
+
+
+def timed(run, *args):
+    """
+    Runs the scenario with stdout (inherited by the worker processes) sent to /dev/null.
+    Returns the wall time in seconds.
+    """
+    sys.stdout.flush()
+    stdout = os.dup(1)
+    with open(os.devnull, 'w', encoding="utf-8") as devnull:
+        os.dup2(devnull.fileno(), 1)
+        try:
+            start = perf_counter()
+            run(*args)
+            return perf_counter() - start
+        finally:
+            # The sink's writer thread may still hold orders for the old fd 1
+            get_order_sink().flush()
+            sys.stdout.flush()
+            os.dup2(stdout, 1)
+            os.close(stdout)
@@ -0,0 +1,135 @@
+"""
+This module measures what the product catalog saves the marketplace
+
+It compares looking products up by value (the frozen dataclasses hash and
+compare every field) with the catalog's integer ids, and the size and build
+time of __slots__ records (CatalogEntry) with regular objects (DictEntry),
+printing the delta and the ratio of each measure. It then runs a scenario (tests/10.in
+by default) with tracemalloc to report its wall time and peak memory.
+
+Usage: python3 catalog_benchmark.py [scenario] [--lookups 1000000] [--records 100000]
+                                    [--sleep-scale 0.01]
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import argparse
+import logging
+import sys
+import tracemalloc
+from time import perf_counter
+
+from benchmark_utils import scale_sleeps, timed
+from tema.catalog import CatalogEntry, ProductCatalog
+from tema.scenario import load_config, run_threads
+
+
+class DictEntry:
+    """
+    The same record as CatalogEntry, without __slots__.
+    """
+
+    def __init__(self, product_id, product):
+        self.product_id = product_id
+        self.product = product
+
+    def __repr__(self):
+        return f"DictEntry({self.product_id}, {self.product!r})"
+
+
+def lookups_per_second(lookup, products, count):
+    """
+    Returns the number of lookups per second over the products, in turn.
+    """
+    rounds = count // len(products)
+    start = perf_counter()
+    for _ in range(rounds):
+        for product in products:
+            lookup(product)
+    return rounds * len(products) / (perf_counter() - start)
+
+
+def record_size(record):
+    """
+    Returns the bytes taken by a record and its attribute dict, if it has one.
+    """
+    size = sys.getsizeof(record)
+    if hasattr(record, "__dict__"):
+        size += sys.getsizeof(record.__dict__)
+    return size
+
+
+def build(record_class, products, count):
+    """
+    Builds count records over the products, in turn.
+
+    returns the seconds taken and the bytes the records hold, traced apart
+    """
+    start = perf_counter()
+    records = [record_class(idx, products[idx % len(products)]) for idx in range(count)]
+    seconds = perf_counter() - start
+    del records
+
+    tracemalloc.start()
+    records = [record_class(idx, products[idx % len(products)]) for idx in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, size
+
+
+def main():
+    """
+        Prints the lookup rates, the record sizes and build times, and the
+        scenario's time and memory
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenario", nargs='?', default="tests/10.in")
+    parser.add_argument("--lookups", type=int, default=1000000)
+    parser.add_argument("--records", type=int, default=100000)
+    parser.add_argument("--sleep-scale", type=float, default=0.01,
+                        help="factor applied to every waiting time of the scenario")
+    args = parser.parse_args()
+
+    # Measure the marketplace, not the log file
+    logging.disable(logging.CRITICAL)
+
+    market_config = load_config(args.scenario)
+    products = market_config['products']
+    by_value = {product: idx for idx, product in enumerate(products)}
+    catalog = ProductCatalog(products)
+
+    value_rate = lookups_per_second(by_value.get, products, args.lookups)
+    id_rate = lookups_per_second(catalog.find, products, args.lookups)
+    print(f"{'lookup':>18} {'ops/s':>12}")
+    print(f"{'by value':>18} {value_rate:>12.0f}")
+    print(f"{'catalog id':>18} {id_rate:>12.0f}")
+    print(f"{'delta':>18} {id_rate - value_rate:>+12.0f}")
+    print(f"{'ratio':>18} {id_rate / value_rate:>11.2f}x")
+
+    # Bytes per record, seconds and bytes of all the records; the deltas and ratios
+    # are CatalogEntry's against DictEntry's
+    measures = [(record_size(record_class(0, products[0])),
+                 *build(record_class, products, args.records))
+                for record_class in (DictEntry, CatalogEntry)]
+    (dict_bytes, dict_seconds, dict_size), (slots_bytes, slots_seconds, slots_size) = measures
+    print(f"{'record':>18} {'bytes':>12} {'build s':>12} {'held KiB':>12}")
+    print(f"{'DictEntry':>18} {dict_bytes:>12} {dict_seconds:>12.4f} {dict_size / 1024:>12.0f}")
+    print(f"{'CatalogEntry':>18} {slots_bytes:>12} {slots_seconds:>12.4f} "
+          f"{slots_size / 1024:>12.0f}")
+    print(f"{'delta':>18} {slots_bytes - dict_bytes:>+12} "
+          f"{slots_seconds - dict_seconds:>+12.4f} {(slots_size - dict_size) / 1024:>+12.0f}")
+    print(f"{'ratio':>18} {slots_bytes / dict_bytes:>11.2f}x "
+          f"{slots_seconds / dict_seconds:>11.2f}x {slots_size / dict_size:>11.2f}x")
+
+    scale_sleeps(market_config, args.sleep_scale)
+    tracemalloc.start()
+    seconds = timed(run_threads, market_config)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"scenario: {seconds:.2f} s, peak traced memory {peak / 1024:.0f} KiB")
+
+
+if __name__ == '__main__':
+    main()
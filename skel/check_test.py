@@ -1,12 +1,56 @@
 """
 This module checks that the homework's solution output is correct
 
+The output and the reference are compared as multisets of lines (a consumer
+buying a product), counted in one streaming pass over each file: no sorting,
+no copy of the files in memory, whatever their size.
+
 Computer Systems Architecture Course
 Assignment 1
 March 2021
 """
-import subprocess
 import sys
+from collections import Counter
+
+# Bytes read from the output at a time
+CHUNK_SIZE = 1 << 20
+
+
+def output_lines(output_filename):
+    """
+    Yields the lines of the output file, split after every ")"
+    """
+    rest = ""
+    with open(output_filename) as output_file:
+        for chunk in iter(lambda: output_file.read(CHUNK_SIZE), ""):
+            # sometimes there is no new line between consumer outputs
+            parts = (rest + chunk).split(")")
+            rest = parts.pop()
+            for part in parts:
+                if len(part.strip()) > 0:
+                    yield part.strip() + ")"
+
+    if len(rest.strip()) > 0:
+        yield rest.strip() + ")"
+
+
+def first_mismatch(output_filename, ref_filename):
+    """
+    Returns a description of the first line printed a different number of times
+    than in the reference, None if there is none
+    """
+    counts = Counter(output_lines(output_filename))
+
+    with open(ref_filename) as ref_file:
+        for line in ref_file:
+            line = line.strip()
+            if line:
+                counts[line] -= 1
+
+    for line, count in counts.items():
+        if count:
+            return f"{line}: {abs(count)} {'more' if count > 0 else 'fewer'} than expected"
+    return None
 
 
 def main():
@@ -17,29 +61,14 @@ def main():
     testname = sys.argv[1]
     output_filename = sys.argv[2]
     ref_filename = sys.argv[3]
-    # load the lines from the output file and sort them
-    with open(output_filename) as output_file:
-        output_lines = output_file.read()
-
-    output_lines = output_lines.split(")")  # sometimes there is no new line between consumer outputs
-    output_lines = [line.strip() + ")" for line in output_lines if len(line.strip()) > 0]
-
-    output_lines.sort()
-
-    sorted_output_filename = output_filename + ".sorted"
-
-    # write to input file (tests/{test_name}.in)
-    with open(sorted_output_filename, 'w') as sorted_output_file:
-        for line in output_lines:
-            print(line, file=sorted_output_file)
 
-    command = subprocess.Popen(["diff", sorted_output_filename, ref_filename], stdout=subprocess.PIPE)
-    out, err = command.communicate()
+    mismatch = first_mismatch(output_filename, ref_filename)
 
-    if len(out) == 0:
+    if mismatch is None:
         print(f"Test {testname}" + ":\t\t" + "PASSED")
     else:
         print(f"Test {testname}" + ":\t\t" + "FAILED")
+        print(f"\t{mismatch}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,126 @@
+"""
+This module measures the Marketplace's throughput under lock contention
+
+Every thread owns a producer, a cart and a product of its own, so threads only
+share the marketplace itself. The fine-grained marketplace is compared against
+the same marketplace with every method serialized on a single global lock
+(the previous producer_lock/customer_lock scheme behaved like this).
+
+Usage: python3 contention_benchmark.py [--threads 1 2 4 8 16] [--duration 1.0]
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import argparse
+import logging
+from threading import Lock, Thread, Barrier
+from time import perf_counter
+
+from tema.marketplace import Marketplace
+from tema.product import Tea
+
+
+class GlobalLockMarketplace(Marketplace):
+    """
+    Reference marketplace where every operation runs under one global lock.
+    A call that waits (timeout other than 0) would wait holding it.
+    """
+
+    def __init__(self, queue_size_per_producer):
+        self.global_lock = Lock()
+        Marketplace.__init__(self, queue_size_per_producer)
+
+    def register_producer(self):
+        with self.global_lock:
+            return Marketplace.register_producer(self)
+
+    def publish(self, producer_id, product, timeout=0):
+        with self.global_lock:
+            return Marketplace.publish(self, producer_id, product, timeout)
+
+    def publish_many(self, producer_id, product, quantity, timeout=0):
+        with self.global_lock:
+            return Marketplace.publish_many(self, producer_id, product, quantity, timeout)
+
+    def new_cart(self):
+        with self.global_lock:
+            return Marketplace.new_cart(self)
+
+    def add_to_cart(self, cart_id, product, quantity=1, timeout=0):
+        with self.global_lock:
+            return Marketplace.add_to_cart(self, cart_id, product, quantity, timeout)
+
+    def remove_from_cart(self, cart_id, product, quantity=1):
+        with self.global_lock:
+            return Marketplace.remove_from_cart(self, cart_id, product, quantity)
+
+    def place_order(self, cart_id):
+        with self.global_lock:
+            return Marketplace.place_order(self, cart_id)
+
+
+def worker(marketplace, index, duration, barrier, results):
+    """
+    Publishes, buys and returns a product of its own until the duration expires.
+    Stores the number of marketplace operations performed in results[index].
+    """
+    product = Tea(name=f"Tea {index}", price=1, type="Black")
+    producer_id = marketplace.register_producer()
+    cart_id = marketplace.new_cart()
+    ops = 0
+
+    barrier.wait()
+    deadline = perf_counter() + duration
+    while perf_counter() < deadline:
+        marketplace.publish(producer_id, product)
+        marketplace.add_to_cart(cart_id, product)
+        marketplace.remove_from_cart(cart_id, product)
+        marketplace.add_to_cart(cart_id, product)
+        ops += 4
+
+    results[index] = ops
+
+
+def measure(marketplace_class, threads, duration):
+    """
+    Returns the marketplace operations per second reached by the given number of threads.
+    """
+    marketplace = marketplace_class(queue_size_per_producer=threads * 2)
+    barrier = Barrier(threads)
+    results = [0] * threads
+
+    workers = [Thread(target=worker, args=(marketplace, i, duration, barrier, results))
+               for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    return sum(results) / duration
+
+
+def main():
+    """
+        Runs the benchmark for every thread count and prints a throughput table
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, nargs='+', default=[1, 2, 4, 8, 16],
+                        help="thread counts to measure")
+    parser.add_argument("--duration", type=float, default=1.0,
+                        help="seconds spent measuring each configuration")
+    args = parser.parse_args()
+
+    # Measure the locking, not the log file
+    logging.disable(logging.CRITICAL)
+
+    print(f"{'threads':>8} {'global ops/s':>14} {'fine ops/s':>14} {'speedup':>8}")
+    for threads in args.threads:
+        global_ops = measure(GlobalLockMarketplace, threads, args.duration)
+        fine_ops = measure(Marketplace, threads, args.duration)
+        print(f"{threads:>8} {global_ops:>14.0f} {fine_ops:>14.0f} {fine_ops / global_ops:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+This module replays a recorded marketplace trace on a marketplace implementation
+
+The trace is recorded with test.py --record; replaying it makes the same calls
+in a single thread at full speed and reports the throughput and the calls whose
+results differ from the recorded ones.
+
+Usage: python3 replay.py trace [--marketplace threads|shared] [--repeat 3]
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import argparse
+import json
+import logging
+import sys
+from statistics import median
+
+from tema.marketplace import Marketplace
+from tema.marketplace_trace import NEW_CART, REGISTER, Trace, replay
+from tema.shm_marketplace import SharedMarketplace
+
+
+def new_marketplace(trace, kind):
+    """
+    Returns a marketplace of the given kind able to take the calls of the trace.
+    """
+    if kind == "shared":
+        return SharedMarketplace(trace.queue_size_per_producer, trace.products,
+                                 max_producers=max(1, trace.count(REGISTER)),
+                                 max_carts=max(1, trace.count(NEW_CART)))
+    return Marketplace(trace.queue_size_per_producer)
+
+
+def main():
+    """
+        Replays the trace on new marketplaces and prints the results as JSON
+
+        returns 1 if a replay diverged from the trace, 0 otherwise
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace", help="trace file recorded with test.py --record")
+    parser.add_argument("--marketplace", choices=("threads", "shared"), default="threads",
+                        help="the implementation replayed on: Marketplace or SharedMarketplace")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of replays, each on a new marketplace")
+    args = parser.parse_args()
+
+    # Measure the marketplace, not the log file
+    logging.disable(logging.CRITICAL)
+
+    trace = Trace(args.trace)
+    runs = []
+    for _ in range(args.repeat):
+        marketplace = new_marketplace(trace, args.marketplace)
+        try:
+            runs.append(replay(trace, marketplace))
+        finally:
+            if args.marketplace == "shared":
+                marketplace.close(unlink=True)
+
+    json.dump({"trace": args.trace,
+               "marketplace": args.marketplace,
+               "calls": runs[0]["calls"],
+               "calls_per_s": median(run["calls_per_s"] for run in runs),
+               "divergences": runs[0]["divergences"],
+               "examples": runs[0]["examples"]}, sys.stdout, indent=2)
+    print()
+
+    return 1 if any(run["divergences"] for run in runs) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
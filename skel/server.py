@@ -0,0 +1,74 @@
+"""
+This module serves a marketplace to the producers and consumers of other processes
+
+They connect with a MarketplaceClient (see tema/marketplace_server.py), e.g.
+python3 test.py tests/10.in --connect /tmp/marketplace.sock
+
+Usage: python3 server.py address [--queue-size 8] [--allow-remote]
+    address: host:port to listen on TCP, or the path of a Unix socket
+
+The protocol has no authentication: TCP is only served on a loopback address,
+unless --allow-remote is given.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import argparse
+import ipaddress
+import signal
+import socket
+import sys
+
+from tema.marketplace import Marketplace
+from tema.marketplace_log import get_pipeline
+from tema.marketplace_server import MarketplaceServer, parse_address
+
+
+def is_loopback(host):
+    """
+    Returns whether the host resolves to a loopback address ("" is every address).
+    """
+    try:
+        return bool(host) and ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def main():
+    """
+        Serves a new marketplace until interrupted or terminated
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("address", help="host:port to listen on TCP, or a Unix socket path")
+    parser.add_argument("--queue-size", type=int, default=8,
+                        help="the maximum size of the queue of each producer")
+    parser.add_argument("--allow-remote", action="store_true",
+                        help="listen on a TCP address other than loopback; anyone who can "
+                             "connect can then use the marketplace")
+    parser.add_argument("--log-level", default="WARNING",
+                        help="minimum level written to marketplace.log")
+    args = parser.parse_args()
+
+    address = parse_address(args.address)
+    if isinstance(address, tuple) and not args.allow_remote and not is_loopback(address[0]):
+        parser.error(f"{args.address} is not a loopback address, see --allow-remote")
+
+    get_pipeline().set_level(args.log_level)
+
+    # Terminating unwinds like an interrupt, so that the Unix socket is removed
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    server = MarketplaceServer(Marketplace(args.queue_size), address)
+    print(f"serving on {server.address}", flush=True)
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
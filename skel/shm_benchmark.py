@@ -0,0 +1,64 @@
+"""
+This module compares the threaded marketplace with the multi-process one
+
+Both run the same scenario (tests/10.in by default) with every waiting time
+scaled down, so that the marketplace operations dominate the run time. The
+bought products are discarded.
+
+Usage: python3 shm_benchmark.py [scenario] [--processes 1 2 4] [--sleep-scale 0.01]
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import argparse
+import logging
+
+from benchmark_utils import scale_sleeps, timed
+from tema.scenario import load_config, run_threads, run_shared_memory
+
+
+def count_units(market_config):
+    """
+    Returns the number of units the consumers add to their carts.
+    """
+    return sum(operation['quantity']
+               for consumer in market_config['consumers']
+               for cart in consumer['carts']
+               for operation in cart if operation['type'] == 'add')
+
+
+def main():
+    """
+        Runs the scenario once with threads and once per process count and prints a table
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenario", nargs='?', default="tests/10.in")
+    parser.add_argument("--processes", type=int, nargs='+', default=[1, 2, 4],
+                        help="numbers of producer/consumer processes to measure")
+    parser.add_argument("--sleep-scale", type=float, default=0.01,
+                        help="factor applied to every waiting time of the scenario")
+    args = parser.parse_args()
+
+    # Measure the marketplace, not the log file
+    logging.disable(logging.CRITICAL)
+
+    units = None
+    print(f"{'mode':>14} {'seconds':>9} {'units/s':>10}")
+    for processes in [0] + args.processes:
+        market_config = load_config(args.scenario)
+        scale_sleeps(market_config, args.sleep_scale)
+        units = units or count_units(market_config)
+
+        if processes:
+            seconds = timed(run_shared_memory, market_config, processes)
+            mode = f"{processes} processes"
+        else:
+            seconds = timed(run_threads, market_config)
+            mode = "threads"
+        print(f"{mode:>14} {seconds:>9.2f} {units / seconds:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
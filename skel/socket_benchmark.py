@@ -0,0 +1,146 @@
+"""
+This module compares the marketplace served over a socket with the in-process one
+
+Every worker owns a producer and a cart, and repeats a cycle of three calls:
+publish a unit, add it to the cart and remove it, which puts it back. The
+cycles run on the Marketplace object itself, then through a MarketplaceClient
+on a Unix socket and on TCP, one call at a time (whose round trip latency is
+measured) and pipelined, and finally from several client processes at once.
+
+Usage: python3 socket_benchmark.py [--cycles 5000] [--batch 64] [--processes 1 2 4]
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+from multiprocessing import Process, SimpleQueue
+from statistics import median
+from time import perf_counter
+
+from tema.marketplace import Marketplace
+from tema.marketplace_server import MarketplaceClient, MarketplaceServer
+from tema.product import Tea
+
+TEA = Tea(name="Linden", price=9, type="Herbal")
+
+# Calls in a cycle
+CYCLE = 3
+
+
+def run_cycles(marketplace, cycles):
+    """
+    Runs the cycles one call at a time.
+
+    returns the latencies of the calls, in seconds
+    """
+    producer_id = marketplace.register_producer()
+    cart_id = marketplace.new_cart()
+
+    latencies = []
+    for _ in range(cycles):
+        start = perf_counter()
+        marketplace.publish_many(producer_id, TEA, 1)
+        published = perf_counter()
+        marketplace.add_to_cart(cart_id, TEA, 1)
+        added = perf_counter()
+        marketplace.remove_from_cart(cart_id, TEA, 1)
+        latencies += (published - start, added - published, perf_counter() - added)
+    return latencies
+
+
+def run_pipelined(client, cycles, batch):
+    """
+    Runs the cycles in pipelines of batch cycles each.
+    """
+    producer_id = client.register_producer()
+    cart_id = client.new_cart()
+
+    pipeline = client.pipeline()
+    for done in range(0, cycles, batch):
+        for _ in range(min(batch, cycles - done)):
+            pipeline.publish_many(producer_id, TEA, 1)
+            pipeline.add_to_cart(cart_id, TEA, 1)
+            pipeline.remove_from_cart(cart_id, TEA, 1)
+        pipeline.execute()
+
+
+def client_process(address, cycles, batch, results):
+    """
+    Runs pipelined cycles from a process of its own and reports its time.
+    """
+    client = MarketplaceClient(address, pool_size=1)
+    start = perf_counter()
+    run_pipelined(client, cycles, batch)
+    results.put(perf_counter() - start)
+    client.close()
+
+
+def report(mode, calls, seconds, latencies=None):
+    """
+    Prints a line of the table.
+    """
+    latency = f"{median(latencies) * 1e6:>12.1f}" if latencies else f"{'-':>12}"
+    print(f"{mode:>24} {calls / seconds:>12.0f} {latency}")
+
+
+def main():
+    """
+        Runs the cycles in each mode and prints a table
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cycles", type=int, default=5000,
+                        help="cycles run by each worker")
+    parser.add_argument("--batch", type=int, default=64,
+                        help="cycles per pipeline")
+    parser.add_argument("--processes", type=int, nargs='+', default=[1, 2, 4],
+                        help="numbers of client processes to measure")
+    args = parser.parse_args()
+
+    # Measure the marketplace, not the log file
+    logging.disable(logging.CRITICAL)
+
+    calls = args.cycles * CYCLE
+    print(f"{'mode':>24} {'calls/s':>12} {'median us':>12}")
+
+    start = perf_counter()
+    latencies = run_cycles(Marketplace(1), args.cycles)
+    report("in process", calls, perf_counter() - start, latencies)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for transport, address in (("unix", os.path.join(directory, "marketplace.sock")),
+                                   ("tcp", ("127.0.0.1", 0))):
+            server = MarketplaceServer(Marketplace(1), address)
+            server.start()
+            client = MarketplaceClient(server.address)
+
+            start = perf_counter()
+            latencies = run_cycles(client, args.cycles)
+            report(f"{transport}", calls, perf_counter() - start, latencies)
+
+            start = perf_counter()
+            run_pipelined(client, args.cycles, args.batch)
+            report(f"{transport} pipelined", calls, perf_counter() - start)
+
+            for processes in args.processes:
+                results = SimpleQueue()
+                workers = [Process(target=client_process,
+                                   args=(server.address, args.cycles, args.batch, results))
+                           for _ in range(processes)]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+                report(f"{transport} {processes} processes", calls * processes,
+                       max(results.get() for _ in workers))
+
+            client.close()
+            server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,3 @@
+"""
+The Marketplace homework package.
+"""
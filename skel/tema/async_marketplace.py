@@ -0,0 +1,217 @@
+"""
+This module represents the asyncio version of the Marketplace, Producer and Consumer.
+
+All the actors run as coroutines on a single event loop instead of one OS thread
+each, and asyncio.sleep replaces the time.sleep calls.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import asyncio
+import unittest
+
+from tema.consumer import Consumer
+from tema.marketplace import Marketplace
+from tema.order_sink import MemoryDestination, OrderSink
+from tema.producer import Producer
+from tema.product import Tea
+
+
+class AsyncMarketplace:
+    """
+    Coroutine interface to the Marketplace, with the same semantics.
+
+    Marketplace calls never block when timeout is 0, so they run directly on the
+    event loop: the locks are never contended by the coroutines. Blocking calls
+    (timeout != 0) would stall the loop and are not supported; the producers and
+    consumers retry with asyncio.sleep instead.
+    """
+
+    def __init__(self, queue_size_per_producer, metrics=False):
+        """
+        Constructor
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+        :type metrics: Bool
+        :param metrics: record the wrapped Marketplace's metrics
+        """
+        self.marketplace = Marketplace(queue_size_per_producer, metrics=metrics)
+
+    async def register_producer(self):
+        """
+        Returns an id for the producer that calls this.
+        """
+        return self.marketplace.register_producer()
+
+    async def publish(self, producer_id, product):
+        """
+        Adds the product provided by the producer to the marketplace.
+        See Marketplace.publish.
+        """
+        return self.marketplace.publish(producer_id, product)
+
+    async def publish_many(self, producer_id, product, quantity):
+        """
+        Adds quantity units of the product provided by the producer to the marketplace.
+        See Marketplace.publish_many.
+        """
+        return self.marketplace.publish_many(producer_id, product, quantity)
+
+    async def new_cart(self):
+        """
+        Creates a new cart for the consumer and returns its id.
+        """
+        return self.marketplace.new_cart()
+
+    async def add_to_cart(self, cart_id, product, quantity=1):
+        """
+        Adds a product to the given cart. See Marketplace.add_to_cart.
+        """
+        return self.marketplace.add_to_cart(cart_id, product, quantity)
+
+    async def remove_from_cart(self, cart_id, product, quantity=1):
+        """
+        Removes a product from cart. See Marketplace.remove_from_cart.
+        """
+        return self.marketplace.remove_from_cart(cart_id, product, quantity)
+
+    async def place_order(self, cart_id):
+        """
+        Return a list with all the products in the cart.
+        """
+        return self.marketplace.place_order(cart_id)
+
+
+class AsyncProducer:
+    """
+    Class that represents a producer running as a coroutine.
+
+    It runs the batches of a Producer (see Producer.batches) on the wrapped
+    Marketplace, whose calls never block with timeout 0, awaiting each wait.
+    """
+
+    def __init__(self, products, marketplace, republish_wait_time, name=None):
+        """
+        Constructor.
+
+        @type products: List()
+        @param products: a list of products that the producer will produce
+
+        @type marketplace: AsyncMarketplace
+        @param marketplace: a reference to the marketplace
+
+        @type republish_wait_time: Time
+        @param republish_wait_time: the number of seconds that a producer must
+        wait until the marketplace becomes available
+
+        @type name: String
+        @param name: the producer's name
+        """
+        self.marketplace = marketplace
+        self.name = name
+
+        # Never started, only its batches run
+        self.producer = Producer(products, marketplace.marketplace, republish_wait_time,
+                                 name=name)
+
+    async def run(self):
+        """
+        Registers the producer and provides its products until told otherwise.
+        """
+        producer_id = await self.marketplace.register_producer()
+
+        # Waits of 0 still give the other coroutines their turn
+        for wait_time in self.producer.batches(producer_id):
+            await asyncio.sleep(wait_time)
+
+
+class AsyncConsumer:
+    """
+    Class that represents a consumer running as a coroutine.
+
+    It runs the steps of a Consumer (see Consumer.steps) on the wrapped
+    Marketplace, awaiting each retry wait.
+    """
+
+    def __init__(self, carts, marketplace, retry_wait_time, name=None, order_sink=None):
+        """
+        Constructor.
+
+        :type carts: List
+        :param carts: a list of add and remove operations
+
+        :type marketplace: AsyncMarketplace
+        :param marketplace: a reference to the marketplace
+
+        :type retry_wait_time: Time
+        :param retry_wait_time: the number of seconds that a producer must wait
+        until the Marketplace becomes available
+
+        :type name: String
+        :param name: the consumer's name, used when printing the orders
+
+        :type order_sink: OrderSink
+        :param order_sink: where the placed orders are printed; None - the standard output
+        """
+        self.marketplace = marketplace
+        self.name = name
+
+        # Never started, only its steps run; queuing an order never blocks the event loop
+        self.consumer = Consumer(carts, marketplace.marketplace, retry_wait_time,
+                                 order_sink=order_sink, name=name)
+
+    async def run(self):
+        """
+        Fills and orders every cart, printing the bought products.
+        """
+        for wait_time in self.consumer.steps():
+            if wait_time is not None:
+                await asyncio.sleep(wait_time)
+
+
+async def run_market(producers, consumers):
+    """
+    Runs the producers and consumers on the current event loop until all
+    the consumers are done, then stops the producers.
+    """
+    producer_tasks = [asyncio.ensure_future(producer.run()) for producer in producers]
+
+    await asyncio.gather(*(consumer.run() for consumer in consumers))
+
+    for task in producer_tasks:
+        task.cancel()
+    await asyncio.gather(*producer_tasks, return_exceptions=True)
+
+
+class TestAsyncMarketplace(unittest.TestCase):
+    """
+    Class for asyncio marketplace testing purposes
+    """
+
+    def test_run_market(self):
+        """
+        Runs a producer and two consumers on one event loop
+        """
+        product = Tea(name="Linden", price=9, type="Herbal")
+        marketplace = AsyncMarketplace(2)
+
+        producer = AsyncProducer([(product, 3, 0)], marketplace, 0, name="prod1")
+        carts = [[{"type": "add", "product": product, "quantity": 4},
+                  {"type": "remove", "product": product, "quantity": 1}]]
+        destination = MemoryDestination()
+        order_sink = OrderSink(destination)
+        consumers = [AsyncConsumer(carts, marketplace, 0.001, name=f"cons{i}",
+                                   order_sink=order_sink)
+                     for i in range(2)]
+
+        # A producer with nothing to produce returns instead of spinning on the loop
+        idle = AsyncProducer([], marketplace, 0, name="prod2")
+
+        asyncio.run(run_market([producer, idle], consumers))
+        order_sink.close()
+
+        lines = sorted(destination.lines())
+        self.assertEqual(lines, [f"cons{i} bought {product}" for i in range(2) for _ in range(3)])
@@ -0,0 +1,153 @@
+"""
+This module represents the product catalog.
+
+Every distinct product is interned once and gets a dense integer id, so that the
+marketplace works with ids instead of comparing products field by field.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import pickle
+import unittest
+from threading import Lock
+
+from tema.product import Coffee, Tea
+
+
+class CatalogEntry:
+    """
+    An interned product and its id.
+    """
+    __slots__ = ("product_id", "product")
+
+    def __init__(self, product_id, product):
+        """
+        Constructor
+
+        :type product_id: Int
+        :param product_id: the product's id, its position in the catalog
+
+        :type product: Product
+        :param product: the canonical product object
+        """
+        self.product_id = product_id
+        self.product = product
+
+    def __repr__(self):
+        return f"CatalogEntry({self.product_id}, {self.product!r})"
+
+
+class ProductCatalog:
+    """
+    Interns products and gives each of them a dense integer id.
+
+    The canonical object of a product is found by identity (a dict keyed by id()),
+    which skips the dataclass __hash__/__eq__; equal but distinct objects fall
+    back to the lookup by value.
+    """
+
+    def __init__(self, products=()):
+        """
+        Constructor
+
+        :type products: List
+        :param products: products to intern upfront, in id order
+        """
+        self.lock = Lock()
+        self.entries = []
+        self.by_identity = {}
+        self.by_value = {}
+
+        for product in products:
+            self.intern(product)
+
+    def __getstate__(self):
+        """
+        The lock is not shared with the processes the catalog is sent to and
+        the object ids are only valid in this one.
+        """
+        return {"entries": self.entries, "by_value": self.by_value}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
+        self.by_identity = {id(entry.product): entry for entry in self.entries}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def intern(self, product):
+        """
+        Returns the id of the product, interning it if it is new.
+        """
+        product_id = self.find(product)
+        if product_id is not None:
+            return product_id
+
+        with self.lock:
+            entry = self.by_value.get(product)
+            if entry is None:
+                entry = CatalogEntry(len(self.entries), product)
+                self.entries.append(entry)
+                self.by_value[product] = entry
+                self.by_identity[id(product)] = entry
+
+        return entry.product_id
+
+    def find(self, product):
+        """
+        Returns the id of the product, or None if it was never interned.
+        """
+        entry = self.by_identity.get(id(product))
+        if entry is not None and entry.product is product:
+            return entry.product_id
+
+        entry = self.by_value.get(product)
+        return None if entry is None else entry.product_id
+
+    def product(self, product_id):
+        """
+        Returns the canonical product with the given id.
+        """
+        return self.entries[product_id].product
+
+    def products(self):
+        """
+        Returns the canonical products, in id order.
+        """
+        return [entry.product for entry in self.entries]
+
+
+class TestProductCatalog(unittest.TestCase):
+    """
+    Class for product catalog testing purposes
+    """
+
+    def test_intern(self):
+        """
+        Checks that products get dense ids and equal products share them
+        """
+        tea = Tea(name="Linden", price=9, type="Herbal")
+        coffee = Coffee(name="Brasil", price=7, acidity=5.09, roast_level="MEDIUM")
+        catalog = ProductCatalog([tea])
+
+        self.assertEqual(catalog.intern(tea), 0)
+        self.assertEqual(catalog.intern(coffee), 1)
+        self.assertEqual(catalog.intern(Tea(name="Linden", price=9, type="Herbal")), 0)
+        self.assertIs(catalog.product(0), tea)
+        self.assertEqual(catalog.products(), [tea, coffee])
+        self.assertEqual(len(catalog), 2)
+        self.assertIsNone(catalog.find(Tea(name="Mint", price=3, type="Herbal")))
+
+    def test_pickle(self):
+        """
+        Checks that a copy of the catalog sent to another process keeps the ids
+        """
+        tea = Tea(name="Linden", price=9, type="Herbal")
+        coffee = Coffee(name="Brasil", price=7, acidity=5.09, roast_level="MEDIUM")
+        catalog = pickle.loads(pickle.dumps(ProductCatalog([tea, coffee])))
+
+        self.assertEqual(catalog.intern(coffee), 1)
+        self.assertEqual(catalog.intern(catalog.product(0)), 0)
+        self.assertEqual(len(catalog), 2)
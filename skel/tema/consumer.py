@@ -6,21 +6,25 @@ Assignment 1
 March 2021
 """
 
-from threading import Thread, Lock
+from threading import Thread
 from time import sleep
 
+from tema.order_sink import get_order_sink
+
 
 class Consumer(Thread):
     """
     Class that represents a consumer.
     """
 
-    def __init__(self, carts, marketplace, retry_wait_time, **kwargs):
+    def __init__(self, carts, marketplace, retry_wait_time, wait_timeout=0, *,
+                 order_sink=None, clock=None, **kwargs):
         """
         Constructor.
 
-        :type carts: List
-        :param carts: a list of add and remove operations
+        :type carts: Iterable
+        :param carts: the carts, each a list of add and remove operations; any iterable,
+        the carts can be read while the consumer runs
 
         :type marketplace: Marketplace
         :param marketplace: a reference to the marketplace
@@ -29,19 +33,37 @@ class Consumer(Thread):
         :param retry_wait_time: the number of seconds that a producer must wait
         until the Marketplace becomes available
 
+        :type wait_timeout: Time
+        :param wait_timeout: if not 0, add_to_cart blocks for up to this many seconds
+        (None - until the product is available) instead of retrying after retry_wait_time
+
+        :type order_sink: OrderSink
+        :param order_sink: where the placed orders are printed; None - the standard output
+
+        :type clock: VirtualClock
+        :param clock: if given, the consumer sleeps in its virtual time instead of real time
+
         :type kwargs:
         :param kwargs: other arguments that are passed to the Thread's __init__()
         """
         self.carts = carts
         self.marketplace = marketplace
         self.retry_wait_time = retry_wait_time
+        self.wait_timeout = wait_timeout
 
-        # Lock used for mutual exclusion while printing order
-        self.print_lock = Lock()
+        # Shared by all the consumers, it writes every order whole
+        self.order_sink = order_sink if order_sink is not None else get_order_sink()
+        self.sleep = clock.sleep if clock is not None else sleep
 
         Thread.__init__(self, **kwargs)
 
-    def run(self):
+    def steps(self):
+        """
+        Runs the carts in order: a generator yielding the seconds to wait before
+        retrying a failed add, and None after each order. A consumer thread sleeps
+        the waits itself, a ConsumerEngine runs the next step on one of its workers
+        once the wait is over, going on with other consumers in between.
+        """
         # For each cart
         for cart in self.carts:
             # Add new empty cart
@@ -57,25 +79,26 @@ class Consumer(Thread):
                     # Add products to the cart
                     count = 0
                     while count != product_quantity:
-                        result = self.marketplace.add_to_cart(cart_id, product_name)
+                        count += self.marketplace.add_to_cart(cart_id, product_name,
+                                                              product_quantity - count,
+                                                              timeout=self.wait_timeout)
 
-                        # Retry adding after waiting the specified retry time
-                        if not result:
-                            sleep(self.retry_wait_time)
-                        else:
-                            count += 1
+                        # Retry adding the rest after waiting the specified retry time
+                        if count != product_quantity and self.wait_timeout == 0:
+                            yield self.retry_wait_time
 
                 elif command_type == "remove":
                     # Remove products from the cart
-                    count = 0
-                    while count != product_quantity:
-                        self.marketplace.remove_from_cart(cart_id, product_name)
-                        count += 1
+                    self.marketplace.remove_from_cart(cart_id, product_name, product_quantity)
 
             # Place order
             order = self.marketplace.place_order(cart_id)
 
             # Print order
-            with self.print_lock:
-                for product in order:
-                    print(f'{self.name} bought {str(product)}')
+            self.order_sink.submit(self.name, order)
+            yield None
+
+    def run(self):
+        for wait_time in self.steps():
+            if wait_time is not None:
+                self.sleep(wait_time)
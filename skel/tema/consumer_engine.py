@@ -0,0 +1,88 @@
+"""
+This module runs consumers as tasks on a pool of worker threads.
+
+A Consumer thread places its orders one after another, sleeping whenever a
+product is missing. The engine runs, instead, each consumer's carts as the
+steps of a task: the carts of a consumer still run in order and its orders are
+printed under its name, while tens of thousands of consumers share a few threads.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import threading
+import unittest
+
+from tema.consumer import Consumer
+from tema.marketplace import Marketplace
+from tema.order_sink import OrderSink, MemoryDestination
+from tema.producer import Producer
+from tema.product import Coffee, Tea
+from tema.task_scheduler import TaskScheduler
+
+
+class ConsumerEngine(TaskScheduler):
+    """
+    Runs the carts of any number of consumers on at most max_workers threads.
+
+    The consumers are Consumer objects that are never started. A consumer
+    blocking on a missing product (wait_timeout not 0) or on reading its next
+    cart (the carts of a .jsonl scenario, fed by a CartFeeder) holds a worker
+    while it waits, so neither runs on the engine.
+    """
+
+    def __init__(self, max_workers=4):
+        TaskScheduler.__init__(self, max_workers, name="consumer")
+
+    def add(self, consumer):
+        """
+        Schedules a consumer's first cart right away.
+
+        :type consumer: Consumer
+        :param consumer: the consumer, not started, sleep-polling
+
+        raises ValueError if the consumer blocks on the marketplace
+        """
+        if consumer.wait_timeout != 0:
+            raise ValueError("engine consumers cannot block on the marketplace")
+        self.schedule(consumer.steps())
+
+
+class TestConsumerEngine(unittest.TestCase):
+    """
+    Class for consumer engine testing purposes
+    """
+
+    def test_many_consumers(self):
+        """
+        Checks that thousands of consumers place their orders, in order, on a few threads
+        """
+        marketplace = Marketplace(50)
+        tea = Tea(name="Linden", price=9, type="Herbal")
+        coffee = Coffee(name="Brasil", price=7, acidity=5.09, roast_level="MEDIUM")
+
+        # A producer thread publishes the teas the consumers wait for
+        producer = Producer([(tea, 50, 0.0001)], marketplace, republish_wait_time=0.001,
+                            daemon=True)
+        producer.start()
+
+        destination = MemoryDestination()
+        sink = OrderSink(destination)
+        carts = [[{"type": "add", "product": tea, "quantity": 1}],
+                 [{"type": "add", "product": coffee, "quantity": 0}],
+                 [{"type": "add", "product": tea, "quantity": 2},
+                  {"type": "remove", "product": tea, "quantity": 1}]]
+
+        threads = threading.active_count()
+        engine = ConsumerEngine(max_workers=4)
+        for idx in range(2000):
+            engine.add(Consumer(carts, marketplace, retry_wait_time=0.001,
+                                order_sink=sink, name=f"cons{idx}"))
+        self.assertLessEqual(threading.active_count(), threads + 5)
+        engine.join()
+        engine.stop()
+        sink.close()
+
+        lines = destination.lines()
+        self.assertEqual(len(lines), 2000 * 2)
+        self.assertEqual(lines.count(f"cons1999 bought {tea}"), 2)
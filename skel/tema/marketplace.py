@@ -6,62 +6,153 @@ Assignment 1
 March 2021
 """
 import unittest
-from logging.handlers import RotatingFileHandler
-from threading import Lock
-import logging
-from time import gmtime
+from collections import deque
+from contextlib import contextmanager
+from itertools import chain, repeat
+from threading import Lock, Thread
+from time import sleep, time
+
+from tema.catalog import ProductCatalog
+from tema.marketplace_log import get_logger
+from tema.marketplace_metrics import MarketplaceMetrics, instrumented
+from tema.marketplace_records import CartRegistry, CartWaiter, ProducerQueues
+from tema.product import Coffee, Tea
 
 
 class Marketplace:
     """
     Class that represents the Marketplace. It's the central part of the implementation.
     The producers and consumers use its methods concurrently.
+
+    Locking scheme:
+        - registry_lock: registering producers/carts and creating product entries;
+        - producers[i].condition: the size of producer i's queue;
+        - producers.free_lock: the set of the producers whose queues have free slots;
+        - product_locks[product_id]: the index entry of that product;
+        - customer_carts[i].lock: the contents of cart i.
+
+    place_order empties the cart and frees its slot for the next new_cart, so
+    the carts held are only those open at the same time; a cart id must not be
+    used after its order is placed.
+
+    Products are interned in the catalog at the API boundary; the index, the
+    waiting queues and the carts only hold their integer ids.
+
+    Blocking publish calls wait on their producer's condition for a free slot.
+    Blocking add_to_cart calls queue up on the product in FIFO order
+    (product_waiting) and a newly published or returned unit is handed off
+    directly to the longest waiting cart, without taking a slot in the
+    producer's queue.
+
+    With metrics on, the producer, product and cart locks are TimedLocks
+    recording how long they are waited for and held (see marketplace_metrics).
+
+    Every unit in a cart remembers the producer it came from; a removed unit goes
+    back to that producer's queue, or to any producer with a free slot if that
+    queue filled up meanwhile.
+
+    Lock ordering: product lock -> registry_lock, used to drop an index entry
+    once its last unit is sold, and producer condition -> producers.free_lock,
+    whose holder takes no other lock. No other method holds two locks at the
+    same time, so no deadlock is possible. Operations that touch
+    several structures take the locks one after another: a queue slot is
+    reserved (or released) under the producer's lock and the unit is then
+    published to (or taken from) the index under the product's lock. Publishing
+    producers and carts buying different products never contend.
     """
 
-    def __init__(self, queue_size_per_producer):
+    def __init__(self, queue_size_per_producer, catalog=None, metrics=False, journal=None):
         """
         Constructor
 
         :type queue_size_per_producer: Int
         :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+        :type catalog: ProductCatalog
+        :param catalog: the catalog the products are interned in, a new one by default
+
+        :type metrics: Bool
+        :param metrics: record the metrics returned by snapshot(); when off (the default)
+        they cost nothing, the methods and the locks are not instrumented
+
+        :type journal: OrderJournal
+        :param journal: if given, place_order appends every order to it
         """
-        # Locks used for thread synchro
-        self.producer_lock = Lock()
-        self.customer_lock = Lock()
+        # Lock used when registering producers, carts and products
+        self.registry_lock = Lock()
+
+        # Number of products currently queued by each producer & their conditions
+        self.producers = ProducerQueues(queue_size_per_producer)
 
-        self.queue_size_per_producer = queue_size_per_producer
+        # Products and their integer ids
+        self.catalog = catalog if catalog is not None else ProductCatalog()
 
-        # Two-dimensional arrays containing producers/carts & their products
-        self.producer_list = []
-        self.customer_carts = []
+        # Inventory index: product id -> {producer index: number of units held}
+        self.product_index = {}
+        self.product_locks = {}
 
-        # Logging mechanism configuration
-        logging.basicConfig(handlers=[RotatingFileHandler(
-            'marketplace.log', maxBytes=100000, backupCount=10)],
-                            level=logging.INFO,
-                            format='[%(asctime)s] %(levelname)s %(message)s',
-                            datefmt='%Y-%m-%dT %H:%M:%S')
-        logging.Formatter.converter = gmtime
-        self.logger = logging.getLogger()
+        # FIFO queues of add_to_cart calls blocked on each product id
+        self.product_waiting = {}
+
+        # Carts, each with its product ids and its lock
+        self.customer_carts = CartRegistry()
+
+        # Logging goes through a queue to a background writer (see marketplace_log)
+        self.logger = get_logger()
+
+        # Call counts, latencies and lock times, None when turned off
+        self.metrics = MarketplaceMetrics() if metrics else None
+
+        # The orders are journaled with the catalog's product ids
+        self.journal = journal
+        if journal is not None:
+            journal.attach(self.catalog)
 
         # Log marketplace initialization
         self.logger.info("Marketplace constructor: queue_size_per_producer - %s",
                          queue_size_per_producer)
 
+    @property
+    def queue_size_per_producer(self):
+        """
+        The maximum size of a queue associated with each producer.
+        """
+        return self.producers.capacity
+
+    def _new_lock(self, kind):
+        """
+        Returns a new lock, timed under the given kind if metrics are on.
+        """
+        if self.metrics is None:
+            return Lock()
+        return self.metrics.timed_lock(kind)
+
+    def snapshot(self):
+        """
+        Returns the marketplace's metrics (see MarketplaceMetrics.snapshot), empty if
+        they are turned off, and the occupancy of the producers' queues.
+        """
+        snapshot = self.metrics.snapshot() if self.metrics is not None else {}
+        snapshot["queues"] = {"capacity": self.queue_size_per_producer,
+                              "sizes": [producer.size for producer in self.producers]}
+        return snapshot
+
+    @instrumented
     def register_producer(self):
         """
         Returns an id for the producer that calls this.
         """
-        self.logger.info("register_producer - returns id %d", len(self.producer_list))
-
         # Add new producer to the list
-        with self.producer_lock:
-            self.producer_list.append([])
+        with self.registry_lock:
+            # The producer's id will be the list's length
+            producer_id = self.producers.register(self._new_lock("producer"))
+
+        self.logger.info("register_producer - returns id %d", producer_id)
 
-        # The producer's id will be the list's length - 1
-        return len(self.producer_list)
+        return producer_id
 
-    def publish(self, producer_id, product):
+    @instrumented(outcome=True)
+    def publish(self, producer_id, product, timeout=0):
         """
         Adds the product provided by the producer to the marketplace
 
@@ -71,37 +162,240 @@ class Marketplace:
         :type product: Product
         :param product: the Product that will be published in the Marketplace
 
+        :type timeout: Float
+        :param timeout: seconds to wait for a free slot in the producer's queue;
+        0 returns immediately, None waits until a slot frees up
+
         returns True or False. If the caller receives False, it should wait and then try again.
         """
         self.logger.info("publish - producer %d adds product %s", producer_id, product)
 
-        # Adjust index
-        producer_id -= 1
+        return self._publish(producer_id - 1, self.catalog.intern(product), 1, timeout) == 1
 
-        # Ensure mutex between threads
-        with self.producer_lock:
-            if self.queue_size_per_producer > len(self.producer_list[producer_id]):
-                self.producer_list[producer_id].append(product)
-                return True
+    @instrumented(outcome=True)
+    def publish_many(self, producer_id, product, quantity, timeout=0):
+        """
+        Adds quantity units of the product provided by the producer to the marketplace
 
-        return False
+        :type producer_id: String
+        :param producer_id: producer id
+
+        :type product: Product
+        :param product: the Product that will be published in the Marketplace
+
+        :type quantity: Int
+        :param quantity: the number of units to publish
+
+        :type timeout: Float
+        :param timeout: seconds to wait for at least a free slot in the producer's queue;
+        0 returns immediately, None waits until a slot frees up
+
+        returns the number of units published, less than quantity if the queue filled up
+        """
+        self.logger.info("publish_many - producer %d adds %d x product %s",
+                         producer_id, quantity, product)
+
+        return self._publish(producer_id - 1, self.catalog.intern(product), quantity, timeout)
+
+    def _publish(self, producer_idx, product_id, quantity, timeout):
+        """
+        Publishes up to quantity units, taking each lock once for the whole batch.
 
+        returns the number of units published
+        """
+        # Carts already waiting for the product get their units without slots
+        published = self._hand_off(producer_idx, product_id, quantity)
+        if published == quantity:
+            return published
+
+        # Reserve slots in the producer's queue
+        reserved = self.producers[producer_idx].reserve(quantity - published, timeout)
+
+        handed_off = self._add_stock(producer_idx, product_id, reserved)
+        if handed_off:
+            # Handed off to carts that started waiting meanwhile
+            self._release_slots(producer_idx, handed_off)
+
+        return published + reserved
+
+    @contextmanager
+    def _locked_entry(self, product_id):
+        """
+        Acquires the product's lock and yields its index entry, creating it if needed.
+        """
+        while True:
+            holders = self.product_index.get(product_id)
+            if holders is None:
+                # Create the product's entry
+                with self.registry_lock:
+                    if product_id not in self.product_index:
+                        self.product_locks[product_id] = self._new_lock("product")
+                        self.product_index[product_id] = {}
+                    holders = self.product_index[product_id]
+
+            with self.product_locks.get(product_id, self.registry_lock):
+                # Retry if the entry was dropped after we looked it up
+                if self.product_index.get(product_id) is holders:
+                    yield holders
+                    return
+
+    def _drop_unused(self, product_id, holders):
+        """
+        Drops the product's entry if it is out of stock and nobody waits for it,
+        so the index only holds the products in stock. Called with the product's lock held.
+        """
+        if not holders and product_id not in self.product_waiting:
+            with self.registry_lock:
+                del self.product_index[product_id]
+                del self.product_locks[product_id]
+
+    def _pop_waiters(self, product_id, producer_idx, units):
+        """
+        Hands up to units of the producer off to the longest waiting carts, in order.
+        Called with the product's lock held.
+
+        returns the number of units the carts received
+        """
+        waiters = self.product_waiting.get(product_id)
+        if not waiters:
+            return 0
+
+        handed_off = 0
+        while waiters and handed_off < units:
+            waiter = waiters[0]
+            handed_off += waiter.hand_off(producer_idx, units - handed_off)
+            if waiter.received_count == waiter.wanted:
+                waiters.popleft()
+
+        if not waiters:
+            del self.product_waiting[product_id]
+
+        return handed_off
+
+    def _hand_off(self, producer_idx, product_id, units):
+        """
+        Hands up to units of the producer off to the longest waiting carts,
+        without reserving slots in the producer's queue.
+
+        returns the number of units the carts received
+        """
+        # Cheap check first, the common case is that nobody waits
+        if product_id not in self.product_waiting:
+            return 0
+
+        with self._locked_entry(product_id) as holders:
+            handed_off = self._pop_waiters(product_id, producer_idx, units)
+            self._drop_unused(product_id, holders)
+
+        return handed_off
+
+    def _add_stock(self, producer_idx, product_id, units):
+        """
+        Records units of product held by the producer in the index, after handing
+        off what the waiting carts need. The units' queue slots must already be reserved.
+
+        returns the number of units handed off, whose slots can be released
+        """
+        if not units:
+            return 0
+
+        with self._locked_entry(product_id) as holders:
+            handed_off = self._pop_waiters(product_id, producer_idx, units)
+            if units > handed_off:
+                holders[producer_idx] = holders.get(producer_idx, 0) + units - handed_off
+            else:
+                self._drop_unused(product_id, holders)
+
+        return handed_off
+
+    def _release_slots(self, producer_idx, units):
+        """
+        Frees slots in the producer's queue and wakes up the producer if it waits for one.
+        """
+        self.producers[producer_idx].release(units)
+
+    def _take_stock(self, product_id, quantity, timeout=0):
+        """
+        Removes up to quantity units of product from the producers holding it and
+        frees their slots in the producers' queues. Each producer costs O(1).
+
+        :type timeout: Float
+        :param timeout: seconds to wait for the missing units to be published;
+        0 returns immediately, None waits until all units are handed off
+
+        returns a dict: producer index -> number of units taken from it
+        """
+        # A miss must not create an entry for a product that was never in stock
+        if timeout == 0 and product_id not in self.product_index:
+            return {}
+
+        taken = {}
+        with self._locked_entry(product_id) as holders:
+            missing = quantity
+            while holders and missing:
+                # Any producer holding the product will do
+                producer_idx = next(iter(holders))
+                units = min(missing, holders[producer_idx])
+                if holders[producer_idx] == units:
+                    del holders[producer_idx]
+                else:
+                    holders[producer_idx] -= units
+
+                taken[producer_idx] = units
+                missing -= units
+
+            if missing and timeout != 0:
+                handed_off = self._wait_hand_off(product_id, holders, missing, timeout)
+            else:
+                handed_off = {}
+                self._drop_unused(product_id, holders)
+
+        for producer_idx, units in taken.items():
+            self._release_slots(producer_idx, units)
+
+        # Handed off units never took slots
+        for producer_idx, units in handed_off.items():
+            taken[producer_idx] = taken.get(producer_idx, 0) + units
+
+        return taken
+
+    def _wait_hand_off(self, product_id, holders, units, timeout):
+        """
+        Queues the caller behind the carts already waiting for the product and waits
+        until the units are handed off. Called with the product's lock held.
+
+        returns a dict: producer index -> number of units handed off, partial on timeout
+        """
+        waiter = CartWaiter(self.product_locks[product_id], units)
+        self.product_waiting.setdefault(product_id, deque()).append(waiter)
+
+        if not waiter.wait(timeout):
+            # Timed out, leave the queue
+            waiters = self.product_waiting[product_id]
+            waiters.remove(waiter)
+            if not waiters:
+                del self.product_waiting[product_id]
+            self._drop_unused(product_id, holders)
+
+        return waiter.received
+
+    @instrumented
     def new_cart(self):
         """
         Creates a new cart for the consumer
 
         returns an int representing the cart_id
         """
-        self.logger.info("new_cart - returns id of new cart %d", len(self.customer_carts))
+        with self.registry_lock:
+            # Add new empty cart
+            cart_id = self.customer_carts.open(lambda: self._new_lock("cart"))
 
-        # Ensure mutex between threads
-        with self.customer_lock:
-            # Add new empty product list for new producer
-            self.customer_carts.append([])
+        self.logger.info("new_cart - returns id of new cart %d", cart_id)
 
-        return len(self.customer_carts)
+        return cart_id
 
-    def add_to_cart(self, cart_id, product):
+    @instrumented(outcome=True)
+    def add_to_cart(self, cart_id, product, quantity=1, timeout=0):
         """
         Adds a product to the given cart. The method returns
 
@@ -111,27 +405,46 @@ class Marketplace:
         :type product: Product
         :param product: the product to add to cart
 
-        returns True or False. If the caller receives False, it should wait and then try again
+        :type quantity: Int
+        :param quantity: the number of units to add
+
+        :type timeout: Float
+        :param timeout: seconds to wait for the missing units to be published;
+        0 returns immediately, None waits until all of them are available
+
+        returns the number of units added (for a single unit it acts as True or False).
+        If the caller receives less than quantity, it should wait and then try again
         """
-        self.logger.info("add_to_cart - adds %s to cart %d",
-                         product, cart_id)
+        self.logger.info("add_to_cart - adds %d x %s to cart %d",
+                         quantity, product, cart_id)
 
         # Adjust index
         cart_id -= 1
 
-        # Ensure mutex between threads
-        with self.customer_lock:
-            # Search for the product in all the product lists
-            for producer_product_list in self.producer_list:
-                # If found, add the product to cart and remove it from stock
-                if product in producer_product_list:
-                    self.customer_carts[cart_id].append(product)
-                    producer_product_list.remove(product)
-                    return True
-
-        return False
-
-    def remove_from_cart(self, cart_id, product):
+        # A product never published has no stock to wait for yet
+        product_id = self.catalog.find(product)
+        if product_id is None:
+            if timeout == 0:
+                return 0
+            product_id = self.catalog.intern(product)
+
+        # Look the product up in the inventory index and reserve the units
+        taken = self._take_stock(product_id, quantity, timeout)
+        if not taken:
+            return 0
+
+        try:
+            self.customer_carts[cart_id].add(product_id, taken)
+        except ValueError:
+            # An ordered cart gets nothing, the units go back on sale
+            self._put_back(product_id, taken)
+            raise
+        added = sum(taken.values())
+
+        return added
+
+    @instrumented
+    def remove_from_cart(self, cart_id, product, quantity=1):
         """
         Removes a product from cart.
 
@@ -140,41 +453,92 @@ class Marketplace:
 
         :type product: Product
         :param product: the product to remove from cart
+
+        :type quantity: Int
+        :param quantity: the number of units to remove
+
+        returns the number of units removed, less than quantity if the cart held fewer
         """
-        self.logger.info("remove_from_cart - product %s is removed from cart %d",
-                         product, cart_id)
+        self.logger.info("remove_from_cart - %d x product %s is removed from cart %d",
+                         quantity, product, cart_id)
 
         # Adjust index
         cart_id -= 1
 
-        # Ensure mutex between threads
-        with self.customer_lock:
-            # Remove product from cart
-            self.customer_carts[cart_id].remove(product)
+        # A product in the cart was interned when it was added
+        product_id = self.catalog.find(product)
+        if product_id is None:
+            return 0
+
+        # Remove product from cart
+        removed = self.customer_carts[cart_id].remove(product_id, quantity)
+        self._put_back(product_id, removed)
 
-            # Check if the removed product can be added back to the producer's list
-            idx = 0
-            while idx < len(self.producer_list):
-                if self.queue_size_per_producer > len(self.producer_list[idx]):
-                    # Add the product back to the producer's list
-                    self.producer_list[idx].append(product)
-                    return True
-                idx += 1
+        return sum(removed.values())
 
-        return False
+    def _put_back(self, product_id, units_by_producer):
+        """
+        Puts units of the product taken out of a cart back on sale.
+
+        :type units_by_producer: Dict
+        :param units_by_producer: producer index -> number of units that came from it
+        """
+        for producer_idx, units in units_by_producer.items():
+            # Carts waiting for the product get the units first
+            handed_off = self._hand_off(producer_idx, product_id, units)
+            if units > handed_off:
+                self._return_stock(producer_idx, product_id, units - handed_off)
 
+    def _return_stock(self, producer_idx, product_id, units):
+        """
+        Puts units removed from a cart back in the queue of the producer they
+        came from or, if it filled up meanwhile, of producers with free slots.
+        Units that find no free slot are dropped.
+        """
+        for _ in range(len(self.producers) + 1):
+            reserved = self.producers[producer_idx].reserve(units)
+            if reserved:
+                handed_off = self._add_stock(producer_idx, product_id, reserved)
+                if handed_off:
+                    self._release_slots(producer_idx, handed_off)
+
+                units -= reserved
+                if not units:
+                    return
+
+            # Each miss means that producer's queue just filled up
+            producer_idx = self.producers.pick_free()
+            if producer_idx is None:
+                return
+
+    @instrumented
     def place_order(self, cart_id):
         """
-        Return a list with all the products in the cart.
+        Return a tuple with all the products in the cart, and free the cart's slot.
 
         :type cart_id: Int
         :param cart_id: id cart
+
+        raises ValueError if the cart's order was already placed
         """
         self.logger.info("place_order - cart %d was ordered", cart_id)
 
         # Adjust index
         cart_id -= 1
-        return self.customer_carts[cart_id]
+        cart = self.customer_carts[cart_id]
+        quantities = cart.take()
+        cart_number = cart.number
+
+        # The slot is reused by the next cart
+        with self.registry_lock:
+            self.customer_carts.release(cart_id)
+
+        if self.journal is not None:
+            self.journal.append(cart_number, quantities)
+
+        # The only place the cart is expanded unit by unit
+        return tuple(chain.from_iterable(repeat(self.catalog.product(product_id), units)
+                                         for product_id, units in quantities.items()))
 
 
 class TestMarketplace(unittest.TestCase):
@@ -184,10 +548,50 @@ class TestMarketplace(unittest.TestCase):
 
     def setUp(self):
         """
-        Initialize marketplace
+        Initialize marketplace and the products used by the tests
         """
         self.marketplace = Marketplace(5)
 
+        # The products module is only needed by the tests
+        self.product_1 = Coffee(name="Brasil", price=7, acidity=5.09, roast_level="MEDIUM")
+        self.product_2 = Tea(name="Wild Cherry", price=5, type="Black")
+        self.product_3 = Coffee(name="Indonezia", price=1, acidity=5.05,
+                                        roast_level="MEDIUM")
+
+    def product_id(self, product):
+        """
+        Returns the id the marketplace gave the product
+        """
+        return self.marketplace.catalog.intern(product)
+
+    def sizes(self):
+        """
+        Returns the number of units queued by each producer
+        """
+        return [producer.size for producer in self.marketplace.producers]
+
+    def stock(self, product):
+        """
+        Returns the index entry of the product: producer index -> number of units held
+        """
+        return self.marketplace.product_index[self.product_id(product)]
+
+    def publish_all(self, producer_id):
+        """
+        Publishes the 3 test products on behalf of the given producer
+        """
+        self.marketplace.publish(producer_id, self.product_1)
+        self.marketplace.publish(producer_id, self.product_2)
+        self.marketplace.publish(producer_id, self.product_3)
+
+    def add_all(self, cart_id):
+        """
+        Adds the 3 test products to the given cart
+        """
+        self.marketplace.add_to_cart(cart_id, self.product_1)
+        self.marketplace.add_to_cart(cart_id, self.product_2)
+        self.marketplace.add_to_cart(cart_id, self.product_3)
+
     def test_register_producer(self):
         """
         Tests the register_producer method
@@ -202,39 +606,27 @@ class TestMarketplace(unittest.TestCase):
         """
         # Add first producer
         producer_id = self.marketplace.register_producer()
-        producer_id -= 1
-        # Initialize 3 products
-        product_1 = {
-            "product_type": "Coffee",
-            "name": "Brasil",
-            "acidity": 5.09,
-            "roast_level": "MEDIUM",
-            "price": 7
-        }
-
-        product_2 = {
-            "product_type": "Tea",
-            "name": "Wild Cherry",
-            "type": "Black",
-            "price": 5
-        }
-
-        product_3 = {
-            "product_type": "Coffee",
-            "name": "Indonezia",
-            "acidity": 5.05,
-            "roast_level": "MEDIUM",
-            "price": 1
-        }
 
         # Publish all 3 products
-        self.marketplace.publish(producer_id, product_1)
-        self.marketplace.publish(producer_id, product_2)
-        self.marketplace.publish(producer_id, product_3)
+        self.publish_all(producer_id)
+
+        for product in [self.product_1, self.product_2, self.product_3]:
+            self.assertEqual(self.stock(product), {producer_id - 1: 1},
+                             "Product publishing failed")
+        self.assertEqual(self.sizes()[producer_id - 1], 3,
+                         "Producer queue size not updated")
 
-        self.assertEqual(
-            self.marketplace.producer_list[producer_id], [product_1, product_2, product_3],
-            "Product publishing failed")
+    def test_publish_full_queue(self):
+        """
+        Tests that publish fails once the producer's queue is full
+        """
+        producer_id = self.marketplace.register_producer()
+
+        for _ in range(5):
+            self.assertTrue(self.marketplace.publish(producer_id, self.product_1))
+        self.assertFalse(self.marketplace.publish(producer_id, self.product_1),
+                         "Publish should fail on a full queue")
+        self.assertEqual(self.stock(self.product_1), {producer_id - 1: 5})
 
     def test_new_cart(self):
         """
@@ -248,161 +640,339 @@ class TestMarketplace(unittest.TestCase):
         """
         Method to check add_to_cart from Marketplace
         """
-        # Add first producer
+        # Add first producer and publish all 3 products
         producer_id = self.marketplace.register_producer()
-        producer_id -= 1
-
-        # Initialize 3 products
-        product_1 = {
-            "product_type": "Coffee",
-            "name": "Brasil",
-            "acidity": 5.09,
-            "roast_level": "MEDIUM",
-            "price": 7
-        }
-
-        product_2 = {
-            "product_type": "Tea",
-            "name": "Wild Cherry",
-            "type": "Black",
-            "price": 5
-        }
-
-        product_3 = {
-            "product_type": "Coffee",
-            "name": "Indonezia",
-            "acidity": 5.05,
-            "roast_level": "MEDIUM",
-            "price": 1
-        }
+        self.publish_all(producer_id)
 
-        # Publish all 3 products
-        self.marketplace.publish(producer_id, product_1)
-        self.marketplace.publish(producer_id, product_2)
-        self.marketplace.publish(producer_id, product_3)
-
-        # Add first cart
+        # Add first cart and all products to it
         cart_id = self.marketplace.new_cart()
-
-        # Add all products to cart
-        self.marketplace.add_to_cart(cart_id, product_1)
-        self.marketplace.add_to_cart(cart_id, product_2)
-        self.marketplace.add_to_cart(cart_id, product_3)
+        self.add_all(cart_id)
 
         # Check if all products were added successfully
-        self.assertEqual(self.marketplace.customer_carts[cart_id - 1], [
-            product_1, product_2, product_3], "Missing expected products from cart")
+        self.assertEqual(self.marketplace.place_order(cart_id), (
+            self.product_1, self.product_2, self.product_3), "Missing expected products from cart")
 
         # Check if all products were removed from the stock
-        self.assertNotIn(product_1, self.marketplace.producer_list[producer_id],
+        self.assertNotIn(self.product_id(self.product_1), self.marketplace.product_index,
                          "Product 1 not removed from stock")
-        self.assertNotIn(product_2, self.marketplace.producer_list[producer_id],
+        self.assertNotIn(self.product_id(self.product_2), self.marketplace.product_index,
                          "Product 2 not removed from stock")
-        self.assertNotIn(product_3, self.marketplace.producer_list[producer_id],
+        self.assertNotIn(self.product_id(self.product_3), self.marketplace.product_index,
                          "Product 3 not removed from stock")
+        self.assertEqual(self.sizes()[producer_id - 1], 0)
 
-    def test_remove_from_cart(self):
+        # Nothing left to buy and a miss does not grow the index
+        self.assertFalse(self.marketplace.add_to_cart(cart_id, self.product_1),
+                         "Adding an out of stock product should fail")
+        self.assertEqual(self.marketplace.product_index, {}, "Index kept an empty entry")
+        self.assertEqual(self.marketplace.product_locks, {}, "Index kept an unused lock")
+
+    def test_add_to_cart_multiple_producers(self):
         """
-        Checks the remove_from_cart method
+        Checks that add_to_cart takes stock from whichever producer holds it
+        """
+        producer_1 = self.marketplace.register_producer()
+        producer_2 = self.marketplace.register_producer()
+        self.marketplace.publish(producer_1, self.product_1)
+        self.marketplace.publish(producer_2, self.product_2)
+        self.marketplace.publish(producer_2, self.product_1)
+
+        cart_id = self.marketplace.new_cart()
+        self.assertTrue(self.marketplace.add_to_cart(cart_id, self.product_1))
+        self.assertTrue(self.marketplace.add_to_cart(cart_id, self.product_1))
+        self.assertFalse(self.marketplace.add_to_cart(cart_id, self.product_1))
+
+        self.assertEqual(self.sizes(), [0, 1])
+        self.assertEqual(self.marketplace.product_index,
+                         {self.product_id(self.product_2): {producer_2 - 1: 1}})
+
+    def test_add_to_cart_blocking(self):
+        """
+        Checks that a blocking add_to_cart wakes up when the product is published
         """
-        # Add first producer
         producer_id = self.marketplace.register_producer()
-        producer_id -= 1
-
-        # Initialize 3 products
-        product_1 = {
-            "product_type": "Coffee",
-            "name": "Brasil",
-            "acidity": 5.09,
-            "roast_level": "MEDIUM",
-            "price": 7
-        }
-
-        product_2 = {
-            "product_type": "Tea",
-            "name": "Wild Cherry",
-            "type": "Black",
-            "price": 5
-        }
-
-        product_3 = {
-            "product_type": "Coffee",
-            "name": "Indonezia",
-            "acidity": 5.05,
-            "roast_level": "MEDIUM",
-            "price": 1
-        }
+        cart_id = self.marketplace.new_cart()
 
-        # Publish all 3 products
-        self.marketplace.publish(producer_id, product_1)
-        self.marketplace.publish(producer_id, product_2)
-        self.marketplace.publish(producer_id, product_3)
+        publisher = Thread(target=lambda: (sleep(0.05),
+                                           self.marketplace.publish(producer_id, self.product_1)))
+        publisher.start()
+        self.assertTrue(self.marketplace.add_to_cart(cart_id, self.product_1, timeout=5),
+                        "Blocking add_to_cart missed the published product")
+        publisher.join()
+
+        # Time out when nothing is published, without leaving the entry behind
+        self.assertFalse(self.marketplace.add_to_cart(cart_id, self.product_1, timeout=0.01))
+        self.assertNotIn(self.product_id(self.product_1), self.marketplace.product_index)
+        self.assertEqual(self.marketplace.product_waiting, {})
 
-        # Add first cart
+    def test_hand_off_fifo(self):
+        """
+        Checks that published units go straight to the longest waiting carts, in order
+        """
+        producer_id = self.marketplace.register_producer()
+        cart_ids = [self.marketplace.new_cart() for _ in range(3)]
+
+        def wait_for_product(cart_id):
+            self.marketplace.add_to_cart(cart_id, self.product_1, timeout=5)
+
+        waiters = []
+        for cart_id in cart_ids:
+            waiter = Thread(target=wait_for_product, args=(cart_id,))
+            waiter.start()
+            waiters.append(waiter)
+
+            # Make sure the carts queue up in order
+            product_id = self.product_id(self.product_1)
+            while len(self.marketplace.product_waiting.get(product_id, ())) < len(waiters):
+                sleep(0.001)
+
+        # Two units go to the first two carts, without taking slots in the queue
+        self.assertTrue(self.marketplace.publish(producer_id, self.product_1))
+        self.assertTrue(self.marketplace.publish(producer_id, self.product_1))
+        waiters[0].join()
+        waiters[1].join()
+        self.assertEqual(self.sizes()[producer_id - 1], 0)
+        self.assertEqual(self.marketplace.place_order(cart_ids[0]), (self.product_1,))
+        self.assertEqual(self.marketplace.place_order(cart_ids[1]), (self.product_1,))
+        self.assertEqual(self.marketplace.customer_carts[cart_ids[2] - 1].snapshot(), {})
+
+        self.marketplace.publish(producer_id, self.product_1)
+        waiters[2].join()
+        self.assertEqual(self.marketplace.place_order(cart_ids[2]), (self.product_1,))
+        self.assertNotIn(self.product_id(self.product_1), self.marketplace.product_index)
+
+    def test_publish_blocking(self):
+        """
+        Checks that a blocking publish waits for a slot in the producer's queue
+        """
+        producer_id = self.marketplace.register_producer()
         cart_id = self.marketplace.new_cart()
-        cart_id -= 1
+        for _ in range(5):
+            self.marketplace.publish(producer_id, self.product_1)
+
+        self.assertFalse(self.marketplace.publish(producer_id, self.product_2, timeout=0.01),
+                         "Publish should time out on a full queue")
 
-        # Add all products to cart
-        self.marketplace.add_to_cart(cart_id, product_1)
-        self.marketplace.add_to_cart(cart_id, product_2)
-        self.marketplace.add_to_cart(cart_id, product_3)
+        buyer = Thread(target=lambda: (sleep(0.05),
+                                       self.marketplace.add_to_cart(cart_id, self.product_1)))
+        buyer.start()
+        self.assertTrue(self.marketplace.publish(producer_id, self.product_2, timeout=5),
+                        "Blocking publish missed the freed slot")
+        buyer.join()
+        self.assertEqual(self.sizes()[producer_id - 1], 5)
+
+    def test_batches(self):
+        """
+        Checks publish_many and the quantity of add_to_cart/remove_from_cart, with partial fills
+        """
+        producer_id = self.marketplace.register_producer()
+        cart_id = self.marketplace.new_cart()
+
+        # Only 5 units fit in the queue
+        self.assertEqual(self.marketplace.publish_many(producer_id, self.product_1, 7), 5)
+        self.assertEqual(self.stock(self.product_1), {producer_id - 1: 5})
+
+        self.assertEqual(self.marketplace.add_to_cart(cart_id, self.product_1, 3), 3)
+        self.assertEqual(self.marketplace.add_to_cart(cart_id, self.product_1, 4), 2)
+        self.assertEqual(self.marketplace.add_to_cart(cart_id, self.product_1, 1), 0)
+        self.assertEqual(self.sizes()[producer_id - 1], 0)
+
+        # Only 5 units are in the cart
+        self.assertEqual(self.marketplace.remove_from_cart(cart_id, self.product_1, 6), 5)
+        self.assertEqual(self.marketplace.place_order(cart_id), ())
+        self.assertEqual(self.stock(self.product_1), {producer_id - 1: 5})
+
+    def test_add_to_cart_blocking_quantity(self):
+        """
+        Checks that a blocking add_to_cart collects its units from several publishes
+        """
+        producer_id = self.marketplace.register_producer()
+        cart_id = self.marketplace.new_cart()
+        self.marketplace.publish(producer_id, self.product_1)
+
+        def publish_later():
+            sleep(0.05)
+            self.marketplace.publish_many(producer_id, self.product_1, 4)
+
+        publisher = Thread(target=publish_later)
+        publisher.start()
+        self.assertEqual(self.marketplace.add_to_cart(cart_id, self.product_1, 3, timeout=5), 3)
+        publisher.join()
+
+        # The 2 extra units went to the producer's queue
+        self.assertEqual(self.stock(self.product_1), {producer_id - 1: 2})
+        self.assertEqual(self.sizes()[producer_id - 1], 2)
+
+        # Partial fill on timeout
+        self.assertEqual(self.marketplace.add_to_cart(cart_id, self.product_1, 4, timeout=0.01), 2)
+        self.assertEqual(len(self.marketplace.place_order(cart_id)), 5)
+
+    def test_remove_from_cart(self):
+        """
+        Checks the remove_from_cart method
+        """
+        # Add first producer and publish all 3 products
+        producer_id = self.marketplace.register_producer()
+        self.publish_all(producer_id)
+
+        # Add first cart and all products to it
+        cart_id = self.marketplace.new_cart()
+        self.add_all(cart_id)
 
         # Remove product 1
-        self.marketplace.remove_from_cart(cart_id, product_1)
+        self.marketplace.remove_from_cart(cart_id, self.product_1)
 
         # Check if product is still in cart
-        self.assertNotIn(product_1, self.marketplace.customer_carts[cart_id],
+        self.assertNotIn(self.product_1, self.marketplace.place_order(cart_id),
                          "Remove from cart failed")
 
         # check for removing from producer
-        self.assertIn(product_1, self.marketplace.producer_list[producer_id],
-                      "Product not re-added to stock")
+        self.assertEqual(self.stock(self.product_1), {producer_id - 1: 1},
+                         "Product not re-added to stock")
 
     def test_place_order(self):
         """
         Checks place_order method
         """
-        # Add first producer
+        # Add first producer and publish all 3 products
         producer_id = self.marketplace.register_producer()
+        self.publish_all(producer_id)
 
-        # Initialize 3 products
-        product_1 = {
-            "product_type": "Coffee",
-            "name": "Brasil",
-            "acidity": 5.09,
-            "roast_level": "MEDIUM",
-            "price": 7
-        }
-
-        product_2 = {
-            "product_type": "Tea",
-            "name": "Wild Cherry",
-            "type": "Black",
-            "price": 5
-        }
-
-        product_3 = {
-            "product_type": "Coffee",
-            "name": "Indonezia",
-            "acidity": 5.05,
-            "roast_level": "MEDIUM",
-            "price": 1
-        }
-
-        # Publish all 3 products
-        self.marketplace.publish(producer_id, product_1)
-        self.marketplace.publish(producer_id, product_2)
-        self.marketplace.publish(producer_id, product_3)
-
-        # Add first cart
+        # Add first cart and all products to it
         cart_id = self.marketplace.new_cart()
-
-        # Add all products to cart
-        self.marketplace.add_to_cart(cart_id, product_1)
-        self.marketplace.add_to_cart(cart_id, product_2)
-        self.marketplace.add_to_cart(cart_id, product_3)
+        self.add_all(cart_id)
 
         # Place order
         order = self.marketplace.place_order(cart_id)
 
-        self.assertEqual(order, [product_1, product_2, product_3], "Order method failed")
+        self.assertEqual(order, (self.product_1, self.product_2, self.product_3),
+                         "Order method failed")
+
+        # The cart's slot goes to the next cart, the order can only be placed once
+        self.assertRaises(ValueError, self.marketplace.place_order, cart_id)
+
+        # An ordered cart takes no units, they stay on sale
+        self.marketplace.publish(producer_id, self.product_1)
+        self.assertRaises(ValueError, self.marketplace.add_to_cart, cart_id, self.product_1)
+        self.assertRaises(ValueError, self.marketplace.remove_from_cart, cart_id, self.product_1)
+        self.assertEqual(self.stock(self.product_1), {producer_id - 1: 1})
+
+        self.assertEqual(self.marketplace.new_cart(), cart_id)
+        self.assertEqual(self.marketplace.place_order(cart_id), ())
+        self.assertEqual(len(self.marketplace.customer_carts), 1)
+
+    def test_concurrent_operations(self):
+        """
+        Checks that no unit is lost or duplicated under concurrent publish/add/remove
+        """
+        # Large queues, so that removed units always find their way back to stock
+        self.marketplace = Marketplace(1000)
+        producer_ids = [self.marketplace.register_producer() for _ in range(4)]
+        products = [self.product_1, self.product_2, self.product_3]
+        deadline = time() + 10
+        bought = []
+        stuck = []
+
+        def retry(operation, *args):
+            # Bounded retry, so that a lost unit fails the test instead of hanging it
+            while not operation(*args):
+                if time() > deadline:
+                    stuck.append(args)
+                    return False
+                sleep(0)
+            return True
+
+        def produce(producer_id):
+            for i in range(300):
+                if not retry(self.marketplace.publish, producer_id, products[i % 3]):
+                    return
+
+        def consume():
+            cart_id = self.marketplace.new_cart()
+            for i in range(300):
+                if not retry(self.marketplace.add_to_cart, cart_id, products[i % 3]):
+                    return
+                if i % 4 == 0:
+                    self.marketplace.remove_from_cart(cart_id, products[i % 3])
+            bought.append(self.marketplace.place_order(cart_id))
+
+        threads = [Thread(target=produce, args=(producer_id,)) for producer_id in producer_ids]
+        threads += [Thread(target=consume) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(stuck, [], "Operations never succeeded")
+
+        # Every published unit is either in a cart or still in stock
+        in_carts = sum(len(order) for order in bought)
+        in_stock = sum(sum(holders.values())
+                       for holders in self.marketplace.product_index.values())
+        self.assertEqual(in_carts, 4 * 300 - 4 * 75)
+        self.assertEqual(in_carts + in_stock, 4 * 300)
+        self.assertEqual(sum(self.sizes()), in_stock)
+
+
+class TestMarketplaceSnapshot(unittest.TestCase):
+    """
+    Class for marketplace metrics testing purposes
+    """
+
+    def test_snapshot(self):
+        """
+        Checks the metrics snapshot and that metrics can be turned off
+        """
+        marketplace = Marketplace(5, metrics=True)
+        tea = Tea(name="Wild Cherry", price=5, type="Black")
+        coffee = Coffee(name="Brasil", price=7, acidity=5.09, roast_level="MEDIUM")
+
+        producer_id = marketplace.register_producer()
+        cart_id = marketplace.new_cart()
+        marketplace.publish_many(producer_id, coffee, 2)
+        marketplace.add_to_cart(cart_id, coffee)
+        marketplace.add_to_cart(cart_id, tea)
+
+        snapshot = marketplace.snapshot()
+        self.assertEqual(snapshot["methods"]["add_to_cart"]["calls"], 2)
+        self.assertEqual(snapshot["methods"]["add_to_cart"]["failed"], 1)
+        self.assertEqual(snapshot["methods"]["publish_many"]["failed"], 0)
+        self.assertIn("p99", snapshot["methods"]["add_to_cart"]["latency_us"])
+        self.assertEqual(snapshot["locks"]["cart"]["acquisitions"], 1)
+        self.assertEqual(snapshot["queues"], {"capacity": 5, "sizes": [1]})
+
+        marketplace = Marketplace(5)
+        marketplace.register_producer()
+        self.assertIsNone(marketplace.metrics)
+        self.assertEqual(marketplace.snapshot(), {"queues": {"capacity": 5, "sizes": [0]}})
+
+
+class TestMarketplaceRemoval(unittest.TestCase):
+    """
+    Class for remove_from_cart provenance testing purposes
+    """
+
+    def test_units_return_to_their_producer(self):
+        """
+        Checks that removed units go back to the producer they came from, or to
+        a producer with free slots once its queue filled up
+        """
+        marketplace = Marketplace(2)
+        tea = Tea(name="Linden", price=9, type="Herbal")
+        first = marketplace.register_producer()
+        second = marketplace.register_producer()
+        cart_id = marketplace.new_cart()
+
+        marketplace.publish_many(second, tea, 2)
+        self.assertEqual(marketplace.add_to_cart(cart_id, tea, 2), 2)
+
+        # The first producer's queue has room, the unit still goes back to the second
+        self.assertEqual(marketplace.remove_from_cart(cart_id, tea), 1)
+        self.assertEqual([producer.size for producer in marketplace.producers], [0, 1])
+
+        # The second producer filled its queue, the unit takes a free slot elsewhere
+        marketplace.publish(second, tea)
+        self.assertEqual(marketplace.remove_from_cart(cart_id, tea), 1)
+        self.assertEqual([producer.size for producer in marketplace.producers], [1, 2])
+        self.assertEqual(marketplace.product_index[marketplace.catalog.find(tea)],
+                         {first - 1: 1, second - 1: 2})
@@ -0,0 +1,258 @@
+"""
+This module represents the Marketplace's logging pipeline.
+
+Log records are put on a queue by the marketplace and written to marketplace.log
+in batches by a background thread, so that formatting and file I/O stay out of
+the marketplace methods.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import atexit
+import io
+import logging
+import os
+import unittest
+from logging.handlers import QueueHandler, RotatingFileHandler
+from queue import SimpleQueue, Empty
+from random import random
+from threading import Lock, Thread
+from time import gmtime
+
+LOG_FORMAT = '[%(asctime)s] %(levelname)s %(message)s'
+LOG_DATE_FORMAT = '%Y-%m-%dT %H:%M:%S'
+
+# Marks the end of the records on the queue
+_STOP = object()
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Queue handler that leaves the formatting to the writer thread.
+
+    The default QueueHandler formats the message in the caller's thread; the
+    marketplace only logs immutable products and ids, so the record can cross
+    the queue with its arguments untouched.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps each record with the given probability.
+    """
+
+    def __init__(self, rate=1.0):
+        logging.Filter.__init__(self)
+        self.rate = rate
+
+    def filter(self, record):
+        return self.rate >= 1.0 or random() < self.rate
+
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+    """
+    Rotating file handler that writes a whole batch of records with a single flush.
+    """
+
+    def emit_batch(self, records):
+        """
+        Writes the records, rotating the file when needed, and flushes once.
+        """
+        with self.lock:
+            for record in records:
+                if self.shouldRollover(record):
+                    self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+                self.stream.write(self.format(record) + self.terminator)
+            self.flush()
+
+
+class LogPipeline:
+    """
+    Queue and background writer thread between a logger and its handler.
+    """
+
+    def __init__(self, logger, handler, level=logging.INFO, sample_rate=1.0, batch_size=512):
+        """
+        Constructor
+
+        :type logger: Logger
+        :param logger: the logger whose records go through the pipeline
+
+        :type handler: Handler
+        :param handler: writes the records; emit_batch is used if it has one
+
+        :type level: Int
+        :param level: the minimum level logged
+
+        :type sample_rate: Float
+        :param sample_rate: the fraction of the records kept
+
+        :type batch_size: Int
+        :param batch_size: the maximum number of records written at once
+        """
+        self.logger = logger
+        self.handler = handler
+        self.batch_size = batch_size
+        self.queue = SimpleQueue()
+        self.sampling = SamplingFilter(sample_rate)
+
+        self.queue_handler = DeferredQueueHandler(self.queue)
+        logger.addHandler(self.queue_handler)
+        logger.addFilter(self.sampling)
+        logger.setLevel(level)
+        logger.propagate = False
+
+        self.writer = None
+        self._start_writer()
+
+    def _start_writer(self):
+        """
+        Starts the thread that writes the queued records.
+        """
+        self.writer = Thread(target=self._write, name="marketplace-log", daemon=True)
+        self.writer.start()
+
+    def restart_in_child(self):
+        """
+        Gives a forked process a queue and a writer thread of its own.
+        """
+        self.queue = SimpleQueue()
+        self.queue_handler.queue = self.queue
+        self._start_writer()
+
+    def set_level(self, level):
+        """
+        Changes the minimum level logged. Disabled calls return before any formatting.
+        """
+        self.logger.setLevel(level)
+
+    def set_sample_rate(self, rate):
+        """
+        Changes the fraction of the records kept.
+        """
+        self.sampling.rate = rate
+
+    def _write(self):
+        """
+        Writer thread: drains the queue in batches until it is stopped.
+        """
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                pass
+
+            stop = batch[-1] is _STOP
+            if stop:
+                batch.pop()
+
+            if hasattr(self.handler, "emit_batch"):
+                self.handler.emit_batch(batch)
+            else:
+                for record in batch:
+                    self.handler.handle(record)
+
+            if stop:
+                return
+
+    def stop(self):
+        """
+        Writes the records still queued and stops the writer thread.
+        """
+        self.queue.put(_STOP)
+        self.writer.join()
+        self.handler.close()
+
+
+_PIPELINE_LOCK = Lock()
+_PIPELINE = []
+
+
+def get_pipeline():
+    """
+    Returns the marketplace's log pipeline, configuring it on first use.
+    """
+    with _PIPELINE_LOCK:
+        if not _PIPELINE:
+            handler = BatchRotatingFileHandler('marketplace.log', maxBytes=100000,
+                                               backupCount=10)
+            formatter = logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT)
+            formatter.converter = gmtime
+            handler.setFormatter(formatter)
+
+            _PIPELINE.append(LogPipeline(logging.getLogger("marketplace"), handler))
+            atexit.register(_PIPELINE[0].stop)
+
+            # A forked process does not inherit the writer thread
+            os.register_at_fork(after_in_child=_PIPELINE[0].restart_in_child)
+
+        return _PIPELINE[0]
+
+
+def get_logger():
+    """
+    Returns the marketplace's logger.
+    """
+    return get_pipeline().logger
+
+
+class TestLogPipeline(unittest.TestCase):
+    """
+    Class for log pipeline testing purposes
+    """
+
+    def setUp(self):
+        """
+        Initialize a pipeline writing to memory
+        """
+        self.output = io.StringIO()
+        handler = logging.StreamHandler(self.output)
+        handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        self.pipeline = LogPipeline(logging.getLogger("test-marketplace"), handler)
+
+    def tearDown(self):
+        self.pipeline.logger.handlers.clear()
+        self.pipeline.logger.filters.clear()
+
+    def test_records_written(self):
+        """
+        Checks that the records reach the handler, in order
+        """
+        for i in range(1000):
+            self.pipeline.logger.info("record %d", i)
+        self.pipeline.stop()
+
+        self.assertEqual(self.output.getvalue().splitlines(),
+                         [f"INFO record {i}" for i in range(1000)])
+
+    def test_disabled_level(self):
+        """
+        Checks that a disabled level never formats its arguments
+        """
+        formatted = []
+
+        class Product:
+            """
+            Records each time it is formatted
+            """
+            def __repr__(self):
+                formatted.append(self)
+                return "Product()"
+
+        self.pipeline.set_level(logging.WARNING)
+        self.pipeline.logger.info("adds %s", Product())
+        self.pipeline.set_level(logging.INFO)
+        self.pipeline.set_sample_rate(0.0)
+        self.pipeline.logger.info("adds %s", Product())
+        self.pipeline.stop()
+
+        self.assertEqual(formatted, [])
+        self.assertEqual(self.output.getvalue(), "")
@@ -0,0 +1,248 @@
+"""
+This module represents the Marketplace's metrics.
+
+Every thread records into a shard of its own, so recording takes no lock; the
+shards are only merged when a snapshot is taken. A marketplace built without
+metrics skips all of it.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import unittest
+from functools import wraps
+from threading import Lock, local
+from time import perf_counter
+
+# Latency buckets: bucket i counts the calls that took less than 2^i microseconds
+HISTOGRAM_BUCKETS = 32
+
+PERCENTILES = (50, 90, 99)
+
+
+class MetricsShard:
+    """
+    The metrics recorded by a single thread.
+    """
+    __slots__ = ("calls", "failures", "histograms", "locks")
+
+    def __init__(self):
+        # Method name -> number of calls / of failed calls / latency histogram
+        self.calls = {}
+        self.failures = {}
+        self.histograms = {}
+
+        # Lock kind -> [number of acquisitions, seconds waited, seconds held]
+        self.locks = {}
+
+    def record_call(self, method, seconds, failed):
+        """
+        Records a call to a marketplace method.
+        """
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if failed:
+            self.failures[method] = self.failures.get(method, 0) + 1
+
+        histogram = self.histograms.get(method)
+        if histogram is None:
+            histogram = self.histograms[method] = [0] * HISTOGRAM_BUCKETS
+        histogram[min(int(seconds * 1e6).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+
+    def record_lock(self, kind, waited, held):
+        """
+        Records an acquisition of a lock: the time spent waiting for it and holding it.
+        """
+        totals = self.locks.get(kind)
+        if totals is None:
+            totals = self.locks[kind] = [0, 0.0, 0.0]
+        totals[0] += 1
+        totals[1] += waited
+        totals[2] += held
+
+
+class MarketplaceMetrics:
+    """
+    Call counts, failures, latency histograms and lock wait/hold times of a marketplace.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.shards = []
+        self.local = local()
+
+    def shard(self):
+        """
+        Returns the calling thread's shard.
+        """
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = MetricsShard()
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def timed_lock(self, kind, lock=None):
+        """
+        Returns a lock recording its wait and hold times under the given kind.
+        """
+        return TimedLock(self, kind, lock)
+
+    def snapshot(self):
+        """
+        Merges the shards into a dict:
+            - methods: name -> calls, failed, latency percentiles (upper bounds, in us);
+            - locks: kind -> acquisitions, wait and hold seconds.
+        """
+        with self.lock:
+            shards = list(self.shards)
+
+        calls, failures, histograms, locks = {}, {}, {}, {}
+        for shard in shards:
+            for method, count in list(shard.calls.items()):
+                calls[method] = calls.get(method, 0) + count
+            for method, count in list(shard.failures.items()):
+                failures[method] = failures.get(method, 0) + count
+            for method, histogram in list(shard.histograms.items()):
+                merged = histograms.setdefault(method, [0] * HISTOGRAM_BUCKETS)
+                for bucket, count in enumerate(list(histogram)):
+                    merged[bucket] += count
+            for kind, shard_totals in list(shard.locks.items()):
+                totals = locks.setdefault(kind, [0, 0.0, 0.0])
+                for idx, value in enumerate(list(shard_totals)):
+                    totals[idx] += value
+
+        return {
+            "methods": {method: {"calls": count,
+                                 "failed": failures.get(method, 0),
+                                 "latency_us": percentiles(histograms[method])}
+                        for method, count in sorted(calls.items())},
+            "locks": {kind: {"acquisitions": count, "wait_s": waited, "hold_s": held}
+                      for kind, (count, waited, held) in sorted(locks.items())},
+        }
+
+
+def percentiles(histogram):
+    """
+    Returns the latency percentiles of a histogram, as the upper bounds of their buckets.
+    """
+    total = sum(histogram)
+    result = {}
+    for percentile in PERCENTILES:
+        rank = total * percentile / 100
+        seen = 0
+        for bucket, count in enumerate(histogram):
+            seen += count
+            if seen >= rank:
+                result[f"p{percentile}"] = 2 ** bucket
+                break
+    return result
+
+
+class TimedLock:
+    """
+    Lock recording the time spent waiting for it and holding it. It can back a
+    Condition: the time spent in Condition.wait counts as neither.
+    """
+    __slots__ = ("metrics", "kind", "raw_lock", "acquired_at", "waited")
+
+    def __init__(self, metrics, kind, lock=None):
+        self.metrics = metrics
+        self.kind = kind
+        self.raw_lock = lock if lock is not None else Lock()
+        self.acquired_at = 0.0
+        self.waited = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        """
+        Acquires the lock, noting the time spent waiting.
+        """
+        start = perf_counter()
+        acquired = self.raw_lock.acquire(blocking, timeout)
+        if acquired:
+            self.acquired_at = perf_counter()
+            self.waited = self.acquired_at - start
+        return acquired
+
+    def release(self):
+        """
+        Releases the lock, recording the time spent waiting for it and holding it.
+        """
+        released_at = perf_counter()
+        waited = self.waited
+        held = released_at - self.acquired_at
+        self.raw_lock.release()
+        self.metrics.shard().record_lock(self.kind, waited, held)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    # Used by Condition.wait, so that waiting for the condition is not recorded
+    def _release_save(self):
+        self.release()
+
+    def _acquire_restore(self, _):
+        self.raw_lock.acquire()
+        self.acquired_at = perf_counter()
+        self.waited = 0.0
+
+    def _is_owned(self):
+        if self.raw_lock.acquire(False):
+            self.raw_lock.release()
+            return False
+        return True
+
+
+def instrumented(method=None, outcome=False):
+    """
+    Decorates a marketplace method so that its calls are recorded, unless the
+    marketplace has no metrics. With outcome, a falsy result counts as a failure.
+    """
+    if method is None:
+        return lambda method: instrumented(method, outcome)
+
+    name = method.__name__
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        metrics = self.metrics
+        if metrics is None:
+            return method(self, *args, **kwargs)
+
+        start = perf_counter()
+        result = method(self, *args, **kwargs)
+        metrics.shard().record_call(name, perf_counter() - start, outcome and not result)
+        return result
+
+    return wrapper
+
+
+class TestMarketplaceMetrics(unittest.TestCase):
+    """
+    Class for marketplace metrics testing purposes
+    """
+
+    def test_snapshot(self):
+        """
+        Checks that calls, failures and lock times from several threads are merged
+        """
+        metrics = MarketplaceMetrics()
+        shard = metrics.shard()
+        shard.record_call("publish", 3e-6, False)
+        shard.record_call("publish", 1e-3, True)
+
+        lock = metrics.timed_lock("cart")
+        with lock:
+            pass
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["methods"]["publish"]["calls"], 2)
+        self.assertEqual(snapshot["methods"]["publish"]["failed"], 1)
+        self.assertEqual(snapshot["methods"]["publish"]["latency_us"]["p50"], 4)
+        self.assertEqual(snapshot["methods"]["publish"]["latency_us"]["p99"], 1024)
+        self.assertEqual(snapshot["locks"]["cart"]["acquisitions"], 1)
+        self.assertGreaterEqual(snapshot["locks"]["cart"]["hold_s"], 0)
@@ -0,0 +1,375 @@
+"""
+This module represents the Marketplace's records: the producers' queues, the
+carts and the add_to_cart calls waiting for a product.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import unittest
+from threading import Condition, Lock
+
+
+class CartWaiter:
+    """
+    A blocked add_to_cart call queued on a product, waiting for units to be handed off.
+    """
+    __slots__ = ("condition", "wanted", "received", "received_count")
+
+    def __init__(self, product_lock, wanted):
+        """
+        Constructor
+
+        :type product_lock: Lock
+        :param product_lock: the lock of the product the cart waits for
+
+        :type wanted: Int
+        :param wanted: the number of units the cart waits for
+        """
+        self.condition = Condition(product_lock)
+        self.wanted = wanted
+
+        # Units handed off so far: producer index -> number of units
+        self.received = {}
+        self.received_count = 0
+
+    def hand_off(self, producer_idx, units):
+        """
+        Gives the waiting cart up to units of the producer. Called with the product's lock held.
+
+        returns the number of units the cart took
+        """
+        units = min(units, self.wanted - self.received_count)
+        self.received[producer_idx] = self.received.get(producer_idx, 0) + units
+        self.received_count += units
+
+        if self.received_count == self.wanted:
+            self.condition.notify()
+        return units
+
+    def wait(self, timeout):
+        """
+        Waits for all the wanted units to be handed off. Called with the product's lock held.
+
+        returns False on timeout
+        """
+        return self.condition.wait_for(lambda: self.received_count == self.wanted, timeout)
+
+
+class ProducerQueue:
+    """
+    The number of units queued by a producer and the condition guarding it,
+    which blocking publish calls wait on for a free slot. The queue keeps its
+    producer's membership in the free producers up to date.
+    """
+    __slots__ = ("condition", "size", "capacity", "producer_idx", "queues")
+
+    def __init__(self, lock, capacity, producer_idx, queues):
+        """
+        Constructor
+
+        :type lock: Lock
+        :param lock: the lock the condition is built on
+
+        :type capacity: Int
+        :param capacity: the maximum number of units queued
+
+        :type producer_idx: Int
+        :param producer_idx: the producer's index
+
+        :type queues: ProducerQueues
+        :param queues: all the producers' queues, which track those with free slots
+        """
+        self.condition = Condition(lock)
+        self.size = 0
+        self.capacity = capacity
+        self.producer_idx = producer_idx
+        self.queues = queues
+
+        queues.mark_free(producer_idx, capacity > 0)
+
+    def reserve(self, units, timeout=0):
+        """
+        Reserves up to units slots in the queue, waiting for a free one if the
+        queue is full and timeout is not 0.
+
+        returns the number of slots reserved
+        """
+        with self.condition:
+            if self.capacity <= self.size:
+                if timeout == 0 or not self.condition.wait_for(
+                        lambda: self.capacity > self.size, timeout):
+                    return 0
+
+            reserved = min(units, self.capacity - self.size)
+            self.size += reserved
+            if self.size >= self.capacity:
+                self.queues.mark_free(self.producer_idx, False)
+
+        return reserved
+
+    def release(self, units):
+        """
+        Frees slots in the queue and wakes up the producer if it waits for one.
+        """
+        with self.condition:
+            if self.size >= self.capacity > self.size - units:
+                self.queues.mark_free(self.producer_idx, True)
+            self.size -= units
+            self.condition.notify()
+
+
+class ProducerQueues:
+    """
+    The producers' queues, indexed by producer index, and the set of those with
+    free slots, so that finding one takes no scan of all the producers.
+    """
+    __slots__ = ("capacity", "queues", "free_lock", "free")
+
+    def __init__(self, capacity):
+        """
+        Constructor
+
+        :type capacity: Int
+        :param capacity: the maximum size of each producer's queue
+        """
+        self.capacity = capacity
+        self.queues = []
+        self.free_lock = Lock()
+        self.free = set()
+
+    def __getitem__(self, producer_idx):
+        return self.queues[producer_idx]
+
+    def __len__(self):
+        return len(self.queues)
+
+    def __iter__(self):
+        return iter(self.queues)
+
+    def register(self, lock):
+        """
+        Adds the queue of a new producer. Called with the marketplace's registry_lock held.
+
+        returns the producer's id, its index + 1
+        """
+        self.queues.append(ProducerQueue(lock, self.capacity, len(self.queues), self))
+        return len(self.queues)
+
+    def mark_free(self, producer_idx, free):
+        """
+        Notes whether the producer's queue has free slots. Called with its condition held.
+        """
+        with self.free_lock:
+            if free:
+                self.free.add(producer_idx)
+            else:
+                self.free.discard(producer_idx)
+
+    def pick_free(self):
+        """
+        Returns the index of a producer with free slots, None if all the queues are full.
+        """
+        with self.free_lock:
+            return next(iter(self.free), None)
+
+
+class Cart:
+    """
+    The quantities in a cart and the lock guarding them: product id -> {index of
+    the producer the units came from: number of units}. Adding or removing units
+    costs O(1) per producer involved, whatever the quantities; the units are only
+    expanded one by one when the order is placed. An ordered cart is closed until
+    it is reused. Its number tells the carts sharing a slot apart.
+    """
+    __slots__ = ("lock", "products", "is_open", "number")
+
+    def __init__(self, lock, number):
+        self.lock = lock
+        self.products = {}
+        self.is_open = True
+        self.number = number
+
+    def add(self, product_id, taken):
+        """
+        Adds units of the product to the cart.
+
+        :type taken: Dict
+        :param taken: producer index -> number of units taken from it
+
+        raises ValueError if the cart was already ordered
+        """
+        with self.lock:
+            if not self.is_open:
+                raise ValueError("the cart was already ordered")
+            holders = self.products.setdefault(product_id, {})
+            for producer_idx, units in taken.items():
+                holders[producer_idx] = holders.get(producer_idx, 0) + units
+
+    def remove(self, product_id, quantity):
+        """
+        Removes up to quantity units of the product from the cart, those of the
+        producer added last first.
+
+        returns a dict: producer index -> number of units removed that came from it
+        raises ValueError if the cart was already ordered
+        """
+        removed = {}
+        with self.lock:
+            if not self.is_open:
+                raise ValueError("the cart was already ordered")
+            holders = self.products.get(product_id)
+            while holders and quantity:
+                producer_idx = next(reversed(holders))
+                units = min(quantity, holders[producer_idx])
+                if holders[producer_idx] == units:
+                    del holders[producer_idx]
+                else:
+                    holders[producer_idx] -= units
+
+                removed[producer_idx] = units
+                quantity -= units
+
+            if holders == {}:
+                del self.products[product_id]
+
+        return removed
+
+    def snapshot(self):
+        """
+        Returns the quantity of each product in the cart: product id -> number of units.
+        """
+        with self.lock:
+            return {product_id: sum(holders.values())
+                    for product_id, holders in self.products.items()}
+
+    def take(self):
+        """
+        Empties and closes the cart.
+
+        returns the quantity of each product that was in the cart, see snapshot
+        """
+        with self.lock:
+            if not self.is_open:
+                raise ValueError("the cart was already ordered")
+            quantities = {product_id: sum(holders.values())
+                          for product_id, holders in self.products.items()}
+            self.products.clear()
+            self.is_open = False
+
+        return quantities
+
+
+class CartRegistry:
+    """
+    The carts, indexed by cart id - 1. The slots of the ordered carts are kept
+    on a free list and reused by the next carts, so that the number of carts
+    held is the largest number open at the same time, not the number ever created.
+    The carts are numbered in the order they are opened, from 1, whatever their slot.
+    """
+    __slots__ = ("carts", "free", "opened")
+
+    def __init__(self):
+        self.carts = []
+        self.free = []
+        self.opened = 0
+
+    def __getitem__(self, cart_idx):
+        return self.carts[cart_idx]
+
+    def __len__(self):
+        return len(self.carts)
+
+    def open(self, new_lock):
+        """
+        Opens a cart, reusing the most recently freed slot if there is one.
+        Called with the marketplace's registry_lock held.
+
+        :type new_lock: Callable
+        :param new_lock: returns the lock of a new cart
+
+        returns the cart's id, its index + 1
+        """
+        self.opened += 1
+        if self.free:
+            cart_idx = self.free.pop()
+            self.carts[cart_idx].is_open = True
+            self.carts[cart_idx].number = self.opened
+        else:
+            self.carts.append(Cart(new_lock(), self.opened))
+            cart_idx = len(self.carts) - 1
+
+        return cart_idx + 1
+
+    def release(self, cart_idx):
+        """
+        Frees the slot of an ordered cart. Called with the marketplace's registry_lock held.
+        """
+        self.free.append(cart_idx)
+
+
+class TestMarketplaceRecords(unittest.TestCase):
+    """
+    Class for marketplace records testing purposes
+    """
+
+    def test_free_producers(self):
+        """
+        Checks that only the producers with free slots are picked
+        """
+        queues = ProducerQueues(2)
+        for _ in range(3):
+            queues.register(Lock())
+
+        self.assertEqual(queues[0].reserve(5), 2)
+        self.assertEqual(queues[2].reserve(2), 2)
+        self.assertEqual(queues.pick_free(), 1)
+
+        self.assertEqual(queues[1].reserve(1), 1)
+        self.assertEqual(queues.pick_free(), 1)
+        self.assertEqual(queues[1].reserve(1), 1)
+        self.assertIsNone(queues.pick_free())
+
+        queues[2].release(1)
+        self.assertEqual(queues.pick_free(), 2)
+        self.assertEqual(len(queues), 3)
+
+    def test_cart_provenance(self):
+        """
+        Checks that the units removed from a cart report the producers they came from
+        """
+        cart = Cart(Lock(), 1)
+        cart.add(7, {0: 2, 1: 1})
+        cart.add(8, {1: 1})
+        cart.add(7, {2: 1})
+
+        self.assertEqual(cart.remove(7, 2), {2: 1, 1: 1})
+        self.assertEqual(cart.remove(9, 1), {})
+        self.assertEqual(cart.remove(8, 5), {1: 1})
+        self.assertEqual(cart.snapshot(), {7: 2})
+
+        # Large quantities are counted, not stored unit by unit
+        cart.add(8, {3: 10 ** 9})
+        self.assertEqual(cart.remove(8, 10 ** 9 - 1), {3: 10 ** 9 - 1})
+        self.assertEqual(cart.take(), {7: 2, 8: 1})
+
+    def test_cart_reuse(self):
+        """
+        Checks that the slot of an ordered cart is reused and an order is taken once
+        """
+        carts = CartRegistry()
+        first = carts.open(Lock)
+        second = carts.open(Lock)
+        carts[first - 1].add(7, {0: 1})
+
+        self.assertEqual(carts[first - 1].take(), {7: 1})
+        self.assertRaises(ValueError, carts[first - 1].take)
+        self.assertRaises(ValueError, carts[first - 1].add, 7, {0: 1})
+        self.assertRaises(ValueError, carts[first - 1].remove, 7, 1)
+        carts.release(first - 1)
+
+        self.assertEqual(carts.open(Lock), first)
+        self.assertEqual(carts[first - 1].number, 3)
+        self.assertEqual(carts.open(Lock), second + 1)
+        self.assertEqual(carts[first - 1].take(), {})
+        self.assertEqual(len(carts), 3)
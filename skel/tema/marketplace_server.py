@@ -0,0 +1,605 @@
+"""
+This module serves a marketplace over a socket and provides its client stub.
+
+The server runs a marketplace in its process; producers and consumers in any
+other process share its inventory through a MarketplaceClient, which has the
+same methods. Requests are compact binary records (the opcodes of the trace
+format) and a connection's requests are answered in order, so a client can
+send a whole batch of calls before reading their results (see Pipeline).
+
+Protocol (little endian):
+    - request: opcode, producer or cart id, product index, quantity, timeout
+      (negative - None); a PRODUCT request is followed by the product;
+    - response: status, result; an ORDER result (the number of products) is
+      followed by the products' indexes, a LOOKUP result (a length) by the
+      product and an ERROR result (a length) by the error message.
+
+A product travels as its JSON fields and its type, one of tema.product's
+classes, so that a client can only make the server build products.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import os
+import socket
+import socketserver
+import tempfile
+import unittest
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import asdict
+from queue import Empty, SimpleQueue
+from struct import Struct
+from json import dumps, loads
+from threading import BoundedSemaphore, Lock, Thread
+
+from tema.catalog import ProductCatalog
+from tema.marketplace import Marketplace
+from tema.product import Coffee, Product, Tea
+from tema.marketplace_trace import INDEX, PRODUCT, REGISTER, PUBLISH, PUBLISH_MANY, NEW_CART, \
+    ADD, REMOVE, ORDER
+
+REQUEST = Struct("<BIIId")
+RESPONSE = Struct("<Bi")
+
+# Returns the product with the given index
+LOOKUP = 8
+
+# Response statuses
+OK, ERROR = range(2)
+
+# Bytes read from a socket at once
+RECV_SIZE = 1 << 16
+
+# The classes a product can be built from
+PRODUCT_TYPES = {product_class.__name__: product_class for product_class in (Product, Tea, Coffee)}
+
+
+def encode_product(product):
+    """
+    Returns the product's type and fields, as JSON.
+    """
+    return dumps({"product_type": type(product).__name__, **asdict(product)}).encode()
+
+
+def decode_product(data):
+    """
+    Returns the product encoded by encode_product.
+
+    raises ValueError if it is not one of the product types
+    """
+    fields = loads(data)
+    product_class = PRODUCT_TYPES.get(fields.pop("product_type", None))
+    if product_class is None:
+        raise ValueError("unknown product type")
+    return product_class(**fields)
+
+
+def parse_address(address):
+    """
+    Returns the socket address of "host:port" (TCP) or of a Unix socket path.
+    """
+    host, separator, port = address.rpartition(":")
+    if separator and port.isdigit():
+        return host, int(port)
+    return address
+
+
+def _family(address):
+    return socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+
+
+def _unlink_stale(path):
+    """
+    Removes the Unix socket left at the path by a server that is gone, so that
+    it can be bound again. A socket still served is left alone.
+    """
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        if os.path.exists(path):
+            os.unlink(path)
+    finally:
+        probe.close()
+
+
+class MarketplaceServer:
+    """
+    Serves a marketplace: a thread per connection answers its requests in order.
+    """
+
+    def __init__(self, marketplace, address):
+        """
+        Constructor
+
+        :type marketplace: Marketplace
+        :param marketplace: the marketplace the calls are made on
+
+        :type address: Tuple, String
+        :param address: (host, port) to listen on TCP (port 0 - any free port),
+        or the path of a Unix socket
+        """
+        self.marketplace = marketplace
+
+        # The products' indexes in the protocol
+        self.catalog = ProductCatalog()
+
+        if _family(address) == socket.AF_UNIX:
+            _unlink_stale(address)
+        server_class = _UnixServer if _family(address) == socket.AF_UNIX else _TCPServer
+        self.server = server_class(address, _RequestHandler)
+        self.server.marketplace_server = self
+        self.address = self.server.server_address
+        self.thread = None
+
+    def start(self):
+        """
+        Serves in a background thread.
+        """
+        self.thread = Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05},
+                             name="marketplace-server", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """
+        Stops serving and closes the listening socket.
+        """
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread.join()
+        self.server.server_close()
+        if isinstance(self.address, str):
+            os.unlink(self.address)
+
+    def handle(self, data, replies):
+        """
+        Answers the complete requests at the start of data.
+
+        returns the number of bytes of data used
+        """
+        offset = 0
+        while len(data) - offset >= REQUEST.size:
+            opcode, target, product_index, quantity, timeout = REQUEST.unpack_from(data, offset)
+            start = offset + REQUEST.size
+            end = start + (quantity if opcode == PRODUCT else 0)
+            if end > len(data):
+                break
+
+            try:
+                replies += self._call((opcode, target, product_index, quantity,
+                                       None if timeout < 0 else timeout), data[start:end])
+            except Exception as error:  # pylint: disable=broad-except
+                message = f"{type(error).__name__}: {error}".encode()
+                replies += RESPONSE.pack(ERROR, len(message))
+                replies += message
+            offset = end
+        return offset
+
+    def _call(self, request, data):
+        """
+        Makes a call on the marketplace and returns its response.
+        """
+        opcode, target, product_index, quantity, timeout = request
+        marketplace = self.marketplace
+        product = (self.catalog.product(product_index)
+                   if opcode in (PUBLISH, PUBLISH_MANY, ADD, REMOVE) else None)
+
+        if opcode == PRODUCT:
+            result = self.catalog.intern(decode_product(data))
+        elif opcode == LOOKUP:
+            data = encode_product(self.catalog.product(target))
+            return RESPONSE.pack(OK, len(data)) + data
+        elif opcode == REGISTER:
+            result = marketplace.register_producer()
+        elif opcode == PUBLISH:
+            result = int(marketplace.publish(target, product, timeout=timeout))
+        elif opcode == PUBLISH_MANY:
+            result = marketplace.publish_many(target, product, quantity, timeout=timeout)
+        elif opcode == NEW_CART:
+            result = marketplace.new_cart()
+        elif opcode == ADD:
+            result = marketplace.add_to_cart(target, product, quantity, timeout=timeout)
+        elif opcode == REMOVE:
+            result = marketplace.remove_from_cart(target, product, quantity)
+        elif opcode == ORDER:
+            order = marketplace.place_order(target)
+            return RESPONSE.pack(OK, len(order)) + b"".join(
+                INDEX.pack(self.catalog.intern(product)) for product in order)
+        else:
+            raise ValueError(f"unknown opcode {opcode}")
+
+        return RESPONSE.pack(OK, result)
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    """
+    Answers the requests of a connection, a batch of them with a single write.
+    """
+
+    def setup(self):
+        if self.request.family != socket.AF_UNIX:
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        marketplace_server = self.server.marketplace_server
+        data = bytearray()
+        try:
+            while True:
+                received = self.request.recv(RECV_SIZE)
+                if not received:
+                    return
+                data += received
+
+                replies = bytearray()
+                del data[:marketplace_server.handle(data, replies)]
+                if replies:
+                    self.request.sendall(replies)
+        except ConnectionError:
+            return
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class _Connection:
+    """
+    A client socket and the bytes received but not read yet.
+    """
+    __slots__ = ("sock", "buffer")
+
+    def __init__(self, address):
+        self.sock = socket.socket(_family(address), socket.SOCK_STREAM)
+        self.sock.connect(address)
+        if self.sock.family != socket.AF_UNIX:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = bytearray()
+
+    def read(self, size):
+        """
+        Returns the next size bytes received.
+        """
+        while len(self.buffer) < size:
+            received = self.sock.recv(RECV_SIZE)
+            if not received:
+                raise ConnectionError("the marketplace server closed the connection")
+            self.buffer += received
+
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def read_response(self):
+        """
+        Returns the status and the result of the next response.
+        """
+        return RESPONSE.unpack(self.read(RESPONSE.size))
+
+
+class _MarketplaceCalls(ABC):
+    """
+    The marketplace's methods, each turned into a call record passed to call().
+    """
+
+    @abstractmethod
+    def call(self, opcode, target=0, product=None, quantity=0, timeout=0):
+        """
+        Makes (or queues) a call.
+        """
+
+    def register_producer(self):
+        """
+        See Marketplace.register_producer.
+        """
+        return self.call(REGISTER)
+
+    def publish(self, producer_id, product, timeout=0):
+        """
+        See Marketplace.publish.
+        """
+        return self.call(PUBLISH, producer_id, product, 1, timeout)
+
+    def publish_many(self, producer_id, product, quantity, timeout=0):
+        """
+        See Marketplace.publish_many.
+        """
+        return self.call(PUBLISH_MANY, producer_id, product, quantity, timeout)
+
+    def new_cart(self):
+        """
+        See Marketplace.new_cart.
+        """
+        return self.call(NEW_CART)
+
+    def add_to_cart(self, cart_id, product, quantity=1, timeout=0):
+        """
+        See Marketplace.add_to_cart.
+        """
+        return self.call(ADD, cart_id, product, quantity, timeout)
+
+    def remove_from_cart(self, cart_id, product, quantity=1):
+        """
+        See Marketplace.remove_from_cart.
+        """
+        return self.call(REMOVE, cart_id, product, quantity)
+
+    def place_order(self, cart_id):
+        """
+        See Marketplace.place_order.
+        """
+        return self.call(ORDER, cart_id)
+
+
+class MarketplaceClient(_MarketplaceCalls):
+    """
+    Stub making the marketplace calls on a MarketplaceServer.
+
+    Each call takes a connection from a pool, shared by the client's threads,
+    and sends its request. A call the server failed raises ValueError.
+    """
+
+    def __init__(self, address, pool_size=4):
+        """
+        Constructor
+
+        :type address: Tuple, String
+        :param address: the server's (host, port), or the path of its Unix socket
+
+        :type pool_size: Int
+        :param pool_size: the maximum number of connections open at once
+        """
+        self.address = address
+        self.slots = BoundedSemaphore(pool_size)
+        self.idle = SimpleQueue()
+
+        # Product <-> index in the protocol, as given by the server
+        self.lock = Lock()
+        self.product_indexes = {}
+        self.products = {}
+
+    @contextmanager
+    def _connection(self):
+        """
+        Lends a pooled connection, closed instead if the calls made on it fail.
+        """
+        with self.slots:
+            try:
+                connection = self.idle.get_nowait()
+            except Empty:
+                connection = _Connection(self.address)
+
+            try:
+                yield connection
+            except BaseException:
+                connection.sock.close()
+                raise
+            self.idle.put(connection)
+
+    def close(self):
+        """
+        Closes the idle connections.
+        """
+        while True:
+            try:
+                self.idle.get_nowait().sock.close()
+            except Empty:
+                return
+
+    def pipeline(self):
+        """
+        Returns a Pipeline queuing calls to be sent together.
+        """
+        return Pipeline(self)
+
+    def call(self, opcode, target=0, product=None, quantity=0, timeout=0):
+        return self.execute([(opcode, target, product, quantity, timeout)])[0]
+
+    def execute(self, calls):
+        """
+        Sends the calls at once, on one connection, and returns their results.
+
+        :type calls: List
+        :param calls: (opcode, producer or cart id, product, quantity, timeout) records
+
+        raises ValueError, after all the calls are made, if the server failed one
+        """
+        results = []
+        errors = []
+        with self._connection() as connection:
+            self._define_products(connection, {call[2] for call in calls} - {None})
+
+            request = bytearray()
+            for opcode, target, product, quantity, timeout in calls:
+                request += REQUEST.pack(opcode, target,
+                                        0 if product is None else self.product_indexes[product],
+                                        quantity, -1.0 if timeout is None else timeout)
+            connection.sock.sendall(request)
+
+            for opcode, *_ in calls:
+                status, result = connection.read_response()
+                if status == ERROR:
+                    errors.append(connection.read(result).decode())
+                    result = None
+                elif opcode == ORDER:
+                    result = [INDEX.unpack_from(data)[0]
+                              for data in (connection.read(INDEX.size) for _ in range(result))]
+                elif opcode == PUBLISH:
+                    result = bool(result)
+                results.append(result)
+
+            # The products of the orders, some maybe published by other clients
+            for idx, (opcode, *_) in enumerate(calls):
+                if opcode == ORDER and results[idx] is not None:
+                    results[idx] = tuple(self._product(connection, product_index)
+                                         for product_index in results[idx])
+
+        if errors:
+            raise ValueError(errors[0])
+        return results
+
+    def _define_products(self, connection, products):
+        """
+        Sends the products the server does not know from this client yet.
+        """
+        products = [product for product in products if product not in self.product_indexes]
+        if not products:
+            return
+
+        request = bytearray()
+        for product in products:
+            data = encode_product(product)
+            request += REQUEST.pack(PRODUCT, 0, 0, len(data), 0)
+            request += data
+        connection.sock.sendall(request)
+
+        for product in products:
+            status, result = connection.read_response()
+            if status == ERROR:
+                raise ValueError(connection.read(result).decode())
+            with self.lock:
+                self.product_indexes[product] = result
+                self.products[result] = product
+
+    def _product(self, connection, product_index):
+        """
+        Returns the product with the given index, asking the server if it is unknown.
+        """
+        product = self.products.get(product_index)
+        if product is not None:
+            return product
+
+        connection.sock.sendall(REQUEST.pack(LOOKUP, product_index, 0, 0, 0))
+        status, result = connection.read_response()
+        if status == ERROR:
+            raise ValueError(connection.read(result).decode())
+        product = decode_product(connection.read(result))
+        with self.lock:
+            self.product_indexes[product] = product_index
+            self.products[product_index] = product
+        return product
+
+
+class Pipeline(_MarketplaceCalls):
+    """
+    Calls queued, sent together with execute() and answered by one round trip.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def call(self, opcode, target=0, product=None, quantity=0, timeout=0):
+        self.calls.append((opcode, target, product, quantity, timeout))
+
+    def execute(self):
+        """
+        Sends the queued calls and returns their results, in order.
+        """
+        calls, self.calls = self.calls, []
+        return self.client.execute(calls)
+
+
+class TestMarketplaceServer(unittest.TestCase):
+    """
+    Class for marketplace server testing purposes
+    """
+
+    def setUp(self):
+        """
+        Serve a marketplace on a Unix socket
+        """
+        self.tea = Tea(name="Linden", price=9, type="Herbal")
+        self.coffee = Coffee(name="Brasil", price=7, acidity=5.09, roast_level="MEDIUM")
+
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.server = MarketplaceServer(Marketplace(3),
+                                        os.path.join(self.directory.name, "marketplace.sock"))
+        self.server.start()
+
+    def tearDown(self):
+        self.server.close()
+        self.directory.cleanup()
+
+    def test_calls(self):
+        """
+        Checks that the calls of two clients share the server's inventory
+        """
+        producer = MarketplaceClient(self.server.address)
+        consumer = MarketplaceClient(self.server.address, pool_size=1)
+
+        producer_id = producer.register_producer()
+        self.assertEqual(producer.publish_many(producer_id, self.tea, 5), 3)
+        self.assertFalse(producer.publish(producer_id, self.coffee))
+
+        cart_id = consumer.new_cart()
+        self.assertEqual(consumer.add_to_cart(cart_id, self.tea, 2), 2)
+        self.assertEqual(consumer.add_to_cart(cart_id, self.coffee), 0)
+        self.assertEqual(consumer.remove_from_cart(cart_id, self.tea), 1)
+        self.assertEqual(consumer.place_order(cart_id), (self.tea,))
+
+        with self.assertRaises(ValueError):
+            consumer.place_order(cart_id)
+        self.assertEqual(consumer.new_cart(), cart_id)
+
+        producer.close()
+        consumer.close()
+
+    def test_pipeline(self):
+        """
+        Checks that pipelined calls are answered in order
+        """
+        client = MarketplaceClient(self.server.address)
+        pipeline = client.pipeline()
+        pipeline.register_producer()
+        pipeline.new_cart()
+        pipeline.publish_many(1, self.coffee, 2)
+        pipeline.add_to_cart(1, self.coffee, 2)
+        pipeline.place_order(1)
+        self.assertEqual(pipeline.execute(), [1, 1, 2, 2, (self.coffee, self.coffee)])
+        client.close()
+
+    def test_product_types(self):
+        """
+        Checks that a request can only define products of the product types
+        """
+        # A product, an unknown type, a pickle
+        for data, status in ((encode_product(self.tea), OK),
+                             (b'{"product_type": "Thread"}', ERROR),
+                             (b"\x80\x04\x95.", ERROR)):
+            replies = bytearray()
+            request = REQUEST.pack(PRODUCT, 0, 0, len(data), 0) + data
+            self.assertEqual(self.server.handle(request, replies), len(request))
+            self.assertEqual(RESPONSE.unpack_from(replies)[0], status)
+
+    def test_stale_socket(self):
+        """
+        Checks that a Unix socket left by a server that is gone is bound again
+        """
+        path = os.path.join(self.directory.name, "stale.sock")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+            stale.bind(path)
+
+        server = MarketplaceServer(Marketplace(3), path)
+        server.start()
+        client = MarketplaceClient(path)
+        self.assertEqual(client.register_producer(), 1)
+        client.close()
+        server.close()
+
+    def test_tcp(self):
+        """
+        Checks that a server listening on TCP is reached with its address
+        """
+        server = MarketplaceServer(Marketplace(3), ("127.0.0.1", 0))
+        server.start()
+        client = MarketplaceClient(parse_address(f"127.0.0.1:{server.address[1]}"))
+        self.assertEqual(client.register_producer(), 1)
+        client.close()
+        server.close()
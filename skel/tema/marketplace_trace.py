@@ -0,0 +1,339 @@
+"""
+This module records the calls made to a marketplace and replays them.
+
+A TraceRecorder wraps a marketplace and writes every call and its result to a
+compact binary trace. Replaying the trace runs the same calls, in the same
+order, on any marketplace implementation in a single thread: the timing of the
+threads no longer changes the work done, so two implementations (or two
+versions of one) can be compared on exactly the same operations.
+
+Trace format (little endian):
+    - header: magic, queue_size_per_producer;
+    - records: opcode, producer or cart id, product index, quantity, result;
+      a PRODUCT record is followed by the pickled product, an ORDER record
+      (whose result is the number of products) by the products' indexes.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import os
+import pickle
+import tempfile
+import unittest
+from struct import Struct
+from threading import Lock
+from time import perf_counter
+
+from tema.marketplace import Marketplace
+from tema.product import Coffee, Tea
+
+MAGIC = b"MKTRACE1"
+HEADER = Struct("<8sI")
+RECORD = Struct("<BIIIi")
+INDEX = Struct("<I")
+
+# Opcodes
+PRODUCT, REGISTER, PUBLISH, PUBLISH_MANY, NEW_CART, ADD, REMOVE, ORDER = range(8)
+
+OPCODE_NAMES = ("product", "register_producer", "publish", "publish_many", "new_cart",
+                "add_to_cart", "remove_from_cart", "place_order")
+
+# Bytes buffered before they are written to the trace file
+BUFFER_SIZE = 1 << 16
+
+
+class TraceRecorder:
+    """
+    Marketplace wrapper recording every call and its result to a trace file.
+
+    The calls run one at a time, each recorded as it returns, so that the trace
+    is exactly the order the marketplace saw. Recording therefore only supports
+    the non blocking calls (timeout 0, the sleep-polling mode).
+    """
+
+    def __init__(self, marketplace, filename):
+        """
+        Constructor
+
+        :type marketplace: Marketplace
+        :param marketplace: the marketplace the calls are made on
+
+        :type filename: String
+        :param filename: the trace file, overwritten
+        """
+        self.marketplace = marketplace
+        self.lock = Lock()
+
+        # Product -> its index in the trace
+        self.product_indexes = {}
+
+        self.buffer = bytearray(HEADER.pack(MAGIC, marketplace.queue_size_per_producer))
+        self.trace_file = open(filename, 'wb')  # pylint: disable=consider-using-with
+
+    def _product_index(self, product):
+        """
+        Returns the product's index, recording the product if it is new. Called with the lock held.
+        """
+        product_index = self.product_indexes.get(product)
+        if product_index is None:
+            product_index = self.product_indexes[product] = len(self.product_indexes)
+            data = pickle.dumps(product)
+            self.buffer += RECORD.pack(PRODUCT, 0, product_index, len(data), 0)
+            self.buffer += data
+        return product_index
+
+    def _record(self, opcode, target, product, quantity, result):
+        """
+        Records a call, unless the trace is closed. Called with the lock held.
+        """
+        if self.trace_file.closed:
+            return
+
+        product_index = self._product_index(product) if product is not None else 0
+        self.buffer += RECORD.pack(opcode, target, product_index, quantity, result)
+        if len(self.buffer) >= BUFFER_SIZE:
+            self.trace_file.write(self.buffer)
+            self.buffer.clear()
+
+    @staticmethod
+    def _check_timeout(timeout):
+        if timeout != 0:
+            raise ValueError("blocking calls cannot be recorded")
+
+    def register_producer(self):
+        """
+        See Marketplace.register_producer.
+        """
+        with self.lock:
+            producer_id = self.marketplace.register_producer()
+            self._record(REGISTER, 0, None, 0, producer_id)
+        return producer_id
+
+    def publish(self, producer_id, product, timeout=0):
+        """
+        See Marketplace.publish.
+        """
+        self._check_timeout(timeout)
+        with self.lock:
+            published = self.marketplace.publish(producer_id, product)
+            self._record(PUBLISH, producer_id, product, 1, int(published))
+        return published
+
+    def publish_many(self, producer_id, product, quantity, timeout=0):
+        """
+        See Marketplace.publish_many.
+        """
+        self._check_timeout(timeout)
+        with self.lock:
+            published = self.marketplace.publish_many(producer_id, product, quantity)
+            self._record(PUBLISH_MANY, producer_id, product, quantity, published)
+        return published
+
+    def new_cart(self):
+        """
+        See Marketplace.new_cart.
+        """
+        with self.lock:
+            cart_id = self.marketplace.new_cart()
+            self._record(NEW_CART, 0, None, 0, cart_id)
+        return cart_id
+
+    def add_to_cart(self, cart_id, product, quantity=1, timeout=0):
+        """
+        See Marketplace.add_to_cart.
+        """
+        self._check_timeout(timeout)
+        with self.lock:
+            added = self.marketplace.add_to_cart(cart_id, product, quantity)
+            self._record(ADD, cart_id, product, quantity, added)
+        return added
+
+    def remove_from_cart(self, cart_id, product, quantity=1):
+        """
+        See Marketplace.remove_from_cart.
+        """
+        with self.lock:
+            removed = self.marketplace.remove_from_cart(cart_id, product, quantity)
+            self._record(REMOVE, cart_id, product, quantity, removed)
+        return removed
+
+    def place_order(self, cart_id):
+        """
+        See Marketplace.place_order.
+        """
+        with self.lock:
+            order = self.marketplace.place_order(cart_id)
+            if self.trace_file.closed:
+                return order
+
+            indexes = [self._product_index(product) for product in order]
+            self._record(ORDER, cart_id, None, 0, len(order))
+            for product_index in indexes:
+                self.buffer += INDEX.pack(product_index)
+        return order
+
+    def close(self):
+        """
+        Writes the buffered records and closes the trace file. The calls made
+        afterwards (by the producers still running) are no longer recorded.
+        """
+        with self.lock:
+            self.trace_file.write(self.buffer)
+            self.buffer.clear()
+            self.trace_file.close()
+
+
+class Trace:
+    """
+    The calls of a trace file, decoded upfront so that replaying only makes the calls.
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as trace_file:
+            data = trace_file.read()
+
+        magic, self.queue_size_per_producer = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError(f"{filename} is not a marketplace trace")
+
+        self.products = []
+        # (opcode, producer or cart id, product index, quantity, result, order)
+        self.calls = []
+
+        offset = HEADER.size
+        while offset < len(data):
+            opcode, target, product_index, quantity, result = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+
+            if opcode == PRODUCT:
+                self.products.append(pickle.loads(data[offset:offset + quantity]))
+                offset += quantity
+                continue
+
+            order = None
+            if opcode == ORDER:
+                order = tuple(INDEX.unpack_from(data, offset + idx * INDEX.size)[0]
+                              for idx in range(result))
+                offset += result * INDEX.size
+
+            self.calls.append((opcode, target, product_index, quantity, result, order))
+
+    def count(self, opcode):
+        """
+        Returns the number of calls with the given opcode.
+        """
+        return sum(1 for call in self.calls if call[0] == opcode)
+
+
+def replay(trace, marketplace, max_examples=10):
+    """
+    Makes the calls of the trace on the marketplace, at full speed in this thread.
+
+    The producer and cart ids are mapped to those the marketplace returns, the
+    products of an order are compared regardless of their order.
+
+    returns a dict: calls, seconds, calls_per_s, divergences (count) and the
+    first max_examples divergences, described
+    """
+    producer_ids = {}
+    cart_ids = {}
+    product_indexes = {product: product_index
+                       for product_index, product in enumerate(trace.products)}
+    divergences = []
+    diverged = 0
+
+    start = perf_counter()
+    for call_idx, (opcode, target, product_index, quantity, result, order) \
+            in enumerate(trace.calls):
+        product = trace.products[product_index] if trace.products else None
+
+        if opcode == REGISTER:
+            producer_ids[result] = marketplace.register_producer()
+            continue
+        if opcode == NEW_CART:
+            cart_ids[result] = marketplace.new_cart()
+            continue
+
+        if opcode == PUBLISH:
+            got = int(marketplace.publish(producer_ids[target], product))
+        elif opcode == PUBLISH_MANY:
+            got = marketplace.publish_many(producer_ids[target], product, quantity)
+        elif opcode == ADD:
+            got = marketplace.add_to_cart(cart_ids[target], product, quantity)
+        elif opcode == REMOVE:
+            got = marketplace.remove_from_cart(cart_ids[target], product, quantity)
+        else:
+            got = tuple(sorted(product_indexes[product]
+                               for product in marketplace.place_order(cart_ids[target])))
+            result = tuple(sorted(order))
+
+        if got != result:
+            diverged += 1
+            if len(divergences) < max_examples:
+                divergences.append(f"call {call_idx}: "
+                                   f"{OPCODE_NAMES[opcode]}({target}) returned {got}, "
+                                   f"recorded {result}")
+    seconds = perf_counter() - start
+
+    return {
+        "calls": len(trace.calls),
+        "seconds": seconds,
+        "calls_per_s": len(trace.calls) / seconds if seconds else 0.0,
+        "divergences": diverged,
+        "examples": divergences,
+    }
+
+
+class TestMarketplaceTrace(unittest.TestCase):
+    """
+    Class for marketplace trace testing purposes
+    """
+
+    def setUp(self):
+        """
+        Record a few calls on a marketplace
+        """
+        self.tea = Tea(name="Linden", price=9, type="Herbal")
+        self.coffee = Coffee(name="Brasil", price=7, acidity=5.09, roast_level="MEDIUM")
+
+        with tempfile.NamedTemporaryFile(suffix=".trace", delete=False) as trace_file:
+            self.filename = trace_file.name
+
+        recorder = TraceRecorder(Marketplace(3), self.filename)
+        producer_id = recorder.register_producer()
+        cart_id = recorder.new_cart()
+        recorder.publish_many(producer_id, self.tea, 5)
+        recorder.publish(producer_id, self.coffee)
+        recorder.add_to_cart(cart_id, self.tea, 4)
+        recorder.add_to_cart(cart_id, self.coffee)
+        recorder.remove_from_cart(cart_id, self.tea)
+        self.order = recorder.place_order(cart_id)
+        recorder.close()
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def test_replay(self):
+        """
+        Checks that replaying on the same implementation reproduces every result
+        """
+        trace = Trace(self.filename)
+        self.assertEqual(trace.queue_size_per_producer, 3)
+        self.assertEqual(trace.products, [self.tea, self.coffee])
+        self.assertEqual(len(trace.calls), 8)
+        self.assertEqual(trace.calls[-1][5], (0, 0))
+
+        stats = replay(trace, Marketplace(3))
+        self.assertEqual(stats["calls"], 8)
+        self.assertEqual(stats["divergences"], 0, stats["examples"])
+
+    def test_divergence(self):
+        """
+        Checks that a marketplace behaving differently is reported
+        """
+        stats = replay(Trace(self.filename), Marketplace(2))
+
+        # One unit less published, added and ordered
+        self.assertEqual(stats["divergences"], 3)
+        self.assertIn("publish_many(1) returned 2, recorded 3", stats["examples"][0])
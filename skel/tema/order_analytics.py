@@ -0,0 +1,283 @@
+"""
+This module aggregates the placed orders: top sellers, revenue and fill rates.
+
+The analytics sit between the consumers and the order sink, like the order
+verifier, and append every unit ordered to columns (product id, consumer id,
+price, timestamp) kept in compact arrays. The reports are computed over whole
+columns with NumPy, an optional dependency: recording works without it, the
+reports need it.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import os
+import tempfile
+import unittest
+from array import array
+from threading import Lock
+from time import perf_counter, time
+
+from tema.catalog import ProductCatalog
+from tema.order_journal import OrderJournal, OrderJournalReader
+from tema.order_verifier import expected_order
+from tema.product import Coffee, Tea
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class OrderAnalytics:
+    """
+    Order sink wrapper recording every unit ordered in columns.
+    """
+
+    def __init__(self, order_sink=None):
+        """
+        Constructor
+
+        :type order_sink: OrderSink
+        :param order_sink: where the orders are then printed; None - they are only recorded
+        """
+        self.order_sink = order_sink
+        self.lock = Lock()
+
+        # The products' and the consumers' ids in the columns
+        self.catalog = ProductCatalog()
+        self.consumer_ids = {}
+
+        # Units added to the carts read, by consumer id; None if they are unknown
+        self.requested = array('q')
+
+        # One row per unit ordered
+        self.product_id = array('i')
+        self.consumer_id = array('i')
+        self.price = array('d')
+        self.timestamp = array('d')
+
+    @classmethod
+    def from_journal(cls, reader):
+        """
+        Returns analytics over the orders of a journal (see order_journal), each
+        cart standing for a consumer, named "cart<number>". The journal does not
+        hold the units the carts asked for, so there is no fill rate.
+
+        :type reader: OrderJournalReader
+        :param reader: the journal's records
+        """
+        if numpy is None:
+            raise ImportError("the order analytics reports need NumPy")
+
+        analytics = cls()
+        analytics.catalog = ProductCatalog(reader.products)
+        records = reader.columns()
+
+        carts, consumer_id = numpy.unique(records["cart"], return_inverse=True)
+        analytics.consumer_ids = {f"cart{number}": idx for idx, number in enumerate(carts.tolist())}
+        analytics.requested = None
+
+        # A row per unit, as if the orders had been submitted
+        prices = numpy.array([product.price for product in reader.products], dtype=numpy.float64)
+        product_id = numpy.repeat(records["product"], records["quantity"]).astype(numpy.int32)
+        analytics.product_id.frombytes(product_id.tobytes())
+        analytics.consumer_id.frombytes(
+            numpy.repeat(consumer_id, records["quantity"]).astype(numpy.int32).tobytes())
+        analytics.price.frombytes(prices[product_id].tobytes())
+        analytics.timestamp.frombytes(
+            numpy.repeat(records["timestamp"], records["quantity"]).tobytes())
+        return analytics
+
+    def _consumer_id(self, consumer_name):
+        """
+        Returns the consumer's id, giving it one if it is new. Called with the lock held.
+        """
+        consumer_id = self.consumer_ids.get(consumer_name)
+        if consumer_id is None:
+            consumer_id = self.consumer_ids[consumer_name] = len(self.consumer_ids)
+            self.requested.append(0)
+        return consumer_id
+
+    def carts(self, consumer_name, carts):
+        """
+        Yields the consumer's carts, noting the units each of them should order.
+        """
+        for cart in carts:
+            units = sum(expected_order(cart).values())
+            with self.lock:
+                self.requested[self._consumer_id(consumer_name)] += units
+            yield cart
+
+    def submit(self, consumer_name, order, timestamp=None):
+        """
+        Records an order, then hands it to the order sink. See OrderSink.submit.
+
+        :type timestamp: Float
+        :param timestamp: when the order was placed; None - now
+        """
+        timestamp = time() if timestamp is None else timestamp
+        product_ids = [self.catalog.intern(product) for product in order]
+
+        with self.lock:
+            consumer_id = self._consumer_id(consumer_name)
+            self.product_id.extend(product_ids)
+            self.consumer_id.extend([consumer_id] * len(order))
+            self.price.extend([product.price for product in order])
+            self.timestamp.extend([timestamp] * len(order))
+
+        if self.order_sink is not None:
+            self.order_sink.submit(consumer_name, order)
+
+    def columns(self):
+        """
+        Returns copies of the columns as NumPy arrays: product_id, consumer_id,
+        price and timestamp, one row per unit ordered.
+        """
+        if numpy is None:
+            raise ImportError("the order analytics reports need NumPy")
+
+        with self.lock:
+            return {"product_id": numpy.array(self.product_id, dtype=numpy.int32),
+                    "consumer_id": numpy.array(self.consumer_id, dtype=numpy.int32),
+                    "price": numpy.array(self.price, dtype=numpy.float64),
+                    "timestamp": numpy.array(self.timestamp, dtype=numpy.float64)}
+
+    def top_sellers(self, count=10, columns=None):
+        """
+        Returns the count products sold the most: (product, units, revenue) tuples.
+        """
+        columns = columns if columns is not None else self.columns()
+        products = len(self.catalog)
+        units = numpy.bincount(columns["product_id"], minlength=products)
+        revenue = numpy.bincount(columns["product_id"], weights=columns["price"],
+                                 minlength=products)
+
+        # Stable, so that products sold as much stay in catalog order
+        top = numpy.argsort(-units, kind="stable")[:count]
+        return [(self.catalog.product(product_id), int(units[product_id]),
+                 float(revenue[product_id])) for product_id in top if units[product_id]]
+
+    def revenue_by_kind(self, columns=None):
+        """
+        Returns the revenue of each kind of product (Coffee, Tea...).
+        """
+        columns = columns if columns is not None else self.columns()
+        kinds = sorted({type(product).__name__ for product in self.catalog.products()})
+        kind_of = numpy.array([kinds.index(type(product).__name__)
+                               for product in self.catalog.products()], dtype=numpy.int32)
+
+        revenue = numpy.bincount(kind_of[columns["product_id"]], weights=columns["price"],
+                                 minlength=len(kinds))
+        return dict(zip(kinds, revenue.tolist()))
+
+    def revenue_by_consumer(self, columns=None):
+        """
+        Returns the revenue brought by each consumer.
+        """
+        columns = columns if columns is not None else self.columns()
+        revenue = numpy.bincount(columns["consumer_id"], weights=columns["price"],
+                                 minlength=len(self.consumer_ids))
+        return dict(zip(self.consumer_ids, revenue.tolist()))
+
+    def fill_rate(self, columns=None):
+        """
+        Returns, for each consumer, the units ordered over the units its carts asked for;
+        empty for the analytics of a journal.
+        """
+        if self.requested is None:
+            return {}
+
+        columns = columns if columns is not None else self.columns()
+        ordered = numpy.bincount(columns["consumer_id"], minlength=len(self.consumer_ids))
+        with self.lock:
+            requested = numpy.array(self.requested, dtype=numpy.float64)
+
+        # A consumer whose carts asked for nothing got all of it
+        rates = numpy.divide(ordered, requested, out=numpy.ones(len(requested)),
+                             where=requested > 0)
+        return dict(zip(self.consumer_ids, rates.tolist()))
+
+    def report(self, count=10):
+        """
+        Returns every aggregate, as a dict that can be dumped to JSON.
+        """
+        start = perf_counter()
+        columns = self.columns()
+        report = {
+            "units": len(columns["product_id"]),
+            "revenue": float(columns["price"].sum()),
+            "top_sellers": [{"product": repr(product), "units": units, "revenue": revenue}
+                            for product, units, revenue in self.top_sellers(count, columns)],
+            "revenue_by_kind": self.revenue_by_kind(columns),
+            "revenue_by_consumer": self.revenue_by_consumer(columns),
+            "fill_rate": self.fill_rate(columns),
+        }
+        report["seconds"] = perf_counter() - start
+        return report
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestOrderAnalytics(unittest.TestCase):
+    """
+    Class for order analytics testing purposes
+    """
+
+    def setUp(self):
+        """
+        Initialize the analytics and a few products
+        """
+        self.tea = Tea(name="Linden", price=9, type="Herbal")
+        self.green = Tea(name="Sencha", price=12, type="Green")
+        self.coffee = Coffee(name="Brasil", price=7, acidity=5.09, roast_level="MEDIUM")
+        self.analytics = OrderAnalytics()
+
+    def test_aggregates(self):
+        """
+        Checks the aggregates of a few orders
+        """
+        carts = [[{"type": "add", "product": self.tea, "quantity": 3},
+                  {"type": "add", "product": self.coffee, "quantity": 1}]]
+        for _ in self.analytics.carts("cons1", carts):
+            self.analytics.submit("cons1", (self.tea, self.tea, self.coffee))
+        self.analytics.submit("cons2", (self.green, self.tea))
+
+        self.assertEqual(self.analytics.top_sellers(2), [(self.tea, 3, 27.0),
+                                                         (self.coffee, 1, 7.0)])
+        self.assertEqual(self.analytics.revenue_by_kind(), {"Coffee": 7.0, "Tea": 39.0})
+        self.assertEqual(self.analytics.revenue_by_consumer(), {"cons1": 25.0, "cons2": 21.0})
+        self.assertEqual(self.analytics.fill_rate(), {"cons1": 0.75, "cons2": 1.0})
+        self.assertEqual(self.analytics.report()["units"], 5)
+
+    def test_from_journal(self):
+        """
+        Checks that the orders of a journal are aggregated
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "orders.journal")
+            journal = OrderJournal(filename)
+            journal.attach(self.analytics.catalog)
+            self.analytics.catalog.intern(self.tea)
+            self.analytics.catalog.intern(self.coffee)
+            journal.append(1, {0: 2, 1: 1})
+            journal.append(2, {1: 3})
+            journal.close()
+
+            reader = OrderJournalReader(filename)
+            analytics = OrderAnalytics.from_journal(reader)
+            self.assertEqual(analytics.top_sellers(), [(self.coffee, 4, 28.0), (self.tea, 2, 18.0)])
+            self.assertEqual(analytics.revenue_by_consumer(), {"cart1": 25.0, "cart2": 21.0})
+            self.assertEqual(analytics.fill_rate(), {})
+            reader.close()
+
+    def test_millions_of_units(self):
+        """
+        Checks the aggregates over millions of units (timed by analytics_benchmark.py)
+        """
+        for name in ("cons1", "cons2", "cons3", "cons4"):
+            self.analytics.submit(name, (self.tea, self.green, self.coffee) * 250_000)
+
+        report = self.analytics.report()
+        self.assertEqual(report["units"], 3_000_000)
+        self.assertEqual(report["revenue_by_kind"], {"Coffee": 7_000_000.0,
+                                                     "Tea": 21_000_000.0})
@@ -0,0 +1,294 @@
+"""
+This module represents the journal of the placed orders.
+
+The marketplace appends every order to a binary file of fixed-size records,
+one per product ordered: order number, cart number, product id (the catalog's),
+quantity and time. The carts are numbered in the order they were opened, since
+the ids of ordered carts are reused. The records are buffered and written in
+large batches. A reader maps the file in memory: it scans the records one at a time, finds
+an order by binary search and, with NumPy, views every record as a structured
+array without copying it, so a journal of tens of millions of orders is read
+without turning them into Python objects.
+
+The products themselves are pickled next to the journal, in id order.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import mmap
+import os
+import pickle
+import unittest
+from itertools import chain, repeat
+from struct import Struct
+from tempfile import TemporaryDirectory
+from threading import Lock
+from time import time
+
+from tema.marketplace import Marketplace
+from tema.product import Tea, Coffee
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b"MKJOURN1"
+HEADER = Struct("<8sII")
+
+# Order number, cart number, product id, quantity, padding, time: 32 bytes, aligned
+RECORD = Struct("<QIII4xd")
+
+# Bytes buffered before they are written to the journal file
+BUFFER_SIZE = 1 << 16
+
+
+def products_filename(filename):
+    """
+    Returns the file the journal's products are pickled to.
+    """
+    return filename + ".products"
+
+
+class OrderJournal:
+    """
+    Append-only journal of the orders placed on a marketplace.
+    """
+
+    def __init__(self, filename, buffer_size=BUFFER_SIZE):
+        """
+        Constructor
+
+        :type filename: String
+        :param filename: the journal file, overwritten
+
+        :type buffer_size: Int
+        :param buffer_size: the bytes of records buffered before they are written
+        """
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.lock = Lock()
+        self.catalog = None
+        self.orders = 0
+
+        self.buffer = bytearray(HEADER.pack(MAGIC, RECORD.size, 0))
+        self.journal_file = open(filename, 'wb')  # pylint: disable=consider-using-with
+
+    def attach(self, catalog):
+        """
+        Sets the catalog whose product ids the orders are written with.
+        """
+        self.catalog = catalog
+
+    def append(self, cart_number, quantities):
+        """
+        Appends an order, unless the journal is closed.
+
+        :type cart_number: Int
+        :param cart_number: the number of the cart ordered, see CartRegistry
+
+        :type quantities: Dict
+        :param quantities: product id -> units ordered
+        """
+        timestamp = time()
+        with self.lock:
+            if self.journal_file.closed:
+                return
+
+            order = self.orders
+            self.orders += 1
+            for product_id, units in quantities.items():
+                self.buffer += RECORD.pack(order, cart_number, product_id, units, timestamp)
+
+            if len(self.buffer) >= self.buffer_size:
+                self.journal_file.write(self.buffer)
+                self.buffer.clear()
+
+    def flush(self):
+        """
+        Writes the buffered records and the products, so that a reader sees every
+        order appended so far.
+        """
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        """
+        See flush. Called with the lock held.
+        """
+        self.journal_file.write(self.buffer)
+        self.buffer.clear()
+        self.journal_file.flush()
+
+        products = self.catalog.products() if self.catalog is not None else []
+        with open(products_filename(self.filename), 'wb') as products_file:
+            pickle.dump(products, products_file)
+
+    def close(self):
+        """
+        Writes the buffered records and the products and closes the journal file.
+        """
+        with self.lock:
+            if not self.journal_file.closed:
+                self._flush()
+                self.journal_file.close()
+
+
+class OrderJournalReader:
+    """
+    The records of a journal, mapped in memory.
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as journal_file:
+            self.journal_map = mmap.mmap(journal_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, record_size, _ = HEADER.unpack_from(self.journal_map)
+        if magic != MAGIC or record_size != RECORD.size:
+            raise ValueError(f"{filename} is not an order journal")
+
+        # A record being written when the journal was read is left out
+        self.count = (len(self.journal_map) - HEADER.size) // RECORD.size
+
+        with open(products_filename(filename), 'rb') as products_file:
+            self.products = pickle.load(products_file)
+
+    def __len__(self):
+        return self.count
+
+    def record(self, idx):
+        """
+        Returns a record: order number, cart number, product id, quantity and time.
+        """
+        if not 0 <= idx < self.count:
+            raise IndexError(idx)
+        return RECORD.unpack_from(self.journal_map, HEADER.size + idx * RECORD.size)
+
+    def scan(self):
+        """
+        Yields the records, in order, reading them straight from the mapped file.
+        """
+        return RECORD.iter_unpack(
+            memoryview(self.journal_map)[HEADER.size:HEADER.size + self.count * RECORD.size])
+
+    def order(self, order_number):
+        """
+        Returns the products of an order, as place_order did; found by binary
+        search, the order numbers increasing through the journal.
+
+        raises KeyError if the order is not in the journal
+        """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.record(middle)[0] < order_number:
+                low = middle + 1
+            else:
+                high = middle
+
+        quantities = []
+        for idx in range(low, self.count):
+            number, _, product_id, units, _ = self.record(idx)
+            if number != order_number:
+                break
+            quantities.append((product_id, units))
+
+        if not quantities:
+            raise KeyError(order_number)
+        return tuple(chain.from_iterable(repeat(self.products[product_id], units)
+                                         for product_id, units in quantities))
+
+    def columns(self):
+        """
+        Returns the records as a NumPy structured array (fields order, cart,
+        product, quantity, timestamp) viewing the mapped file, not a copy.
+        """
+        if numpy is None:
+            raise ImportError("the journal's columns need NumPy")
+
+        dtype = numpy.dtype({"names": ["order", "cart", "product", "quantity", "timestamp"],
+                             "formats": ["<u8", "<u4", "<u4", "<u4", "<f8"],
+                             "offsets": [0, 8, 12, 16, 24],
+                             "itemsize": RECORD.size})
+        return numpy.frombuffer(self.journal_map, dtype=dtype, count=self.count,
+                                offset=HEADER.size)
+
+    def close(self):
+        """
+        Unmaps the file. The columns must not be used any more.
+        """
+        self.journal_map.close()
+
+
+class TestOrderJournal(unittest.TestCase):
+    """
+    Class for order journal testing purposes
+    """
+
+    def setUp(self):
+        """
+        Journal a few orders placed on a marketplace
+        """
+        self.tea = Tea(name="Linden", price=9, type="Herbal")
+        self.coffee = Coffee(name="Brasil", price=7, acidity=5.09, roast_level="MEDIUM")
+
+        self.directory = TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.filename = os.path.join(self.directory.name, "orders.journal")
+        self.journal = OrderJournal(self.filename, buffer_size=64)
+        marketplace = Marketplace(10, journal=self.journal)
+
+        producer_id = marketplace.register_producer()
+        marketplace.publish_many(producer_id, self.tea, 6)
+        marketplace.publish_many(producer_id, self.coffee, 3)
+        self.orders = []
+        for quantity in range(1, 4):
+            cart_id = marketplace.new_cart()
+            marketplace.add_to_cart(cart_id, self.tea, quantity)
+            marketplace.add_to_cart(cart_id, self.coffee)
+            self.orders.append(marketplace.place_order(cart_id))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_read(self):
+        """
+        Checks that the journaled orders are scanned and found again
+        """
+        self.journal.close()
+        reader = OrderJournalReader(self.filename)
+
+        self.assertEqual(len(reader), 6)
+        self.assertEqual([record[:4] for record in reader.scan()][:2],
+                         [(0, 1, 0, 1), (0, 1, 1, 1)])
+        for order_number, order in enumerate(self.orders):
+            self.assertEqual(reader.order(order_number), order)
+        with self.assertRaises(KeyError):
+            reader.order(3)
+        reader.close()
+
+    def test_flush(self):
+        """
+        Checks that a reader sees the orders flushed while the journal is open
+        """
+        self.journal.flush()
+        reader = OrderJournalReader(self.filename)
+        self.assertEqual(reader.order(2), self.orders[2])
+        reader.close()
+        self.journal.close()
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_columns(self):
+        """
+        Checks that the columns view the records
+        """
+        self.journal.close()
+        reader = OrderJournalReader(self.filename)
+        columns = reader.columns()
+
+        self.assertEqual(columns["order"].tolist(), [0, 0, 1, 1, 2, 2])
+        # The three carts share a slot, not a number
+        self.assertEqual(columns["cart"].tolist(), [1, 1, 2, 2, 3, 3])
+        self.assertEqual(int(columns["quantity"][columns["product"] == 0].sum()), 6)
+        del columns
+        reader.close()
@@ -0,0 +1,267 @@
+"""
+This module represents the sink of the placed orders.
+
+The consumers hand over whole orders; a single writer thread formats them and
+writes them to the destination in large chunks, so the lines of two orders
+never interleave and the consumers never wait for the output.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import atexit
+import io
+import os
+import sys
+import unittest
+from queue import SimpleQueue, Empty
+from threading import Event, Lock, Thread
+
+from tema.product import Coffee, Tea
+
+# Marks the end of the orders on the queue
+_STOP = object()
+
+
+class StreamDestination:
+    """
+    Writes the orders to a text stream, the standard output by default.
+    """
+
+    def __init__(self, stream=None):
+        """
+        Constructor
+
+        :type stream: TextIO
+        :param stream: the stream written to; None - the current sys.stdout
+        """
+        self.stream = stream
+
+    def write(self, text):
+        """
+        Writes a chunk of complete lines.
+        """
+        (self.stream or sys.stdout).write(text)
+
+    def flush(self):
+        """
+        Flushes the stream.
+        """
+        (self.stream or sys.stdout).flush()
+
+    def close(self):
+        """
+        Flushes the stream, which belongs to the caller and stays open.
+        """
+        self.flush()
+
+
+class FileDestination(StreamDestination):
+    """
+    Writes the orders to a file, with a large buffer.
+    """
+
+    def __init__(self, filename, buffer_size=1 << 16):
+        # Closed with the sink
+        output_file = open(filename, 'w', buffering=buffer_size,  # pylint: disable=consider-using-with
+                           encoding="utf-8")
+        StreamDestination.__init__(self, output_file)
+
+    def close(self):
+        self.stream.close()
+
+
+class MemoryDestination:
+    """
+    Keeps the orders in memory.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, text):
+        """
+        Keeps a chunk of complete lines.
+        """
+        self.chunks.append(text)
+
+    def flush(self):
+        """
+        Nothing to flush.
+        """
+
+    def close(self):
+        """
+        Nothing to close, the lines stay readable.
+        """
+
+    def lines(self):
+        """
+        Returns the lines written so far.
+        """
+        return "".join(self.chunks).splitlines()
+
+
+class OrderSink:
+    """
+    Queue and background writer thread between the consumers and a destination.
+    """
+
+    def __init__(self, destination=None, batch_size=1024):
+        """
+        Constructor
+
+        :type destination: StreamDestination, FileDestination, MemoryDestination
+        :param destination: where the orders are written; None - the standard output
+
+        :type batch_size: Int
+        :param batch_size: the maximum number of orders written at once
+        """
+        self.destination = destination if destination is not None else StreamDestination()
+        self.batch_size = batch_size
+        self.queue = SimpleQueue()
+
+        self.writer = None
+        self._start_writer()
+
+    def _start_writer(self):
+        """
+        Starts the thread that writes the queued orders.
+        """
+        self.writer = Thread(target=self._write, name="order-sink", daemon=True)
+        self.writer.start()
+
+    def restart_in_child(self):
+        """
+        Gives a forked process a queue and a writer thread of its own.
+        """
+        self.queue = SimpleQueue()
+        self._start_writer()
+
+    def submit(self, consumer_name, order):
+        """
+        Queues a placed order, printed as one line per product.
+
+        :type consumer_name: String
+        :param consumer_name: the consumer who placed the order
+
+        :type order: Tuple
+        :param order: the bought products, as returned by place_order
+        """
+        if order:
+            self.queue.put((consumer_name, order))
+
+    def _write(self):
+        """
+        Writer thread: drains the queue in batches until it is stopped.
+        """
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size and isinstance(batch[-1], tuple):
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                pass
+
+            # A flush request or the end marker is always the last item of its batch
+            marker = None if isinstance(batch[-1], tuple) else batch.pop()
+
+            lines = [f'{consumer_name} bought {product}\n'
+                     for consumer_name, order in batch for product in order]
+            if lines:
+                self.destination.write("".join(lines))
+            self.destination.flush()
+
+            if marker is _STOP:
+                return
+            if marker is not None:
+                marker.set()
+
+    def flush(self):
+        """
+        Waits until the orders submitted so far are written.
+        """
+        written = Event()
+        self.queue.put(written)
+        written.wait()
+
+    def close(self):
+        """
+        Writes the orders still queued, stops the writer thread and closes the destination.
+        """
+        self.queue.put(_STOP)
+        self.writer.join()
+        self.destination.close()
+
+
+_SINK_LOCK = Lock()
+_SINK = []
+
+
+def get_order_sink():
+    """
+    Returns the sink printing the orders to the standard output, starting it on first use.
+    """
+    with _SINK_LOCK:
+        if not _SINK:
+            _SINK.append(OrderSink())
+            atexit.register(_SINK[0].close)
+
+            # A forked process does not inherit the writer thread
+            os.register_at_fork(after_in_child=_SINK[0].restart_in_child)
+
+        return _SINK[0]
+
+
+class TestOrderSink(unittest.TestCase):
+    """
+    Class for order sink testing purposes
+    """
+
+    def setUp(self):
+        """
+        Initialize two products
+        """
+        self.tea = Tea(name="Linden", price=9, type="Herbal")
+        self.coffee = Coffee(name="Brasil", price=7, acidity=5.09, roast_level="MEDIUM")
+
+    def test_orders_not_interleaved(self):
+        """
+        Checks that the orders of concurrent consumers are written whole
+        """
+        destination = MemoryDestination()
+        sink = OrderSink(destination, batch_size=16)
+
+        def consume(name):
+            for _ in range(200):
+                sink.submit(name, [self.tea, self.coffee, self.tea])
+
+        consumers = [Thread(target=consume, args=(f"cons{i}",)) for i in range(4)]
+        for consumer in consumers:
+            consumer.start()
+        for consumer in consumers:
+            consumer.join()
+        sink.close()
+
+        lines = destination.lines()
+        self.assertEqual(len(lines), 4 * 200 * 3)
+        for idx in range(0, len(lines), 3):
+            name = lines[idx].split()[0]
+            self.assertEqual(lines[idx:idx + 3], [f"{name} bought {self.tea}",
+                                                  f"{name} bought {self.coffee}",
+                                                  f"{name} bought {self.tea}"])
+
+    def test_flush(self):
+        """
+        Checks that flush waits for the submitted orders to reach the stream
+        """
+        output = io.StringIO()
+        sink = OrderSink(StreamDestination(output))
+
+        sink.submit("cons1", [self.coffee])
+        sink.submit("cons2", [])
+        sink.flush()
+        self.assertEqual(output.getvalue(), f"cons1 bought {self.coffee}\n")
+
+        sink.close()
+        self.assertFalse(output.closed)
@@ -0,0 +1,177 @@
+"""
+This module checks the orders while the consumers place them.
+
+The verifier sits between the consumers and the order sink: every cart a
+consumer reads is turned into the order it should produce, and every order
+placed is compared with the expected one right away, so the first wrong order
+is reported as soon as it is placed instead of after the run.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import sys
+import unittest
+from collections import Counter, deque
+from threading import Lock, Thread
+
+from tema.order_sink import MemoryDestination, OrderSink
+from tema.product import Coffee, Tea
+
+
+def expected_order(cart):
+    """
+    Returns the products the cart should be ordered with and their quantities.
+
+    A removal takes out at most the units that are in the cart.
+    """
+    order = Counter()
+    for command in cart:
+        if command["type"] == "add":
+            order[command["product"]] += command["quantity"]
+        else:
+            order[command["product"]] -= min(command["quantity"], order[command["product"]])
+    return +order
+
+
+class OrderVerifier:
+    """
+    Order sink wrapper comparing each placed order with the cart it comes from.
+    """
+
+    def __init__(self, order_sink, report=None):
+        """
+        Constructor
+
+        :type order_sink: OrderSink
+        :param order_sink: where the checked orders are printed
+
+        :type report: Callable
+        :param report: called with the description of the first wrong order;
+        None - printed to stderr
+        """
+        self.order_sink = order_sink
+        self.report = report if report is not None else lambda error: print(error,
+                                                                            file=sys.stderr)
+        self.lock = Lock()
+
+        # Consumer name -> expected orders of the carts read but not ordered yet
+        self.pending = {}
+        self.checked = 0
+        self.error = None
+
+    def carts(self, consumer_name, carts):
+        """
+        Yields the consumer's carts, noting the order each of them should produce.
+
+        The carts can be any iterable, read while the consumer runs.
+        """
+        with self.lock:
+            pending = self.pending.setdefault(consumer_name, deque())
+
+        for cart in carts:
+            pending.append(expected_order(cart))
+            yield cart
+
+    def submit(self, consumer_name, order):
+        """
+        Checks an order against the consumer's oldest cart not ordered yet, then
+        hands it to the order sink. See OrderSink.submit.
+        """
+        pending = self.pending.get(consumer_name)
+        expected = pending.popleft() if pending else None
+        placed = Counter(order)
+
+        if expected is None:
+            self._fail(f"{consumer_name} placed an order for no cart: {dict(placed)}")
+        elif placed != expected:
+            missing = expected - placed
+            extra = placed - expected
+            self._fail(f"{consumer_name} placed a wrong order: missing {dict(missing)}, "
+                       f"extra {dict(extra)}")
+        else:
+            with self.lock:
+                self.checked += 1
+
+        self.order_sink.submit(consumer_name, order)
+
+    def _fail(self, error):
+        """
+        Keeps and reports the first error.
+        """
+        with self.lock:
+            first = self.error is None
+            if first:
+                self.error = error
+        if first:
+            self.report(error)
+
+    def finish(self):
+        """
+        Checks that every cart read was ordered.
+
+        returns the first error, None if all the orders were right
+        """
+        for consumer_name, pending in self.pending.items():
+            if pending:
+                self._fail(f"{consumer_name} did not order {len(pending)} of its carts")
+        return self.error
+
+
+class TestOrderVerifier(unittest.TestCase):
+    """
+    Class for order verifier testing purposes
+    """
+
+    def setUp(self):
+        """
+        Initialize a verifier in front of an in-memory sink
+        """
+        self.tea = Tea(name="Linden", price=9, type="Herbal")
+        self.coffee = Coffee(name="Brasil", price=7, acidity=5.09, roast_level="MEDIUM")
+        self.destination = MemoryDestination()
+        self.order_sink = OrderSink(self.destination)
+        self.errors = []
+        self.verifier = OrderVerifier(self.order_sink, report=self.errors.append)
+        self.carts = [[{"type": "add", "product": self.tea, "quantity": 2},
+                       {"type": "remove", "product": self.tea, "quantity": 5},
+                       {"type": "add", "product": self.coffee, "quantity": 1}],
+                      [{"type": "add", "product": self.tea, "quantity": 3},
+                       {"type": "remove", "product": self.tea, "quantity": 1}]]
+
+    def test_right_orders(self):
+        """
+        Checks that the orders of concurrent consumers are checked against their own carts
+        """
+        def consume(name):
+            for _ in self.verifier.carts(name, self.carts):
+                pass
+            self.verifier.submit(name, [self.coffee])
+            self.verifier.submit(name, [self.tea, self.tea])
+
+        consumers = [Thread(target=consume, args=(name,))
+                     for name in ("cons1", "cons2", "cons3", "cons4")]
+        for consumer in consumers:
+            consumer.start()
+        for consumer in consumers:
+            consumer.join(timeout=10)
+        self.order_sink.close()
+
+        self.assertIsNone(self.verifier.finish())
+        self.assertEqual(self.verifier.checked, 8)
+        self.assertEqual(len(self.destination.lines()), 12)
+
+    def test_first_error_reported(self):
+        """
+        Checks that the first wrong order is reported when it is placed
+        """
+        carts = self.verifier.carts("cons1", self.carts)
+        next(carts)
+        self.verifier.submit("cons1", [self.coffee, self.tea])
+        self.assertEqual(self.errors, ["cons1 placed a wrong order: missing {}, "
+                                       f"extra {{{self.tea!r}: 1}}"])
+
+        next(carts)
+        self.assertEqual(self.verifier.finish(), self.errors[0])
+        self.assertEqual(len(self.errors), 1)
+        self.order_sink.close()
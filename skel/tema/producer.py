@@ -15,7 +15,8 @@ class Producer(Thread):
     Class that represents a producer.
     """
 
-    def __init__(self, products, marketplace, republish_wait_time, **kwargs):
+    def __init__(self, products, marketplace, republish_wait_time, wait_timeout=0, clock=None,
+                 **kwargs):
         """
         Constructor.
 
@@ -29,49 +30,61 @@ class Producer(Thread):
         @param republish_wait_time: the number of seconds that a producer must
         wait until the marketplace becomes available
 
+        @type wait_timeout: Time
+        @param wait_timeout: if not 0, publish blocks for up to this many seconds
+        (None - until a slot frees up) instead of retrying after republish_wait_time
+
+        @type clock: VirtualClock
+        @param clock: if given, the producer sleeps in its virtual time instead of real time
+
         @type kwargs:
         @param kwargs: other arguments that are passed to the Thread's __init__()
         """
         self.products = products
         self.marketplace = marketplace
         self.republish_wait_time = republish_wait_time
+        self.wait_timeout = wait_timeout
+        self.sleep = clock.sleep if clock is not None else sleep
         Thread.__init__(self, **kwargs)
 
-    def provide(self, producer_id):
+    def batches(self, producer_id):
         """
-        Auxiliary function used for providing products to the marketplace
+        Publishes the products in turn, forever, one batch at a time: a generator
+        yielding the seconds to wait after each batch. It stops at a product with
+        quantity 0. A producer thread sleeps the waits itself, a ProducerScheduler
+        runs the next batch on one of its workers once the wait is over.
 
         @type producer_id: Int
         @param producer_id: the producer's index/id
         """
-        for product in self.products:
-            # Parse name, quantity & timeout
-            product_name = product[0]
-            product_quantity = product[1]
-            time = product[2]
-
-            if product_quantity == 0:
-                return False
-
-            count = 0
-            while count != product_quantity:
-                # Send product to the marketplace's stock
-                result = self.marketplace.publish(producer_id, product_name)
-
-                # Timeout after publishing product
-                sleep(time)
-
-                # If publishing failed, retry after a delay
-                if not result:
-                    sleep(self.republish_wait_time)
-
-                count += 1
-
-        return True
+        if not self.products:
+            return
+
+        while True:
+            for product_name, product_quantity, time in self.products:
+                if product_quantity == 0:
+                    return
+
+                # Send the whole batch to the marketplace's stock, until the queue is full
+                count = 0
+                while count != product_quantity:
+                    published = self.marketplace.publish_many(producer_id, product_name,
+                                                              product_quantity - count,
+                                                              timeout=self.wait_timeout)
+                    if not published:
+                        break
+                    count += published
+
+                # Timeout after producing the batch, and if publishing failed, retry
+                # after a delay (unless publish blocked already)
+                if count != product_quantity and self.wait_timeout == 0:
+                    yield time * product_quantity + self.republish_wait_time
+                else:
+                    yield time * product_quantity
 
     def run(self):
         # Register new producer
         producer_id = self.marketplace.register_producer()
 
-        while self.provide(producer_id):
-            continue
+        for wait_time in self.batches(producer_id):
+            self.sleep(wait_time)
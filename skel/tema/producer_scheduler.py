@@ -0,0 +1,97 @@
+"""
+This module runs producers as tasks on a pool of worker threads.
+
+A Producer thread spends nearly all of its life sleeping between two batches.
+The scheduler runs, instead, each producer's batches as the steps of a task,
+so any number of producers share a few threads while keeping their production
+and republish delays.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import threading
+import unittest
+from time import sleep
+
+from tema.marketplace import Marketplace
+from tema.producer import Producer
+from tema.product import Tea
+from tema.task_scheduler import TaskScheduler
+
+
+class ProducerScheduler(TaskScheduler):
+    """
+    Runs the batches of any number of producers on at most max_workers threads.
+
+    The producers are Producer objects that are never started: the scheduler
+    registers each of them and runs its batches, one at a time. Only for the
+    sleep-polling mode (wait_timeout 0): a producer blocking on a full queue
+    holds a worker, and once those hold every worker the other producers never run.
+    """
+
+    def __init__(self, max_workers=4):
+        TaskScheduler.__init__(self, max_workers, name="producer")
+
+    def add(self, producer):
+        """
+        Schedules a producer's first batch right away.
+
+        :type producer: Producer
+        :param producer: the producer, not started, sleep-polling
+
+        raises ValueError if the producer blocks on the marketplace
+        """
+        if producer.wait_timeout != 0:
+            raise ValueError("scheduled producers cannot block on the marketplace")
+        self.schedule(self._batches(producer))
+
+    @staticmethod
+    def _batches(producer):
+        """
+        Registers the producer, on a worker, then runs its batches.
+        """
+        producer_id = producer.marketplace.register_producer()
+        yield from producer.batches(producer_id)
+
+
+class TestProducerScheduler(unittest.TestCase):
+    """
+    Class for producer scheduler testing purposes
+    """
+
+    def setUp(self):
+        """
+        Initialize a marketplace and a product
+        """
+        self.marketplace = Marketplace(3)
+        self.tea = Tea(name="Linden", price=9, type="Herbal")
+
+    def test_many_producers(self):
+        """
+        Checks that many producers fill their queues on a few threads
+        """
+        threads = threading.active_count()
+        scheduler = ProducerScheduler(max_workers=2)
+        for _ in range(200):
+            scheduler.add(Producer([(self.tea, 1, 0.01)], self.marketplace,
+                                   republish_wait_time=0.01))
+
+        sleep(0.5)
+        self.assertLessEqual(threading.active_count(), threads + 3)
+        scheduler.stop()
+
+        self.assertEqual(len(self.marketplace.producers), 200)
+        self.assertEqual([queue.size for queue in self.marketplace.producers], [3] * 200)
+
+    def test_timing(self):
+        """
+        Checks that a producer waits its production time after each batch
+        """
+        scheduler = ProducerScheduler(max_workers=2)
+        scheduler.add(Producer([(self.tea, 1, 0.3)], self.marketplace,
+                               republish_wait_time=0))
+
+        sleep(0.45)
+        scheduler.stop()
+        self.assertEqual(self.marketplace.producers[0].size, 2)
@@ -0,0 +1,341 @@
+"""
+This module loads the market configuration files and runs them
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import asyncio
+import os
+import tempfile
+import unittest
+from itertools import chain
+from json import dumps, loads
+from queue import Queue
+from threading import Thread
+from time import perf_counter
+
+from tema import product
+from tema.producer import Producer
+from tema.producer_scheduler import ProducerScheduler
+from tema.consumer import Consumer
+from tema.consumer_engine import ConsumerEngine
+from tema.marketplace import Marketplace
+from tema.order_sink import MemoryDestination, OrderSink
+from tema.async_marketplace import AsyncMarketplace, AsyncProducer, AsyncConsumer, run_market
+from tema.shm_marketplace import SharedMarketplace, run_processes
+from tema.virtual_clock import VirtualClock
+
+
+def load_config(filename):
+    """
+        Loads the market configuration and turns product ids into actual products
+    """
+    with open(filename, encoding="utf-8") as input_file:
+        market_config = loads(input_file.read())
+
+    # turn product definitions into actual products
+    products = {}
+
+    for k, products_dict in market_config['products'].items():
+        params = {k: products_dict[k] for k in products_dict.keys() if k != 'product_type'}
+        products[k] = getattr(product, products_dict['product_type'])(**params)
+    market_config['products'] = list(products.values())
+
+    # turn product ids into products in producers
+    for producer in market_config['producers']:
+        producer['products'] = [(products[i], quantity, sleep_time)
+                                for i, quantity, sleep_time
+                                in producer['products']]
+
+    # turn product ids into products in consumer order lists and expected carts
+    for consumer in market_config['consumers']:
+        for cart in consumer['carts']:
+            for operation in cart:
+                operation['product'] = products[operation['product']]
+
+    return market_config
+
+
+class CartFeeder(Thread):
+    """
+    Reads the carts of a JSON Lines scenario and hands them to their consumers
+    as these finish the previous ones.
+    """
+
+    def __init__(self, lines, products, consumer_names, backlog=1):
+        """
+        Constructor
+
+        :type lines: Iterable
+        :param lines: the cart lines of the scenario, closed once read if it is a file
+
+        :type products: Dict
+        :param products: product id -> product
+
+        :type consumer_names: List
+        :param consumer_names: the names of the consumers the carts are for
+
+        :type backlog: Int
+        :param backlog: the number of carts read ahead for each consumer
+        """
+        self.lines = lines
+        self.products = products
+        self.queues = {name: Queue(backlog) for name in consumer_names}
+        Thread.__init__(self, name="cart-feeder", daemon=True)
+
+    def carts(self, consumer_name):
+        """
+        Returns an iterator over the carts of the consumer, in file order.
+        """
+        queue = self.queues[consumer_name]
+        cart = queue.get()
+        while cart is not None:
+            yield cart
+            cart = queue.get()
+
+    def run(self):
+        try:
+            for line in self.lines:
+                if not line.strip():
+                    continue
+
+                record = loads(line)
+                cart = [dict(operation, product=self.products[operation['product']])
+                        for operation in record['operations']]
+
+                # Waits while the consumer still has its backlog to go through
+                self.queues[record['cart']].put(cart)
+        finally:
+            if hasattr(self.lines, "close"):
+                self.lines.close()
+
+            # No more carts
+            for queue in self.queues.values():
+                queue.put(None)
+
+
+def load_stream(filename, backlog=1):
+    """
+        Loads a JSON Lines scenario: a marketplace, product, producer or consumer
+        definition per line, then a line per cart. Only the definitions are read
+        here; the carts are read by a CartFeeder while the consumers run, so the
+        consumers' "carts" are iterators and memory does not grow with the carts.
+
+        returns the market configuration, as load_config does
+    """
+    # Closed by the feeder, once every cart is read
+    input_file = open(filename, encoding="utf-8")  # pylint: disable=consider-using-with
+    market_config = {'products': [], 'producers': [], 'consumers': []}
+    products = {}
+
+    line = input_file.readline()
+    while line:
+        record = loads(line) if line.strip() else {}
+        if 'cart' in record:
+            break
+
+        if 'marketplace' in record:
+            market_config['marketplace'] = record['marketplace']
+        elif 'product' in record:
+            params = {k: v for k, v in record.items() if k not in ('product', 'product_type')}
+            products[record['product']] = getattr(product, record['product_type'])(**params)
+            market_config['products'].append(products[record['product']])
+        elif 'producer' in record:
+            producer = record['producer']
+            producer['products'] = [(products[i], quantity, sleep_time)
+                                    for i, quantity, sleep_time in producer['products']]
+            market_config['producers'].append(producer)
+        elif 'consumer' in record:
+            market_config['consumers'].append(record['consumer'])
+        line = input_file.readline()
+
+    feeder = CartFeeder(chain([line], input_file), products,
+                        [consumer['name'] for consumer in market_config['consumers']], backlog)
+    for consumer in market_config['consumers']:
+        consumer['carts'] = feeder.carts(consumer['name'])
+    feeder.start()
+
+    return market_config
+
+
+def run_threads(market_config, wait_timeout=0, marketplace=None, order_sink=None, *,
+                producer_workers=0, consumer_workers=0):
+    """
+        Runs every producer and consumer in a thread of its own, on the given
+        marketplace or on a new one built from the configuration; the orders go
+        to the given sink, the standard output by default. With producer_workers
+        (consumer_workers), the producers (consumers) run instead on a
+        ProducerScheduler (ConsumerEngine) of that many workers
+    """
+    # build the marketplace
+    if marketplace is None:
+        marketplace = Marketplace(**market_config['marketplace'])
+
+    # build and start the producers
+    producers = [Producer(**p_market_config, marketplace=marketplace,
+                          wait_timeout=wait_timeout, daemon=True)
+                 for p_market_config in market_config['producers']]
+
+    scheduler = ProducerScheduler(producer_workers) if producer_workers else None
+    for producer in producers:
+        if scheduler is not None:
+            scheduler.add(producer)
+        else:
+            producer.start()
+
+    # build and start the consumers
+    consumers = [Consumer(**c_market_config, marketplace=marketplace,
+                          wait_timeout=wait_timeout, order_sink=order_sink)
+                 for c_market_config in market_config['consumers']]
+
+    if consumer_workers:
+        engine = ConsumerEngine(consumer_workers)
+        for consumer in consumers:
+            engine.add(consumer)
+        engine.join()
+        engine.stop()
+    else:
+        for consumer in consumers:
+            consumer.start()
+
+        for consumer in consumers:
+            consumer.join()
+
+    if scheduler is not None:
+        scheduler.stop()
+
+    return marketplace
+
+
+def run_virtual(market_config, marketplace=None, order_sink=None):
+    """
+        Runs every producer and consumer in a thread of its own, sleeping on a
+        virtual clock: returns the marketplace and the virtual seconds the
+        consumers took
+    """
+    if marketplace is None:
+        marketplace = Marketplace(**market_config['marketplace'])
+    clock = VirtualClock()
+
+    # The threads only sleep on the clock, they never wait on the marketplace
+    producers = [Producer(**p_market_config, marketplace=marketplace, clock=clock, daemon=True)
+                 for p_market_config in market_config['producers']]
+    consumers = [Consumer(**c_market_config, marketplace=marketplace, order_sink=order_sink,
+                          clock=clock)
+                 for c_market_config in market_config['consumers']]
+
+    clock.start(*producers, *consumers)
+
+    for consumer in consumers:
+        consumer.join()
+
+    # The producers sleep forever instead of running ahead in virtual time
+    clock.stop()
+
+    return marketplace, clock.time()
+
+
+def run_asyncio(market_config, metrics=False, order_sink=None):
+    """
+        Runs every producer and consumer as a coroutine on a single event loop
+    """
+    marketplace = AsyncMarketplace(**market_config['marketplace'], metrics=metrics)
+
+    producers = [AsyncProducer(**p_market_config, marketplace=marketplace)
+                 for p_market_config in market_config['producers']]
+    consumers = [AsyncConsumer(**c_market_config, marketplace=marketplace, order_sink=order_sink)
+                 for c_market_config in market_config['consumers']]
+
+    asyncio.run(run_market(producers, consumers))
+
+    return marketplace.marketplace
+
+
+def run_shared_memory(market_config, processes):
+    """
+        Runs the producers and consumers in separate processes sharing the marketplace
+    """
+    max_carts = sum(len(consumer['carts']) for consumer in market_config['consumers'])
+    marketplace = SharedMarketplace(**market_config['marketplace'],
+                                    products=market_config['products'],
+                                    max_producers=len(market_config['producers']),
+                                    max_carts=max_carts)
+
+    try:
+        run_processes(marketplace, market_config['producers'], market_config['consumers'],
+                      processes)
+    finally:
+        marketplace.close(unlink=True)
+
+
+class TestScenario(unittest.TestCase):
+    """
+    Class for scenario loading testing purposes
+    """
+
+    def test_load_stream(self):
+        """
+        Checks that the carts of a JSON Lines scenario reach their consumers, in order
+        """
+        records = [{"marketplace": {"queue_size_per_producer": 2}},
+                   {"product": "id1", "product_type": "Tea", "name": "Linden", "price": 9,
+                    "type": "Herbal"},
+                   {"producer": {"name": "prod1", "products": [["id1", 1, 0]],
+                                 "republish_wait_time": 0}},
+                   {"consumer": {"name": "cons1", "retry_wait_time": 0}},
+                   {"consumer": {"name": "cons2", "retry_wait_time": 0}}]
+        records += [{"cart": f"cons{2 - i % 2}",
+                     "operations": [{"type": "add", "product": "id1", "quantity": i}]}
+                    for i in range(1, 7)]
+
+        with tempfile.NamedTemporaryFile('w', suffix=".jsonl", delete=False) as input_file:
+            input_file.write("\n".join(dumps(record) for record in records))
+        try:
+            market_config = load_stream(input_file.name)
+
+            tea = product.Tea(name="Linden", price=9, type="Herbal")
+            self.assertEqual(market_config['marketplace'], {"queue_size_per_producer": 2})
+            self.assertEqual(market_config['producers'][0]['products'], [(tea, 1, 0)])
+
+            # Each consumer only sees its carts, the feeder waits for the slower one
+            carts = {}
+
+            def consume(consumer):
+                carts[consumer['name']] = [[operation['quantity'] for operation in cart]
+                                           for cart in consumer['carts']]
+
+            consumers = [Thread(target=consume, args=(consumer,))
+                         for consumer in market_config['consumers']]
+            for consumer in consumers:
+                consumer.start()
+            for consumer in consumers:
+                consumer.join(timeout=10)
+
+            self.assertEqual(carts, {"cons1": [[1], [3], [5]], "cons2": [[2], [4], [6]]})
+        finally:
+            os.unlink(input_file.name)
+
+    def test_run_virtual(self):
+        """
+        Checks that a producer and a consumer trade without waiting for their delays
+        """
+        tea = product.Tea(name="Linden", price=9, type="Herbal")
+        destination = MemoryDestination()
+        market_config = {
+            "marketplace": {"queue_size_per_producer": 2},
+            "producers": [{"name": "prod1", "products": [(tea, 2, 60)],
+                           "republish_wait_time": 60}],
+            "consumers": [{"name": "cons1", "retry_wait_time": 60,
+                           "carts": [[{"type": "add", "product": tea, "quantity": 5}]]}],
+        }
+
+        start = perf_counter()
+        sink = OrderSink(destination)
+        _, elapsed = run_virtual(market_config, order_sink=sink)
+        sink.close()
+
+        self.assertLess(perf_counter() - start, 5)
+        self.assertGreaterEqual(elapsed, 4 * 60)
+        self.assertEqual(destination.lines(), [f"cons1 bought {tea}"] * 5)
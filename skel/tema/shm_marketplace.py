@@ -0,0 +1,348 @@
+"""
+This module represents the multi-process version of the Marketplace.
+
+The inventory and the carts live in a multiprocessing.shared_memory block, as
+counters indexed by integer producer, product and cart ids, so that producers
+and consumers running in different processes share them and use all the cores.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import unittest
+from multiprocessing import Lock, Process
+from multiprocessing.shared_memory import SharedMemory
+
+from tema.catalog import ProductCatalog
+from tema.consumer import Consumer
+from tema.order_sink import get_order_sink
+from tema.producer import Producer
+from tema.product import Coffee, Tea
+
+# Number of locks the carts are spread over
+CART_LOCK_STRIPES = 64
+
+
+class SharedMarketplace:
+    """
+    Marketplace whose state is shared between processes.
+
+    Shared memory layout (int64 cells):
+        - producer count, cart count;
+        - sizes[producer]: number of units queued by each producer;
+        - stock[product][producer]: units of each product held by each producer;
+        - carts[cart][product]: units of each product in each cart.
+
+    Locking follows Marketplace: registry_lock, one lock per producer, one per
+    product and striped cart locks, all multiprocessing locks, never nested.
+    Blocking calls (timeout != 0) are not supported.
+    """
+
+    def __init__(self, queue_size_per_producer, products, max_producers, max_carts):
+        """
+        Constructor
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+        :type products: List
+        :param products: every product that can be published; its position is its id
+
+        :type max_producers: Int
+        :param max_producers: the maximum number of producers that can register
+
+        :type max_carts: Int
+        :param max_carts: the maximum number of carts that can be created
+        """
+        self.queue_size_per_producer = queue_size_per_producer
+        self.catalog = ProductCatalog(products)
+        self.max_producers = max_producers
+
+        self.registry_lock = Lock()
+        self.producer_locks = [Lock() for _ in range(max_producers)]
+        self.product_locks = [Lock() for _ in range(len(self.catalog))]
+        self.cart_locks = [Lock() for _ in range(CART_LOCK_STRIPES)]
+
+        cells = 2 + max_producers * (1 + len(self.catalog)) + max_carts * len(self.catalog)
+        self.shm = SharedMemory(create=True, size=cells * 8)
+        self.cells = self.shm.buf.cast('q')
+        for idx in range(cells):
+            self.cells[idx] = 0
+
+    def __getstate__(self):
+        """
+        Processes that are spawned reattach to the shared memory block by name.
+        """
+        state = self.__dict__.copy()
+        state["shm"] = self.shm.name
+        del state["cells"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = SharedMemory(name=state["shm"])
+        self.cells = self.shm.buf.cast('q')
+
+    def close(self, unlink=False):
+        """
+        Detaches from the shared memory block; the owner also unlinks it.
+        """
+        self.cells.release()
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+    def _size_cell(self, producer_idx):
+        return 2 + producer_idx
+
+    def _stock_cell(self, product_id, producer_idx):
+        return 2 + self.max_producers * (1 + product_id) + producer_idx
+
+    def _cart_cell(self, cart_idx, product_id):
+        return (2 + self.max_producers * (1 + len(self.catalog))
+                + cart_idx * len(self.catalog) + product_id)
+
+    def register_producer(self):
+        """
+        Returns an id for the producer that calls this.
+        """
+        with self.registry_lock:
+            if self.cells[0] == self.max_producers:
+                raise IndexError("no free producer slots")
+            self.cells[0] += 1
+            return self.cells[0]
+
+    def publish(self, producer_id, product, timeout=0):
+        """
+        Adds the product provided by the producer to the marketplace.
+        See Marketplace.publish.
+        """
+        return self.publish_many(producer_id, product, 1, timeout) == 1
+
+    def publish_many(self, producer_id, product, quantity, timeout=0):
+        """
+        Adds quantity units of the product provided by the producer to the marketplace.
+        See Marketplace.publish_many.
+        """
+        if timeout != 0:
+            raise ValueError("blocking calls are not supported across processes")
+
+        producer_idx = producer_id - 1
+        product_id = self.catalog.find(product)
+
+        # Reserve slots in the producer's queue
+        size_cell = self._size_cell(producer_idx)
+        with self.producer_locks[producer_idx]:
+            reserved = min(quantity, self.queue_size_per_producer - self.cells[size_cell])
+            if reserved <= 0:
+                return 0
+            self.cells[size_cell] += reserved
+
+        with self.product_locks[product_id]:
+            self.cells[self._stock_cell(product_id, producer_idx)] += reserved
+
+        return reserved
+
+    def new_cart(self):
+        """
+        Creates a new cart for the consumer
+
+        returns an int representing the cart_id
+        """
+        with self.registry_lock:
+            # The carts take the end of the block
+            if self._cart_cell(self.cells[1], 0) >= len(self.cells):
+                raise IndexError("no free cart slots")
+            self.cells[1] += 1
+            return self.cells[1]
+
+    def add_to_cart(self, cart_id, product, quantity=1, timeout=0):
+        """
+        Adds a product to the given cart. See Marketplace.add_to_cart.
+
+        returns the number of units added
+        """
+        if timeout != 0:
+            raise ValueError("blocking calls are not supported across processes")
+
+        product_id = self.catalog.find(product)
+
+        # Take the units from whichever producers hold them
+        taken = {}
+        missing = quantity
+        with self.product_locks[product_id]:
+            for producer_idx in range(self.cells[0]):
+                cell = self._stock_cell(product_id, producer_idx)
+                units = min(missing, self.cells[cell])
+                if units:
+                    self.cells[cell] -= units
+                    taken[producer_idx] = units
+                    missing -= units
+                    if not missing:
+                        break
+
+        # Free their slots
+        for producer_idx, units in taken.items():
+            with self.producer_locks[producer_idx]:
+                self.cells[self._size_cell(producer_idx)] -= units
+
+        added = quantity - missing
+        if added:
+            with self.cart_locks[cart_id % CART_LOCK_STRIPES]:
+                self.cells[self._cart_cell(cart_id - 1, product_id)] += added
+
+        return added
+
+    def remove_from_cart(self, cart_id, product, quantity=1):
+        """
+        Removes a product from cart. See Marketplace.remove_from_cart.
+
+        returns the number of units removed
+        """
+        product_id = self.catalog.find(product)
+
+        cart_cell = self._cart_cell(cart_id - 1, product_id)
+        with self.cart_locks[cart_id % CART_LOCK_STRIPES]:
+            removed = min(quantity, self.cells[cart_cell])
+            self.cells[cart_cell] -= removed
+
+        # Add the units back to the producers' queues that have room
+        returned = 0
+        for producer_idx in range(self.cells[0]):
+            if returned == removed:
+                break
+
+            size_cell = self._size_cell(producer_idx)
+            with self.producer_locks[producer_idx]:
+                units = min(removed - returned,
+                            self.queue_size_per_producer - self.cells[size_cell])
+                if units <= 0:
+                    continue
+                self.cells[size_cell] += units
+
+            with self.product_locks[product_id]:
+                self.cells[self._stock_cell(product_id, producer_idx)] += units
+            returned += units
+
+        return removed
+
+    def place_order(self, cart_id):
+        """
+        Return a tuple with all the products in the cart. See Marketplace.place_order;
+        the carts' cells are allocated upfront, they are not reused.
+        """
+        order = []
+        with self.cart_locks[cart_id % CART_LOCK_STRIPES]:
+            for product_id, product in enumerate(self.catalog.products()):
+                order += [product] * self.cells[self._cart_cell(cart_id - 1, product_id)]
+
+        return tuple(order)
+
+
+def run_producers(marketplace, producer_configs):
+    """
+    Process body: runs the producers as daemon threads until the process is terminated.
+    """
+    producers = [Producer(**config, marketplace=marketplace, daemon=True)
+                 for config in producer_configs]
+    for producer in producers:
+        producer.start()
+    for producer in producers:
+        producer.join()
+
+
+def run_consumers(marketplace, consumer_configs):
+    """
+    Process body: runs the consumers as threads until all of them are done.
+    """
+    # The sink writes each batch of whole lines with a single flush, so lines from
+    # different processes do not interleave
+    order_sink = get_order_sink()
+
+    consumers = [Consumer(**config, marketplace=marketplace, order_sink=order_sink)
+                 for config in consumer_configs]
+    for consumer in consumers:
+        consumer.start()
+    for consumer in consumers:
+        consumer.join()
+
+    # The process exits without running the atexit handlers
+    order_sink.flush()
+
+
+def run_processes(marketplace, producer_configs, consumer_configs, processes):
+    """
+    Runs the producers and the consumers split over the given number of processes each,
+    until all the consumers are done.
+    """
+    processes = max(1, processes)
+    producer_workers = [Process(target=run_producers,
+                                args=(marketplace, producer_configs[i::processes]),
+                                daemon=True)
+                        for i in range(processes) if producer_configs[i::processes]]
+    consumer_workers = [Process(target=run_consumers,
+                                args=(marketplace, consumer_configs[i::processes]))
+                        for i in range(processes) if consumer_configs[i::processes]]
+
+    for worker in producer_workers + consumer_workers:
+        worker.start()
+    for worker in consumer_workers:
+        worker.join()
+    for worker in producer_workers:
+        worker.terminate()
+        worker.join()
+
+
+class TestSharedMarketplace(unittest.TestCase):
+    """
+    Class for shared memory marketplace testing purposes
+    """
+
+    def setUp(self):
+        """
+        Initialize a marketplace with 2 products
+        """
+        self.tea = Tea(name="Linden", price=9, type="Herbal")
+        self.coffee = Coffee(name="Brasil", price=7, acidity=5.09, roast_level="MEDIUM")
+        self.marketplace = SharedMarketplace(3, [self.tea, self.coffee], 2, 4)
+
+    def tearDown(self):
+        self.marketplace.close(unlink=True)
+
+    def test_operations(self):
+        """
+        Checks the marketplace operations on the shared counters
+        """
+        producer_id = self.marketplace.register_producer()
+        cart_id = self.marketplace.new_cart()
+
+        self.assertEqual(self.marketplace.publish_many(producer_id, self.tea, 5), 3)
+        self.assertFalse(self.marketplace.publish(producer_id, self.coffee))
+        self.assertEqual(self.marketplace.add_to_cart(cart_id, self.tea, 4), 3)
+        self.assertEqual(self.marketplace.remove_from_cart(cart_id, self.tea, 1), 1)
+        self.assertEqual(self.marketplace.place_order(cart_id), (self.tea, self.tea))
+        self.assertEqual(self.marketplace.add_to_cart(cart_id, self.tea), 1)
+
+    def test_processes(self):
+        """
+        Checks that consumers in another process buy what producers in a third one publish
+        """
+        producer = {"name": "prod1", "products": [(self.tea, 2, 0), (self.coffee, 1, 0)],
+                    "republish_wait_time": 0.01}
+        cart = [{"type": "add", "product": self.tea, "quantity": 2},
+                {"type": "add", "product": self.coffee, "quantity": 1}]
+        consumer = {"name": "cons1", "carts": [cart], "retry_wait_time": 0.01}
+
+        consumers = Process(target=run_consumers, args=(self.marketplace, [consumer]))
+        producers = Process(target=run_producers, args=(self.marketplace, [producer]),
+                            daemon=True)
+        consumers.start()
+        producers.start()
+
+        consumers.join(timeout=30)
+        self.assertEqual(consumers.exitcode, 0, "Consumers did not finish")
+        producers.terminate()
+        producers.join()
+
+        # The consumer's cart holds its 3 units
+        self.assertEqual(self.marketplace.place_order(1), (self.tea, self.tea, self.coffee))
@@ -0,0 +1,190 @@
+"""
+This module runs step generators as tasks on a pool of worker threads.
+
+A task is a generator: each step runs on a worker and yields the seconds to
+wait before the next one. The waiting tasks are kept in a heap ordered by the
+time their next step is due; a timer thread hands the due steps to the pool, so
+any number of tasks share a few threads, none of them sleeping on a worker.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from heapq import heappop, heappush
+from itertools import count
+from threading import Condition, Thread
+from time import monotonic
+
+# Returned by next() once a task is done
+_DONE = object()
+
+
+class TaskScheduler:
+    """
+    Runs the steps of any number of tasks on at most max_workers threads.
+
+    The steps of a task run one at a time, in order. The pool starts a worker
+    only when a step is due and none is idle, so the number of workers follows
+    the backlog, up to max_workers. A step blocking (on a full queue, on a
+    missing product) holds its worker while it waits.
+    """
+
+    def __init__(self, max_workers=4, name="task"):
+        """
+        Constructor
+
+        :type max_workers: Int
+        :param max_workers: the maximum number of threads running steps
+
+        :type name: String
+        :param name: the prefix of the threads' names
+        """
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix=name)
+        self.condition = Condition()
+        self.stopped = False
+
+        # Tasks added and not done yet, the first exception a step raised
+        self.active = 0
+        self.error = None
+
+        # (due time, sequence number, task), earliest first
+        self.timers = []
+        self.sequence = count()
+
+        self.timer = Thread(target=self._dispatch, name=f"{name}-timer", daemon=True)
+        self.timer.start()
+
+    def schedule(self, task):
+        """
+        Adds a task, its first step running right away.
+
+        :type task: Generator
+        :param task: yields the seconds to wait after each step; None - no wait
+        """
+        with self.condition:
+            self.active += 1
+        self._schedule(0, task)
+
+    def _schedule(self, delay, task):
+        """
+        Schedules the task's next step after the given number of seconds.
+        """
+        with self.condition:
+            if self.stopped:
+                return
+
+            # A step due now skips the timer thread
+            if not delay:
+                self.executor.submit(self._run_step, task)
+                return
+
+            heappush(self.timers, (monotonic() + delay, next(self.sequence), task))
+
+            # The timer thread only needs to wake up earlier for a new earliest step
+            if self.timers[0][2] is task:
+                self.condition.notify_all()
+
+    def _dispatch(self):
+        """
+        Timer thread: hands each step to the pool once it is due.
+        """
+        with self.condition:
+            while not self.stopped:
+                if not self.timers:
+                    self.condition.wait()
+                    continue
+
+                delay = self.timers[0][0] - monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+
+                self.executor.submit(self._run_step, heappop(self.timers)[2])
+
+    def _run_step(self, task):
+        """
+        Worker: runs a task's step and schedules the next one after its wait.
+        """
+        try:
+            delay = next(task, _DONE)
+        except Exception as error:  # pylint: disable=broad-except
+            delay = _DONE
+            with self.condition:
+                self.error = self.error or error
+
+        if delay is not _DONE:
+            self._schedule(delay, task)
+            return
+
+        with self.condition:
+            self.active -= 1
+            if not self.active:
+                self.condition.notify_all()
+
+    def join(self):
+        """
+        Waits until every task added is done.
+
+        raises the first exception a step raised
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: not self.active or self.stopped)
+            if self.error is not None:
+                raise self.error
+
+    def stop(self):
+        """
+        Stops scheduling steps and waits for those running to finish.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+        self.timer.join()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class TestTaskScheduler(unittest.TestCase):
+    """
+    Class for task scheduler testing purposes
+    """
+
+    def test_steps(self):
+        """
+        Checks that the steps of each task run in order, after their waits
+        """
+        scheduler = TaskScheduler(max_workers=1)
+        steps = []
+
+        def task(name, delays):
+            for delay in delays:
+                steps.append((name, monotonic()))
+                yield delay
+            steps.append((name, monotonic()))
+
+        start = monotonic()
+        scheduler.schedule(task("a", [0.2, None]))
+        scheduler.schedule(task("b", [0.1]))
+        scheduler.join()
+        scheduler.stop()
+
+        self.assertEqual([name for name, _ in steps], ["a", "b", "b", "a", "a"])
+        self.assertGreaterEqual(steps[2][1] - start, 0.1)
+        self.assertGreaterEqual(steps[3][1] - start, 0.2)
+
+    def test_error(self):
+        """
+        Checks that a failing task is done and its exception raised by join
+        """
+        scheduler = TaskScheduler(max_workers=1)
+
+        def task():
+            yield 0.01
+            raise ValueError("broken")
+
+        scheduler.schedule(task())
+        with self.assertRaises(ValueError):
+            scheduler.join()
+        scheduler.stop()
@@ -0,0 +1,134 @@
+"""
+This module represents the virtual clock of the simulation mode.
+
+The producers and consumers sleep on the clock instead of time.sleep. Once all
+of them are asleep, nothing can happen until the earliest of them wakes up, so
+the clock jumps straight to that moment: a scenario runs without ever waiting
+and its threads still go through the same marketplace operations.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import unittest
+from heapq import heappop, heappush
+from itertools import count
+from threading import Event, Lock, Thread
+from time import perf_counter
+
+
+class VirtualClock:
+    """
+    Clock shared by a set of threads, advancing only when all of them sleep.
+
+    Only the threads started with start() may sleep on it: a thread blocked on
+    anything else than the clock (a lock, I/O) simply delays the next jump.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.now = 0.0
+        self.participants = 0
+        self.stopped = False
+
+        # (wake up time, sequence number, event set on waking up), earliest first
+        self.sleepers = []
+        self.sequence = count()
+
+    def time(self):
+        """
+        Returns the virtual seconds elapsed since the clock was created.
+        """
+        return self.now
+
+    def start(self, *threads):
+        """
+        Starts threads sleeping on the clock; the clock stops waiting for each once it ends.
+
+        They join together, so that the first to sleep does not advance the clock alone.
+        """
+        with self.lock:
+            self.participants += len(threads)
+
+        for thread in threads:
+            thread.run = self._run_then_leave(thread.run)
+            thread.start()
+
+    def _run_then_leave(self, run):
+        """
+        Returns the thread body followed by leaving the clock.
+        """
+        def run_then_leave():
+            try:
+                run()
+            finally:
+                self.leave()
+
+        return run_then_leave
+
+    def leave(self):
+        """
+        Removes the calling thread from the threads the clock waits for.
+        """
+        with self.lock:
+            self.participants -= 1
+            self._advance()
+
+    def stop(self):
+        """
+        Stops the clock: the threads still sleeping never wake up.
+        """
+        with self.lock:
+            self.stopped = True
+
+    def sleep(self, seconds):
+        """
+        Blocks the calling thread for the given number of virtual seconds.
+        """
+        woken = Event()
+        with self.lock:
+            heappush(self.sleepers, (self.now + max(seconds, 0), next(self.sequence), woken))
+            self._advance()
+
+        # Only the sleepers due are woken, not every thread on the clock
+        woken.wait()
+
+    def _advance(self):
+        """
+        Jumps to the earliest wake up time and wakes its sleepers, if all the
+        threads are asleep. Called with the lock held.
+        """
+        if self.stopped or not self.sleepers or len(self.sleepers) < self.participants:
+            return
+
+        self.now = max(self.now, self.sleepers[0][0])
+        while self.sleepers and self.sleepers[0][0] <= self.now:
+            heappop(self.sleepers)[2].set()
+
+
+class TestVirtualClock(unittest.TestCase):
+    """
+    Class for virtual clock testing purposes
+    """
+
+    def test_sleep(self):
+        """
+        Checks that sleeping threads wake up in virtual time order, without waiting
+        """
+        clock = VirtualClock()
+        woken = []
+
+        def sleeper(name, delays):
+            for delay in delays:
+                clock.sleep(delay)
+                woken.append((clock.time(), name))
+
+        threads = [Thread(target=sleeper, args=("a", [10, 10, 10])),
+                   Thread(target=sleeper, args=("b", [15, 1]))]
+        start = perf_counter()
+        clock.start(*threads)
+        for thread in threads:
+            thread.join(timeout=10)
+
+        self.assertLess(perf_counter() - start, 5)
+        self.assertEqual(woken, [(10, "a"), (15, "b"), (16, "b"), (20, "a"), (30, "a")])
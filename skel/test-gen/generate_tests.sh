@@ -11,3 +11,6 @@ python3 test_generator.py 08 10 50 5 40 1 5
 python3 test_generator.py 09 20 5 2 25 1 2
 python3 test_generator.py 10 50 200 10 40 1 5
 
+
+# Load scenario: synthetic products, streamed to disk, no removals (empty is_basic/supports_removal)
+# python3 test_generator.py load 10 100000 10 100 5 10 "" "" --stream --wait-scale 0.01
@@ -11,9 +11,11 @@ Script input
     - max number of carts per consumer
     - is basic test
     - should have removal operations
+    - --stream: synthetic products, .in/.jsonl/.ref.out written incrementally (see stream_test)
 """
 import argparse
 import random
+from collections import Counter
 from json import loads, dumps
 
 from tema.product import *  # pylint: disable=wildcard-import, unused-wildcard-import
@@ -33,6 +35,10 @@ def generate_test():
         print("Invalid arguments")
     print(cmdline_arguments)
 
+    if cmdline_arguments[ARG_STREAM]:
+        stream_test(cmdline_arguments)
+        return
+
     products = generate_products(cmdline_arguments[ARG_PRODUCTS])
     producers = generate_producers(cmdline_arguments[ARG_PRODUCERS],
                                    products, cmdline_arguments[ARG_IS_BASIC])
@@ -93,6 +99,12 @@ def parse_input():
                         help="True if it is a simple test, False otherwise")
     parser.add_argument(ARG_SUPPORTS_REMOVAL, type=bool, nargs='?', default=True,
                         help="True if the consumer can remove products from cart, False otherwise")
+    parser.add_argument("--" + ARG_STREAM, action="store_true",
+                        help="synthetic products of any count, written to disk incrementally")
+    parser.add_argument("--" + ARG_SEED, type=int, default=0,
+                        help="random seed of the streaming mode")
+    parser.add_argument("--wait-scale", dest=ARG_WAIT_SCALE, type=float, default=1.0,
+                        help="factor applied to the waiting times of the streaming mode")
 
     return parser.parse_args().__dict__
 
@@ -345,5 +357,171 @@ def generate_in_out_test_files(test_name):
         print(dumps(conf, indent=4), file=input_file)
 
 
+def synthetic_product(rng, index):
+    """
+    Generates the description of a product with a unique name, half coffee, half tea.
+    :param rng: the random generator
+    :param index: the product's index, part of its name
+    :return: a dict like the ones of generate_products
+    """
+    if index % 2 == 0:
+        product = {"product_type": "Coffee",
+                   "name": SYNTHETIC_COFFEE_PREFIX + str(index + 1),
+                   "acidity": round(rng.uniform(MIN_ACIDITY, MAX_ACIDITY), 2),
+                   "roast_level": rng.choice(ROAST_LEVEL)}
+    else:
+        product = {"product_type": "Tea",
+                   "name": SYNTHETIC_TEA_PREFIX + str(index + 1),
+                   "type": rng.choice(TEA_TYPES)}
+
+    product["price"] = rng.randint(1, 10)
+    return product
+
+
+def generate_cart(rng, product_count, max_operations, max_quantity, has_remove_operation):
+    """
+    Generates the operations of a cart on products given by their index,
+    like generate_consumers does.
+    :return: a list of operations
+    """
+    num_operations = min(rng.randint(1, max_operations), product_count)
+
+    operations = [{"type": ADD_TO_CART_OP, "product": index,
+                   "quantity": rng.randint(1, max_quantity)}
+                  for index in rng.sample(range(product_count), num_operations)]
+
+    # 0 or 1 removal operations
+    if has_remove_operation and rng.randint(0, 1) > 0:
+        operation = rng.choice(operations)
+        operations.append({"type": REMOVE_FROM_CART_OP,
+                           "product": operation["product"],
+                           "quantity": rng.randint(1, operation["quantity"])})
+
+    return operations
+
+
+def write_items(output_file, items):
+    """
+    Writes the items as the elements of a JSON array, one by one.
+    """
+    output_file.write("[")
+    for count, item in enumerate(items):
+        output_file.write((",\n" if count else "\n") + dumps(item))
+    output_file.write("\n]")
+
+
+def stream_test(arguments):
+    """
+    Generates a test of any size, writing the input and reference output files while
+    generating it. Only the products, the producers and a few numbers per consumer are
+    kept in memory, so the operation count is only bound by the disk.
+
+    Every product is produced by exactly one producer (or several, when there are more
+    producers than products): producer i produces the products i, i + producers, ...
+    A producer's queue can then only fill up with its own products, so with at least
+    as many producers as products no wanted product is held back by a queue full of
+    unwanted ones.
+
+    Each consumer and each cart have a random generator of their own, so the carts can
+    be generated in any order: consumer by consumer, in the order of their names, which
+    is the order of their lines in the sorted reference output, and round-robin over
+    the consumers for the JSON Lines input (see tema.scenario.load_stream).
+    :param arguments: the command line arguments
+    :return: nothing
+    """
+    rng = random.Random(arguments[ARG_SEED])
+    test_name = arguments[ARG_TEST_NAME]
+    product_count = arguments[ARG_PRODUCTS]
+    producer_count = arguments[ARG_PRODUCERS]
+    is_basic = arguments[ARG_IS_BASIC]
+    wait_scale = arguments[ARG_WAIT_SCALE]
+
+    def wait_time(generator):
+        return round(generator.uniform(MIN_WAIT_TIME, MAX_WAIT_TIME) * wait_scale, 4)
+
+    def own_rng(*path):
+        return random.Random("/".join(str(x) for x in (arguments[ARG_SEED],) + path))
+
+    products = [synthetic_product(rng, i) for i in range(product_count)]
+    product_ids = [PRODUCT_PREFIX + str(i + 1) for i in range(product_count)]
+
+    # The reference output shows the products as the homework prints them
+    product_names = [str(globals()[product["product_type"]](
+        **{k: v for k, v in product.items() if k != "product_type"})) for product in products]
+
+    producers = [{"name": PRODUCER_NAME_PREFIX + str(index + 1),
+                  ARG_PRODUCTS: [[product_ids[i], rng.randint(1, 3 if is_basic else 5),
+                                  wait_time(rng)]
+                                 for i in range(index % product_count, product_count,
+                                                producer_count)],
+                  "republish_wait_time": wait_time(rng)}
+                 for index in range(producer_count)]
+
+    def cart(index, cart_index):
+        operations = generate_cart(own_rng(index, cart_index), product_count,
+                                   3 if is_basic else 10, 5 if is_basic else 10,
+                                   arguments[ARG_SUPPORTS_REMOVAL])
+        return operations, compute_expected_cart(operations)
+
+    def with_ids(operations):
+        return [dict(operation, product=product_ids[operation["product"]])
+                for operation in operations]
+
+    # Name, retry time and cart count of every consumer, in the order of their names:
+    # "cons1" < "cons10" < "cons2", like their "consN bought ..." lines
+    consumers = []
+    for index in sorted(range(1, arguments[ARG_CONSUMERS] + 1), key=str):
+        consumer_rng = own_rng(index)
+        consumers.append((index, CONSUMER_NAME_PREFIX + str(index), wait_time(consumer_rng),
+                          consumer_rng.randint(arguments[ARG_MIN_CARTS],
+                                               arguments[ARG_MAX_CARTS])))
+
+    def consumer(index, name, retry_wait_time, cart_count, ref_file):
+        carts = []
+        bought = Counter()
+        for cart_index in range(cart_count):
+            operations, expected_cart = cart(index, cart_index)
+            carts.append(with_ids(operations))
+            bought.update(expected_cart)
+
+        for i in sorted(bought, key=product_names.__getitem__):
+            ref_file.write(f"{name} bought {product_names[i]}\n" * bought[i])
+
+        return {"name": name, "retry_wait_time": retry_wait_time, "carts": carts}
+
+    marketplace = generate_marketplace(arguments[ARG_MARKETPLACE_Q])
+
+    with open(f'{TESTS_DIR}/{test_name}.in', 'w', encoding="utf-8") as input_file, \
+            open(f'{TESTS_DIR}/{test_name}.ref.out', 'w', encoding="utf-8") as ref_file:
+        input_file.write('{"' + ARG_PRODUCTS + '": {')
+        for count, (product_id, product) in enumerate(zip(product_ids, products)):
+            input_file.write((",\n" if count else "\n") + dumps(product_id) + ": "
+                             + dumps(product))
+        input_file.write('\n},\n"' + ARG_PRODUCERS + '": ')
+        write_items(input_file, producers)
+        input_file.write(',\n"' + ARG_CONSUMERS + '": ')
+        write_items(input_file, (consumer(*config, ref_file) for config in consumers))
+        input_file.write(',\n"marketplace": ' + dumps(marketplace) + "}\n")
+
+    # The same test as JSON Lines: the definitions first, then one cart per line
+    with open(f'{TESTS_DIR}/{test_name}.jsonl', 'w', encoding="utf-8") as input_file:
+        input_file.write(dumps({"marketplace": marketplace}) + "\n")
+        for product_id, product in zip(product_ids, products):
+            input_file.write(dumps({"product": product_id, **product}) + "\n")
+        for producer in producers:
+            input_file.write(dumps({"producer": producer}) + "\n")
+        for _, name, retry_wait_time, _ in consumers:
+            input_file.write(dumps({"consumer": {"name": name,
+                                                 "retry_wait_time": retry_wait_time}}) + "\n")
+
+        # Round-robin, so that every consumer gets its first carts early on
+        for cart_index in range(arguments[ARG_MAX_CARTS]):
+            for index, name, _, cart_count in consumers:
+                if cart_index < cart_count:
+                    input_file.write(dumps({"cart": name,
+                                            "operations": with_ids(cart(index, cart_index)[0])})
+                                     + "\n")
+
+
 if __name__ == "__main__":
     generate_test()
@@ -42,6 +42,13 @@ DEFAULT_MARKETPLACE_QUEUE_SIZE = 8
 DEFAULT_MIN_NUMBER_CARTS_PER_CONSUMER = 1
 DEFAULT_MAX_NUMBER_CARTS_PER_CONSUMER = 3
 
+# Streaming mode: synthetic catalogs of any size
+SYNTHETIC_COFFEE_PREFIX = "Coffee "
+SYNTHETIC_TEA_PREFIX = "Tea "
+TEA_TYPES = sorted(set(TEA_NAMES_TYPES.values()))
+MIN_WAIT_TIME = 0.05
+MAX_WAIT_TIME = 0.4
+
 # Input arguments names for the test_generator script
 ARG_TEST_NAME = "test_name"
 ARG_PRODUCERS = "producers"
@@ -52,3 +59,6 @@ ARG_MAX_CARTS = "max_carts"
 ARG_MARKETPLACE_Q = "marketplace_q"
 ARG_IS_BASIC = "is_basic"
 ARG_SUPPORTS_REMOVAL = "supports_removal"
+ARG_STREAM = "stream"
+ARG_SEED = "seed"
+ARG_WAIT_SCALE = "wait_scale"
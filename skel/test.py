@@ -6,68 +6,193 @@ Assignment 1
 March 2020
 """
 
+import argparse
+import json
 import sys
-from json import loads
 
-from tema.producer import Producer
-from tema.consumer import Consumer
 from tema.marketplace import Marketplace
-from tema.product import Product, Coffee, Tea
-
-
-def main():
+from tema.marketplace_log import get_pipeline
+from tema.marketplace_server import MarketplaceClient, parse_address
+from tema.marketplace_trace import TraceRecorder
+from tema.order_sink import get_order_sink
+from tema.order_analytics import OrderAnalytics, numpy
+from tema.order_journal import OrderJournal
+from tema.order_verifier import OrderVerifier
+from tema.scenario import load_config, load_stream, run_threads, run_asyncio, run_shared_memory, \
+    run_virtual
+
+
+def parse_args():
     """
-        Convert the market_configuration input file into specific models:
-        Producer, Consumer, Marketplace
+        Parses the command line: the input file and the run options
     """
-    try:
-        filename = sys.argv[1]
-    except IndexError:
-        print("no input file specified")
-        raise SystemExit
-
-    with open(filename) as input_file:
-        market_config = loads(input_file.read())
-
-    # turn product definitions into actual products
-    products = {}
-
-    for k, products_dict in market_config['products'].items():
-        params = {k: products_dict[k] for k in products_dict.keys() if k != 'product_type'}
-        products[k] = globals()[products_dict['product_type']](**params)
-    del market_config['products']
-
-    # turn product ids into products in producers
-    for producer in market_config['producers']:
-        producer['products'] = [(products[i], quantity, sleep_time)
-                                for i, quantity, sleep_time
-                                in producer['products']]
-
-    # turn product ids into products in consumer order lists and expected carts
-    for consumer in market_config['consumers']:
-        for cart in consumer['carts']:
-            for operation in cart:
-                operation['product'] = products[operation['product']]
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename", help="market configuration input file; a .jsonl file "
+                                         "is streamed, its carts read while the consumers run")
+    parser.add_argument("--blocking", action="store_true",
+                        help="producers and consumers wait on the marketplace "
+                             "instead of sleep-polling")
+    parser.add_argument("--wait-timeout", type=float, default=None,
+                        help="seconds a blocking call waits before retrying "
+                             "(default: wait until it succeeds)")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="run every producer and consumer as a coroutine "
+                             "on a single event loop")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="split the producers and the consumers over this many "
+                             "processes each, sharing a shared memory marketplace")
+    parser.add_argument("--virtual-time", action="store_true",
+                        help="simulate the waiting times on a virtual clock instead of "
+                             "sleeping; the virtual duration is printed to stderr")
+    parser.add_argument("--producer-workers", type=int, default=0, metavar="N",
+                        help="run the producers' batches on a pool of at most N threads "
+                             "instead of a thread per producer")
+    parser.add_argument("--consumer-workers", type=int, default=0, metavar="N",
+                        help="run the consumers' carts on a pool of at most N threads "
+                             "instead of a thread per consumer")
+    parser.add_argument("--connect", metavar="ADDRESS",
+                        help="use the marketplace served by server.py at host:port or at "
+                             "this Unix socket path, instead of one in this process; the "
+                             "server's --queue-size should be the scenario's")
+    parser.add_argument("--record", metavar="FILE",
+                        help="record the marketplace calls and their results to this trace "
+                             "file, to be replayed with replay.py")
+    parser.add_argument("--verify", action="store_true",
+                        help="check every order as it is placed: the first wrong one is "
+                             "printed to stderr and the exit status is 1")
+    parser.add_argument("--analytics", metavar="FILE",
+                        help="aggregate the orders (top sellers, revenue, fill rates) and "
+                             "write the report to this JSON file; needs NumPy")
+    parser.add_argument("--journal", metavar="FILE",
+                        help="append every placed order to this binary journal, read with "
+                             "tema.order_journal.OrderJournalReader")
+    parser.add_argument("--log-level", default="INFO",
+                        help="minimum level written to marketplace.log, e.g. WARNING to disable")
+    parser.add_argument("--log-sample-rate", type=float, default=1.0,
+                        help="fraction of the marketplace log records that are kept")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="record the marketplace's metrics and write their snapshot "
+                             "to this JSON file")
+
+    args = parser.parse_args()
+    if args.filename.endswith(".jsonl") and (args.asyncio or args.processes):
+        parser.error("a .jsonl scenario only runs with threads")
+    if args.filename.endswith(".jsonl") and args.consumer_workers:
+        # The pooled consumers would wait for the feeder, which waits for a consumer without one
+        parser.error("a .jsonl scenario does not run with --consumer-workers")
+    if args.metrics and args.processes:
+        parser.error("the shared memory marketplace has no metrics")
+    if args.virtual_time and (args.asyncio or args.processes or args.blocking):
+        parser.error("--virtual-time only runs sleep-polling threads")
+    if (args.producer_workers or args.consumer_workers) and \
+            (args.asyncio or args.processes or args.virtual_time):
+        parser.error("--producer-workers and --consumer-workers only run with real-time threads")
+    if args.producer_workers and args.blocking:
+        # Producers blocked on their full queues would hold every worker
+        parser.error("--producer-workers only runs sleep-polling producers")
+    if args.consumer_workers and args.blocking:
+        # So would consumers blocked on missing products
+        parser.error("--consumer-workers only runs sleep-polling consumers")
+    if args.connect and (args.asyncio or args.processes or args.metrics or args.record or
+                         args.journal):
+        parser.error("--connect only runs threads, without --metrics, --record or --journal")
+    if args.journal and (args.asyncio or args.processes):
+        parser.error("--journal only journals the threads' marketplace")
+    if args.verify and args.processes:
+        parser.error("--verify does not run across processes")
+    if args.analytics and (args.processes or numpy is None):
+        parser.error("--analytics needs NumPy and does not run across processes")
+    if args.record and (args.asyncio or args.processes or args.blocking):
+        parser.error("--record only records sleep-polling threads")
+
+    return args
+
+
+def new_marketplace(args, market_config):
+    """
+        Returns the marketplace the threads run on: a new one, or a client of the served one
+    """
+    if args.connect:
+        # The server's queue size applies, not the scenario's
+        return MarketplaceClient(parse_address(args.connect), pool_size=16)
+    return Marketplace(**market_config['marketplace'], metrics=bool(args.metrics),
+                       journal=OrderJournal(args.journal) if args.journal else None)
 
-    # build the marketplace
-    marketplace = Marketplace(**market_config['marketplace'])
 
-    # build and start the producers
-    producers = [Producer(**p_market_config, marketplace=marketplace, daemon=True)
-                 for p_market_config in market_config['producers']]
+def wrap_order_sink(args, market_config):
+    """
+        Puts the verifier and the analytics asked for in front of the order sink;
+        both note the order of every cart as the consumers read it
 
-    for producer in producers:
-        producer.start()
+        returns the sink the consumers use (None - the default one), the verifier
+        and the analytics (None if not asked for)
+    """
+    order_sink = verifier = analytics = None
+    if args.verify:
+        order_sink = verifier = OrderVerifier(get_order_sink())
+    if args.analytics:
+        order_sink = analytics = OrderAnalytics(order_sink if order_sink is not None
+                                                else get_order_sink())
+
+    for consumer in market_config['consumers']:
+        for wrapper in (verifier, analytics):
+            if wrapper is not None:
+                consumer['carts'] = wrapper.carts(consumer['name'], consumer['carts'])
 
-    # build and start the consumers
-    consumers = [Consumer(**c_market_config, marketplace=marketplace)
-                 for c_market_config in market_config['consumers']]
+    return order_sink, verifier, analytics
 
-    for consumer in consumers:
-        consumer.start()
 
-    for consumer in consumers:
-        consumer.join()
+def main():
+    """
+        Convert the market_configuration input file into specific models:
+        Producer, Consumer, Marketplace
+    """
+    args = parse_args()
+
+    log_pipeline = get_pipeline()
+    log_pipeline.set_level(args.log_level)
+    log_pipeline.set_sample_rate(args.log_sample_rate)
+
+    if args.filename.endswith(".jsonl"):
+        market_config = load_stream(args.filename)
+    else:
+        market_config = load_config(args.filename)
+
+    order_sink, verifier, analytics = wrap_order_sink(args, market_config)
+
+    if args.asyncio:
+        marketplace = run_asyncio(market_config, metrics=bool(args.metrics),
+                                  order_sink=order_sink)
+    elif args.processes:
+        run_shared_memory(market_config, args.processes)
+    else:
+        marketplace = new_marketplace(args, market_config)
+        market = TraceRecorder(marketplace, args.record) if args.record else marketplace
+
+        if args.virtual_time:
+            _, elapsed = run_virtual(market_config, market, order_sink)
+            print(f"virtual time: {elapsed:.3f} s", file=sys.stderr)
+        else:
+            # 0 keeps the sleep-polling behaviour
+            run_threads(market_config, args.wait_timeout if args.blocking else 0, market,
+                        order_sink, producer_workers=args.producer_workers,
+                        consumer_workers=args.consumer_workers)
+
+        if args.record:
+            market.close()
+        if args.journal:
+            marketplace.journal.close()
+
+    if args.metrics:
+        with open(args.metrics, 'w', encoding="utf-8") as metrics_file:
+            json.dump(marketplace.snapshot(), metrics_file, indent=2)
+
+    if analytics is not None:
+        with open(args.analytics, 'w', encoding="utf-8") as analytics_file:
+            json.dump(analytics.report(), analytics_file, indent=2)
+
+    if verifier is not None and verifier.finish() is not None:
+        sys.exit(1)
 
 
 if __name__ == '__main__':